@@ -0,0 +1,158 @@
+'''
+python interface to the Salesforce Bulk API 2.0 ingest and query jobs
+'''
+
+import logging
+import tempfile
+import time
+
+import requests
+
+from cumulusci.salesforce_api.exceptions import Bulk2ApiError
+
+
+class Bulk2Api(object):
+    """ A client for Bulk API 2.0 jobs.
+
+    An ingest job takes the data of all of its records in a single csv
+    upload which the server splits into batches itself.  Query job results
+    are downloaded in pages which are linked by locators.
+    """
+
+    # Query jobs were added to the Bulk API 2.0 in API version 47.0
+    min_api_version = 47.0
+
+    # The upload of an ingest job is limited to 150MB once base64 encoded by
+    # the server which leaves 100MB of csv data
+    max_upload_bytes = 100000000
+
+    poll_interval = 10
+
+    def __init__(self, instance_url, access_token, api_version, logger=None):
+        if not instance_url.startswith('https://'):
+            instance_url = 'https://' + instance_url
+        if not logger:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+        self.api_version = float(api_version)
+        if self.api_version < self.min_api_version:
+            self.logger.warning(
+                'Bulk API 2.0 requires API version {:.1f} or later; '
+                'using {:.1f} instead of {:.1f}'.format(
+                    self.min_api_version, self.min_api_version, self.api_version))
+            self.api_version = self.min_api_version
+        self.endpoint = '{}/services/data/v{:.1f}/jobs'.format(
+            instance_url.rstrip('/'), self.api_version)
+        # Reuse connections across the many calls of a job
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer {}'.format(access_token)
+
+    def _request(self, method, path, **kwargs):
+        resp = self.session.request(method, self.endpoint + path, **kwargs)
+        if resp.status_code >= 400:
+            try:
+                error = resp.json()[0]
+                message = '{errorCode}: {message}'.format(**error)
+            except (ValueError, IndexError, KeyError, TypeError):
+                message = resp.content
+            raise Bulk2ApiError(message, resp)
+        return resp
+
+    def _download(self, path, **kwargs):
+        """ Streams a csv response to a temporary file and returns the file
+        with the response """
+        resp = self._request('GET', path, stream=True, **kwargs)
+        result_file = tempfile.TemporaryFile()
+        for chunk in resp.iter_content(chunk_size=65536):
+            result_file.write(chunk)
+        result_file.seek(0)
+        return result_file, resp
+
+    def create_ingest_job(self, sf_object, operation, external_id_field=None):
+        """ Creates an ingest job for csv data written with CRLF line endings
+        and returns the job info """
+        job = {
+            'object': sf_object,
+            'operation': operation,
+            'contentType': 'CSV',
+            'lineEnding': 'CRLF',
+        }
+        if external_id_field:
+            job['externalIdFieldName'] = external_id_field
+        return self._request('POST', '/ingest', json=job).json()
+
+    def upload_job_data(self, job_id, data):
+        """ Uploads the csv data of an ingest job from a string or file """
+        self._request(
+            'PUT',
+            '/ingest/{}/batches'.format(job_id),
+            data=data,
+            headers={'Content-Type': 'text/csv'},
+        )
+
+    def close_job(self, job_id):
+        """ Marks the upload of an ingest job as complete so it is queued
+        for processing """
+        return self._set_job_state(job_id, 'UploadComplete')
+
+    def abort_job(self, job_id, job_type='ingest'):
+        return self._set_job_state(job_id, 'Aborted', job_type)
+
+    def _set_job_state(self, job_id, state, job_type='ingest'):
+        return self._request(
+            'PATCH',
+            '/{}/{}'.format(job_type, job_id),
+            json={'state': state},
+        ).json()
+
+    def get_job(self, job_id, job_type='ingest'):
+        return self._request('GET', '/{}/{}'.format(job_type, job_id)).json()
+
+    def wait_for_job(self, job_id, job_type='ingest'):
+        """ Polls a job until it is complete and returns the job info.
+        Raises Bulk2ApiError if the job failed or was aborted. """
+        while True:
+            info = self.get_job(job_id, job_type)
+            if info['state'] == 'JobComplete':
+                return info
+            if info['state'] in ('Failed', 'Aborted'):
+                raise Bulk2ApiError(
+                    'Job {} {}: {}'.format(
+                        job_id, info['state'].lower(), info.get('errorMessage')),
+                    info,
+                )
+            time.sleep(self.poll_interval)
+
+    def get_successful_results(self, job_id):
+        """ Returns a temporary file with the sf__Id and sf__Created columns
+        and the uploaded fields of each successful row """
+        return self._download('/ingest/{}/successfulResults'.format(job_id))[0]
+
+    def get_failed_results(self, job_id):
+        """ Returns a temporary file with the sf__Id and sf__Error columns
+        and the uploaded fields of each failed row """
+        return self._download('/ingest/{}/failedResults'.format(job_id))[0]
+
+    def create_query_job(self, soql, operation='query'):
+        return self._request('POST', '/query', json={
+            'operation': operation,
+            'query': soql,
+            'contentType': 'CSV',
+        }).json()
+
+    def get_query_results(self, job_id, max_records=None):
+        """ Yields a temporary file for each page of the results of a
+        completed query job.  Every page starts with the header row. """
+        params = {}
+        if max_records:
+            params['maxRecords'] = max_records
+        while True:
+            result_file, resp = self._download(
+                '/query/{}/results'.format(job_id),
+                params=params,
+            )
+            yield result_file
+            locator = resp.headers.get('Sforce-Locator')
+            if not locator or locator == 'null':
+                return
+            params['locator'] = locator
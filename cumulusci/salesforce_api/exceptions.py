@@ -10,6 +10,12 @@ class MetadataApiError(CumulusCIException):
 class MetadataComponentFailure(MetadataApiError):
     pass
 
+class Bulk2ApiError(CumulusCIException):
+
+    def __init__(self, message, response):
+        super(Bulk2ApiError, self).__init__(message)
+        self.response = response
+
 class MissingOAuthError(CumulusCIException):
     pass
 
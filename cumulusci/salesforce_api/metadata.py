@@ -11,15 +11,21 @@ based on mrbelvedere/mpinstaller/mdapi.py
 
 from __future__ import unicode_literals
 import base64
+import heapq
+import itertools
 # import dateutil.parser
 import httplib
 import re
+import sys
+import tempfile
+import threading
 import time
-from xml.dom.minidom import parseString
 from xml.sax.saxutils import escape
 from zipfile import ZipFile
 import StringIO
 
+from future.utils import raise_
+from lxml import etree
 import requests
 
 from cumulusci.salesforce_api import soap_envelopes
@@ -29,8 +35,314 @@ from cumulusci.salesforce_api.exceptions import MetadataComponentFailure
 from cumulusci.salesforce_api.exceptions import MetadataApiError
 
 
+class _ZipFileTarget(object):
+    """ An lxml parser target which builds the SOAP envelope except for the
+    text of the zipFile element.  The base64 text is decoded as it is
+    parsed into a temporary file instead of being kept in memory. """
+
+    chunk_size = 65536
+
+    def __init__(self):
+        self.builder = etree.TreeBuilder()
+        self.zip_file = None
+        self._in_zip = False
+        self._data = []
+        self._size = 0
+
+    def start(self, tag, attrib, nsmap=None):
+        if tag.rsplit('}', 1)[-1] == 'zipFile':
+            self._in_zip = True
+            self.zip_file = tempfile.TemporaryFile()
+        return self.builder.start(tag, attrib, nsmap)
+
+    def data(self, data):
+        if not self._in_zip:
+            return self.builder.data(data)
+        self._data.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self._decode()
+
+    def end(self, tag):
+        if self._in_zip:
+            self._decode(final=True)
+            self.zip_file.seek(0)
+            self._in_zip = False
+        return self.builder.end(tag)
+
+    def close(self):
+        return self.builder.close()
+
+    def _decode(self, final=False):
+        data = ''.join(''.join(self._data).split())
+        # Only whole groups of 4 base64 characters can be decoded
+        end = len(data) if final else len(data) - len(data) % 4
+        self.zip_file.write(base64.b64decode(data[:end]))
+        self._data = [data[end:]]
+        self._size = len(data) - end
+
+
+class SoapResponse(object):
+    """ A Metadata API response with its SOAP envelope parsed once.
+
+    The parsed envelope is shared by fault detection, status handling and
+    result extraction.  Other attributes are read from the requests
+    response.  Elements are found by their local name in any namespace
+    like minidom's getElementsByTagName.
+
+    A streamed response is parsed as it is downloaded and the zipFile
+    element, if any, is decoded to the temporary file zip_file.  Its
+    content is then the envelope without the zip data.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, response, stream=False):
+        self.response = response
+        self.zip_file = None
+        if stream:
+            self._parse_stream()
+            return
+        try:
+            self.root = etree.fromstring(
+                response.content, etree.XMLParser(huge_tree=True))
+        except etree.XMLSyntaxError:
+            self.root = None
+
+    def _parse_stream(self):
+        target = _ZipFileTarget()
+        parser = etree.XMLParser(target=target, huge_tree=True)
+        # Keep the start of the body for errors which are not xml
+        head = []
+        head_size = 0
+        try:
+            for chunk in self.response.iter_content(self.chunk_size):
+                if head_size < self.chunk_size:
+                    head.append(chunk)
+                    head_size += len(chunk)
+                parser.feed(chunk)
+            self.root = parser.close()
+        except etree.XMLSyntaxError:
+            self.root = None
+        finally:
+            # Return the connection to the pool of the session
+            self.response.close()
+        self.zip_file = target.zip_file
+        if self.root is not None:
+            self.content = etree.tostring(self.root)
+        else:
+            self.content = b''.join(head)
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def findall(self, tag, parent=None):
+        """ Returns the elements named tag under parent or the root """
+        if parent is None:
+            parent = self.root
+        if parent is None:
+            return []
+        return list(parent.iter('{*}' + tag))
+
+    def find(self, tag, parent=None):
+        """ Returns the first element named tag or None """
+        if parent is None:
+            parent = self.root
+        if parent is None:
+            return None
+        return next(parent.iter('{*}' + tag), None)
+
+    def findtext(self, tag, parent=None):
+        """ Returns the text of the first element named tag or None """
+        element = self.find(tag, parent)
+        if element is not None:
+            return element.text
+
+
+class StreamedEnvelope(object):
+    """ A SOAP envelope with a zip file spliced in as base64 which is read
+    as a request body.
+
+    The zip file is encoded in chunks as the body is read so the encoded
+    zip is never held in memory.  The length is computed from the size of
+    the zip file.  Like a string envelope, replace() returns a new
+    envelope with the text replaced in the prefix and suffix so the body
+    can be sent again.
+    """
+
+    # A multiple of 3 so each chunk encodes without padding
+    chunk_size = 49152
+
+    def __init__(self, prefix, zip_file, suffix):
+        self.prefix = prefix
+        self.zip_file = zip_file
+        self.suffix = suffix
+        self._buffer = b''
+        self._chunks = None
+
+    def __len__(self):
+        self.zip_file.seek(0, 2)
+        zip_size = self.zip_file.tell()
+        encoded_size = (zip_size + 2) // 3 * 4
+        return len(self.prefix) + encoded_size + len(self.suffix)
+
+    def replace(self, old, new):
+        return StreamedEnvelope(
+            self.prefix.replace(old.encode('utf-8'), new.encode('utf-8')),
+            self.zip_file,
+            self.suffix.replace(old.encode('utf-8'), new.encode('utf-8')),
+        )
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = self._iter_chunks()
+        for chunk in self._chunks:
+            self._buffer += chunk
+            if size >= 0 and len(self._buffer) >= size:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def _iter_chunks(self):
+        yield self.prefix
+        self.zip_file.seek(0)
+        while True:
+            # Short reads would put padding in the middle of the encoding
+            data = b''
+            while len(data) < self.chunk_size:
+                block = self.zip_file.read(self.chunk_size - len(data))
+                if not block:
+                    break
+                data += block
+            if not data:
+                break
+            yield base64.b64encode(data)
+        yield self.suffix
+
+
+class MetadataApiClient(object):
+    """ Sends Metadata API calls to an org over one requests session so
+    the connection to the instance is kept alive between calls.  Use
+    get_metadata_client() to share the client of an org. """
+
+    def __init__(self, instance_url, org_id):
+        self.instance_url = instance_url
+        self.org_id = org_id
+        self.session = requests.Session()
+        self._endpoint_urls = {}
+
+    def endpoint_url(self, api_version):
+        endpoint = self._endpoint_urls.get(api_version)
+        if endpoint:
+            return endpoint
+        # If "My Domain" is configured in the org, the instance_url needs to be
+        # parsed differently
+        instance_url = self.instance_url
+        if instance_url.find('.my.salesforce.com') != -1:
+            # Parse instance_url with My Domain configured
+            # URL will be in the format
+            # https://name--name.na11.my.salesforce.com and should be
+            # https://na11.salesforce.com
+            instance_url = re.sub(
+                r'https://.*\.(\w+)\.my\.salesforce\.com', r'https://\1.salesforce.com', instance_url)
+        # Build the endpoint url from the instance_url
+        endpoint = '{}/services/Soap/m/{}/{}'.format(
+            instance_url,
+            api_version,
+            self.org_id,
+        )
+        self._endpoint_urls[api_version] = endpoint
+        return endpoint
+
+    def post(self, api_version, headers, data, stream=False):
+        return self.session.post(
+            self.endpoint_url(api_version),
+            headers=headers,
+            data=data,
+            stream=stream,
+        )
+
+
+_metadata_clients = {}
+_metadata_clients_lock = threading.Lock()
+
+
+def get_metadata_client(org_config):
+    """ Returns the MetadataApiClient of an org which is shared by all
+    Metadata API calls to the org in the process """
+    key = (org_config.instance_url, org_config.org_id)
+    with _metadata_clients_lock:
+        client = _metadata_clients.get(key)
+        if client is None:
+            client = MetadataApiClient(*key)
+            _metadata_clients[key] = client
+        return client
+
+
+class MetadataPoller(object):
+    """ Waits on many Metadata API operations at once.
+
+    Operations are started when they are added and are then polled from a
+    single loop.  Each operation is polled when its own check interval has
+    passed so a long deploy which has backed off does not delay a quick
+    retrieve.  as_completed() yields the operations as they complete and
+    their result() returns the processed response or raises the error
+    which stopped them.
+    """
+
+    def __init__(self):
+        # (time of the next poll, sequence, operation)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._completed = []
+
+    def add(self, api):
+        api.task.logger.info('Pending')
+        self._step(api, api._start)
+
+    def as_completed(self):
+        while self._completed or self._queue:
+            while self._completed:
+                yield self._completed.pop(0)
+            if not self._queue:
+                return
+            due, _, api = heapq.heappop(self._queue)
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._step(api, api._poll)
+
+    def wait(self):
+        """ Waits for all operations and returns them in the order they
+        completed """
+        return list(self.as_completed())
+
+    def _step(self, api, step):
+        try:
+            next_check = step()
+            if next_check is None:
+                api._finish()
+        except Exception as e:
+            api.exception = e
+            # Keep the traceback to raise the error from where it failed
+            api._exc_info = sys.exc_info()
+            next_check = None
+        if next_check is None:
+            self._completed.append(api)
+        else:
+            heapq.heappush(
+                self._queue,
+                (time.time() + next_check, next(self._sequence), api),
+            )
+
+
 class BaseMetadataApiCall(object):
     check_interval = 1
+    # Stream the response of the result call, see SoapResponse
+    stream_result = False
     soap_envelope_start = None
     soap_envelope_status = None
     soap_envelope_result = None
@@ -43,37 +355,34 @@ class BaseMetadataApiCall(object):
         self.task = task
         self.status = None
         self.check_num = 1
+        self.response = None
+        self.exception = None
+        self._exc_info = None
+        self._result = None
         self.api_version = (
             api_version if api_version else
             task.project_config.project__package__api_version
         )
 
     def __call__(self):
-        self.task.logger.info('Pending')
-        response = self._get_response()
-        if self.status != 'Failed':
-            return self._process_response(response)
+        poller = MetadataPoller()
+        poller.add(self)
+        poller.wait()
+        return self.result()
+
+    def result(self):
+        """ Returns the result of a complete operation or raises the error
+        which stopped it """
+        if self.exception:
+            raise_(*self._exc_info)
+        return self._result
+
+    @property
+    def client(self):
+        return get_metadata_client(self.task.org_config)
 
     def _build_endpoint_url(self):
-        # Parse org id from id which ends in /ORGID/USERID
-        org_id = self.task.org_config.org_id
-        # If "My Domain" is configured in the org, the instance_url needs to be
-        # parsed differently
-        instance_url = self.task.org_config.instance_url
-        if instance_url.find('.my.salesforce.com') != -1:
-            # Parse instance_url with My Domain configured
-            # URL will be in the format
-            # https://name--name.na11.my.salesforce.com and should be
-            # https://na11.salesforce.com
-            instance_url = re.sub(
-                r'https://.*\.(\w+)\.my\.salesforce\.com', r'https://\1.salesforce.com', instance_url)
-        # Build the endpoint url from the instance_url
-        endpoint = '{}/services/Soap/m/{}/{}'.format(
-            instance_url,
-            self.api_version,
-            org_id,
-        )
-        return endpoint
+        return self.client.endpoint_url(self.api_version)
 
     def _build_envelope_result(self):
         if self.soap_envelope_result:
@@ -96,30 +405,38 @@ class BaseMetadataApiCall(object):
             'SOAPAction': action,
         }
 
-    def _call_mdapi(self, headers, envelope, refresh=None):
+    def _call_mdapi(self, headers, envelope, refresh=None, stream=False):
         # Insert the session id
         session_id = self.task.org_config.access_token
         auth_envelope = envelope.replace('###SESSION_ID###', session_id)
-        response = requests.post(self._build_endpoint_url(
-        ), headers=headers, data=auth_envelope)
-        faultcode = parseString(
-            response.content).getElementsByTagName('faultcode')
+        response = SoapResponse(self.client.post(
+            self.api_version, headers, auth_envelope, stream), stream)
         # refresh = False can be passed to prevent a loop if refresh fails
         if refresh is None:
             refresh = True
-        if faultcode:
-            return self._handle_soap_error(headers, envelope, refresh, response)
+        if response.find('faultcode') is not None:
+            return self._handle_soap_error(
+                headers, envelope, refresh, response, stream)
         return response
 
-    def _get_element_value(self, dom, tag):
-        result = dom.getElementsByTagName(tag)
-        if result and result[0].firstChild:
-            return result[0].firstChild.nodeValue
+    def _get_element_value(self, element, tag):
+        result = next(element.iter('{*}' + tag), None)
+        if result is not None:
+            return result.text
 
     def _get_check_interval(self):
         return self.check_interval * ((self.check_num / 3) + 1)
 
-    def _get_response(self):
+    def _get_next_check(self):
+        # start increasing the check interval progressively to handle long pending jobs
+        check_interval = self._get_check_interval()
+        self.check_num += 1
+        return check_interval
+
+    def _start(self):
+        """ Sends the start call of the operation.  Returns the seconds to
+        wait before the first poll or None if the operation is complete """
+        self.response = None
         if not self.soap_envelope_start:
             # where is this from?
             raise NotImplemented('No soap_start template was provided')
@@ -127,78 +444,78 @@ class BaseMetadataApiCall(object):
         envelope = self._build_envelope_start()
         if not envelope:
             return
-        envelope = envelope.encode('utf-8')
+        if not isinstance(envelope, StreamedEnvelope):
+            envelope = envelope.encode('utf-8')
         headers = self._build_headers(self.soap_action_start, envelope)
-        response = self._call_mdapi(headers, envelope)
+        self.response = self._call_mdapi(headers, envelope)
         # If no status or result calls are configured, return the result
         if not self.soap_envelope_status and not self.soap_envelope_result:
-            return response
+            return
         # Process the response to set self.process_id with the process id
         # started
-        response = self._process_response_start(response)
-        # Check the status if configured
+        self.response = self._process_response_start(self.response)
         if self.soap_envelope_status:
-            while self.status not in ['Done', 'Failed']:
-                # Check status in a loop until done
-                envelope = self._build_envelope_status()
-                if not envelope:
-                    return
-                envelope = envelope.encode('utf-8')
-                headers = self._build_headers(
-                    self.soap_action_status, envelope)
-                response = self._call_mdapi(headers, envelope)
-                response = self._process_response_status(response)
-
-                # start increasing the check interval progressively to handle long pending jobs
-                check_interval = self._get_check_interval()
-                self.check_num += 1
-
-                time.sleep(check_interval)
-            # Fetch the final result and return
-            if self.soap_envelope_result:
-                envelope = self._build_envelope_result()
-                if not envelope:
-                    return
-                envelope = envelope.encode('utf-8')
-                headers = self._build_headers(
-                    self.soap_action_result, envelope)
-                response = self._call_mdapi(headers, envelope)
-            else:
-                return response
-        else:
-            # Check the result and return when done
-            while self.status not in ['Succeeded', 'Failed', 'Canceled']:
-                # start increasing the check interval progressively to handle long pending jobs
-                check_interval = self._get_check_interval()
-                self.check_num += 1
-                time.sleep(check_interval)
-
-                envelope = self._build_envelope_result()
-                envelope = envelope.encode('utf-8')
-                headers = self._build_headers(
-                    self.soap_action_result, envelope)
-                response = self._call_mdapi(headers, envelope)
-                response = _process_response_result(response)
-        return response
+            # Check the status right away
+            return 0
+        return self._get_next_check()
+
+    def _poll(self):
+        """ Checks the status or result of the operation once.  Returns the
+        seconds to wait before the next poll or None if the operation is
+        complete """
+        if not self.soap_envelope_status:
+            # Check the result until done
+            envelope = self._build_envelope_result()
+            envelope = envelope.encode('utf-8')
+            headers = self._build_headers(
+                self.soap_action_result, envelope)
+            response = self._call_mdapi(headers, envelope)
+            self.response = self._process_response_result(response)
+            if self.status not in ['Succeeded', 'Failed', 'Canceled']:
+                return self._get_next_check()
+            return
 
-    def _handle_soap_error(self, headers, envelope, refresh, response):
-        faultcode = parseString(
-            response.content).getElementsByTagName('faultcode')
-        if faultcode:
-            faultcode = faultcode[0].firstChild.nodeValue
-        else:
-            faultcode = ''
-        faultstring = parseString(
-            response.content).getElementsByTagName('faultstring')
-        if faultstring:
-            faultstring = faultstring[0].firstChild.nodeValue
-        else:
+        # Check the status until done
+        envelope = self._build_envelope_status()
+        if not envelope:
+            self.response = None
+            return
+        envelope = envelope.encode('utf-8')
+        headers = self._build_headers(
+            self.soap_action_status, envelope)
+        response = self._call_mdapi(headers, envelope)
+        self.response = self._process_response_status(response)
+        if self.status not in ['Done', 'Failed']:
+            return self._get_next_check()
+
+        # Fetch the final result
+        if self.soap_envelope_result and self.status != 'Failed':
+            envelope = self._build_envelope_result()
+            if not envelope:
+                self.response = None
+                return
+            envelope = envelope.encode('utf-8')
+            headers = self._build_headers(
+                self.soap_action_result, envelope)
+            self.response = self._call_mdapi(
+                headers, envelope, stream=self.stream_result)
+
+    def _finish(self):
+        """ Processes the final response of a complete operation """
+        if self.status != 'Failed':
+            self._result = self._process_response(self.response)
+
+    def _handle_soap_error(self, headers, envelope, refresh, response, stream=False):
+        faultcode = response.findtext('faultcode') or ''
+        faultstring = response.findtext('faultstring')
+        if faultstring is None:
             faultstring = response.content
         if faultcode == 'sf:INVALID_SESSION_ID' and self.task.org_config and self.task.org_config.refresh_token:
             # Attempt to refresh token and recall request
             if refresh:
                 self.org_config.refresh_oauth_token()
-                return self._call_mdapi(headers, envelope, refresh=False)
+                return self._call_mdapi(
+                    headers, envelope, refresh=False, stream=stream)
         # Log the error
         message = '{}: {}'.format(faultcode, faultstring)
         self._set_status('Failed', message)
@@ -214,21 +531,19 @@ class BaseMetadataApiCall(object):
     def _process_response_start(self, response):
         if response.status_code == httplib.INTERNAL_SERVER_ERROR:
             return response
-        ids = parseString(response.content).getElementsByTagName('id')
-        if ids:
-            self.process_id = ids[0].firstChild.nodeValue
+        process_id = response.findtext('id')
+        if process_id:
+            self.process_id = process_id
         return response
 
     def _process_response_status(self, response):
-        resp_xml = parseString(response.content)
-        done = resp_xml.getElementsByTagName('done')
-        if done:
-            if done[0].firstChild.nodeValue == 'true':
+        done = response.findtext('done')
+        if done is not None:
+            if done == 'true':
                 self._set_status('Done')
             else:
-                state_detail = resp_xml.getElementsByTagName('stateDetail')
-                if state_detail:
-                    log = state_detail[0].firstChild.nodeValue
+                log = response.findtext('stateDetail')
+                if log:
                     self._set_status('InProgress', log)
                     self.check_num = 1
                 elif self.status == 'InProgress':
@@ -263,6 +578,7 @@ class ApiRetrieveUnpackaged(BaseMetadataApiCall):
     soap_action_start = 'retrieve'
     soap_action_status = 'checkStatus'
     soap_action_result = 'checkRetrieveStatus'
+    stream_result = True
 
     def __init__(self, task, package_xml, api_version):
         super(ApiRetrieveUnpackaged, self).__init__(task, api_version)
@@ -284,13 +600,9 @@ class ApiRetrieveUnpackaged(BaseMetadataApiCall):
 
     def _process_response(self, response):
         # Parse the metadata zip file from the response
-        zipstr = parseString(response.content).getElementsByTagName('zipFile')
-        if zipstr:
-            zipstr = zipstr[0].firstChild.nodeValue
-        else:
+        if not response.zip_file:
             return self.packages
-        zipstringio = StringIO.StringIO(base64.b64decode(zipstr))
-        zipfile = ZipFile(zipstringio, 'r')
+        zipfile = ZipFile(response.zip_file, 'r')
         zipfile = zip_subfolder(zipfile, 'unpackaged')
         return zipfile
 
@@ -302,6 +614,7 @@ class ApiRetrieveInstalledPackages(BaseMetadataApiCall):
     soap_action_start = 'retrieve'
     soap_action_status = 'checkStatus'
     soap_action_result = 'checkRetrieveStatus'
+    stream_result = True
 
     def __init__(self, task):
         super(ApiRetrieveInstalledPackages, self).__init__(task)
@@ -309,13 +622,9 @@ class ApiRetrieveInstalledPackages(BaseMetadataApiCall):
 
     def _process_response(self, response):
         # Parse the metadata zip file from the response
-        zipstr = parseString(response.content).getElementsByTagName('zipFile')
-        if zipstr:
-            zipstr = zipstr[0].firstChild.nodeValue
-        else:
+        if not response.zip_file:
             return self.packages
-        zipstringio = StringIO.StringIO(base64.b64decode(zipstr))
-        zipfile = ZipFile(zipstringio, 'r')
+        zipfile = ZipFile(response.zip_file, 'r')
         packages = {}
         # Loop through all files in the zip skipping anything other than
         # InstalledPackages
@@ -323,10 +632,8 @@ class ApiRetrieveInstalledPackages(BaseMetadataApiCall):
             if not path.endswith('.installedPackage'):
                 continue
             namespace = path.split('/')[-1].split('.')[0]
-            version = parseString(zipfile.open(
-                path).read()).getElementsByTagName('versionNumber')
-            if version:
-                version = version[0].firstChild.nodeValue
+            version = self._get_element_value(
+                etree.fromstring(zipfile.open(path).read()), 'versionNumber')
             packages[namespace] = version
         self.packages = packages
         return self.packages
@@ -340,6 +647,7 @@ class ApiRetrievePackaged(BaseMetadataApiCall):
     soap_action_start = 'retrieve'
     soap_action_status = 'checkStatus'
     soap_action_result = 'checkRetrieveStatus'
+    stream_result = True
 
     def __init__(self, task, package_name, api_version):
         super(ApiRetrievePackaged, self).__init__(task, api_version)
@@ -353,13 +661,9 @@ class ApiRetrievePackaged(BaseMetadataApiCall):
 
     def _process_response(self, response):
         # Parse the metadata zip file from the response
-        zipstr = parseString(response.content).getElementsByTagName('zipFile')
-        if zipstr:
-            zipstr = zipstr[0].firstChild.nodeValue
-        else:
+        if not response.zip_file:
             return self.packages
-        zipstringio = StringIO.StringIO(base64.b64decode(zipstr))
-        zipfile = ZipFile(zipstringio, 'r')
+        zipfile = ZipFile(response.zip_file, 'r')
         return zipfile
 
 
@@ -370,6 +674,8 @@ class ApiDeploy(BaseMetadataApiCall):
     soap_action_status = 'checkDeployStatus'
 
     def __init__(self, task, package_zip, purge_on_delete=None):
+        """ package_zip is either the base64 encoded zip or a file with the
+        zip which is streamed into the request """
         super(ApiDeploy, self).__init__(task)
         if purge_on_delete is None:
             purge_on_delete = True
@@ -389,17 +695,23 @@ class ApiDeploy(BaseMetadataApiCall):
         #    self.purge_on_delete = 'false'
 
     def _build_envelope_start(self):
-        if self.package_zip:
+        if not self.package_zip:
+            return
+        if isinstance(self.package_zip, basestring):
             return self.soap_envelope_start % {
                 'package_zip': self.package_zip,
                 'purge_on_delete': self.purge_on_delete,
             }
+        envelope = self.soap_envelope_start % {
+            'package_zip': '###PACKAGE_ZIP###',
+            'purge_on_delete': self.purge_on_delete,
+        }
+        prefix, suffix = envelope.encode('utf-8').split(b'###PACKAGE_ZIP###')
+        return StreamedEnvelope(prefix, self.package_zip, suffix)
 
     def _process_response(self, response):
-        status = parseString(response.content).getElementsByTagName('status')
-        if status:
-            status = status[0].firstChild.nodeValue
-        else:
+        status = response.findtext('status')
+        if not status:
             # If no status element is in the result xml, return fail and log
             # the entire SOAP envelope in the log
             self._set_status('Failed', response.content)
@@ -411,39 +723,21 @@ class ApiDeploy(BaseMetadataApiCall):
         else:
             # If failed, parse out the problem text and raise appropriate exception
             messages = []
-            resp_xml = parseString(response.content)
 
-            component_failures = resp_xml.getElementsByTagName('componentFailures')
-            for component_failure in component_failures:
+            for component_failure in response.findall('componentFailures'):
                 failure_info = {
-                    'component_type': None,
-                    'file_name': None,
-                    'line_num': None,
-                    'column_num': None,
-                    'problem': component_failure.getElementsByTagName('problem')[0].firstChild.nodeValue,
-                    'problem_type': component_failure.getElementsByTagName('problemType')[0].firstChild.nodeValue,
+                    'component_type': response.findtext('componentType', component_failure),
+                    'file_name': response.findtext('fullName', component_failure),
+                    'line_num': response.findtext('lineNumber', component_failure),
+                    'column_num': response.findtext('columnNumber', component_failure),
+                    'problem': response.findtext('problem', component_failure),
+                    'problem_type': response.findtext('problemType', component_failure),
                 }
-                component_type = component_failure.getElementsByTagName('componentType')
-                if component_type and component_type[0].firstChild:
-                    failure_info['component_type'] = component_type[0].firstChild.nodeValue
-                file_name = component_failure.getElementsByTagName('fullName')
-                if file_name and file_name[0].firstChild:
-                    failure_info['file_name'] = file_name[0].firstChild.nodeValue
                 if not failure_info['file_name']:
-                    file_name = component_failure.getElementsByTagName('fileName')
-                    if file_name and file_name[0].firstChild:
-                        failure_info['file_name'] = file_name[0].firstChild.nodeValue
-        
-                line_num = component_failure.getElementsByTagName('lineNumber')
-                if line_num and line_num[0].firstChild:
-                    failure_info['line_num'] = line_num[0].firstChild.nodeValue
-                
-                column_num = component_failure.getElementsByTagName('columnNumber')
-                if column_num and column_num[0].firstChild:
-                    failure_info['column_num'] = column_num[0].firstChild.nodeValue
-                
-                created = component_failure.getElementsByTagName('created')[0].firstChild.nodeValue == 'true'
-                deleted = component_failure.getElementsByTagName('deleted')[0].firstChild.nodeValue == 'true'
+                    failure_info['file_name'] = response.findtext('fileName', component_failure)
+
+                created = response.findtext('created', component_failure) == 'true'
+                deleted = response.findtext('deleted', component_failure) == 'true'
                 if deleted: 
                     failure_info['action'] = 'Delete'
                 elif created:
@@ -465,27 +759,15 @@ class ApiDeploy(BaseMetadataApiCall):
                 raise MetadataComponentFailure(log, response)
                 
             else:
-                problems = parseString(
-                    response.content).getElementsByTagName('problem')
-                for problem in problems:
-                    messages.append(problem.firstChild.nodeValue)
+                for problem in response.findall('problem'):
+                    messages.append(problem.text)
 
             # Parse out any failure text (from test failures in production
             # deployments) and add to log
-            failures = parseString(
-                response.content).getElementsByTagName('failures')
-            for failure in failures:
+            for failure in response.findall('failures'):
                 # Get needed values from subelements
-                namespace = failure.getElementsByTagName('namespace')
-                if namespace and namespace[0].firstChild:
-                    namespace = namespace[0].firstChild.nodeValue
-                else:
-                    namespace = None
-                stacktrace = failure.getElementsByTagName('stackTrace')
-                if stacktrace and stacktrace[0].firstChild:
-                    stacktrace = stacktrace[0].firstChild.nodeValue
-                else:
-                    stacktrace = None
+                namespace = response.findtext('namespace', failure)
+                stacktrace = response.findtext('stackTrace', failure)
                 message = ['Apex Test Failure: ', ]
                 if namespace:
                     message.append('from namespace %s: ' % namespace)
@@ -628,7 +910,7 @@ class ApiListMetadata(BaseMetadataApiCall):
             'createdDate',
             'lastModifiedDate',
         ]
-        for result in parseString(response.content).getElementsByTagName('result'):
+        for result in response.findall('result'):
             result_data = {}
             # Parse fields
             for tag in tags:
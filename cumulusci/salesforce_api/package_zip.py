@@ -3,6 +3,8 @@ from zipfile import ZipFile
 from tempfile import TemporaryFile
 from xml.sax.saxutils import escape
 
+from cumulusci.utils import ZipSubfolder
+
 INSTALLED_PACKAGE_PACKAGE_XML = """<?xml version="1.0" encoding="utf-8"?>
 <Package xmlns="http://soap.sforce.com/2006/04/metadata">
   <types>
@@ -55,6 +57,8 @@ class BasePackageZipBuilder(object):
 
 class ZipfilePackageZipBuilder(BasePackageZipBuilder):
     def __init__(self, zipfile):
+        if isinstance(zipfile, ZipSubfolder):
+            zipfile = zipfile.as_zipfile()
         self.zip = zipfile
         self.zip_file = zipfile.fp
 
@@ -0,0 +1,100 @@
+""" Tests for the Bulk API 2.0 client """
+
+import csv
+import unittest
+
+from mock import MagicMock
+from mock import patch
+import responses
+
+from cumulusci.salesforce_api.bulk2 import Bulk2Api
+from cumulusci.salesforce_api.exceptions import Bulk2ApiError
+from cumulusci.salesforce_api.tests.utils import FakeBulk2Server
+
+
+@patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+class TestBulk2Api(unittest.TestCase):
+
+    def setUp(self):
+        self.api = Bulk2Api('https://example.com', 'abc123', 38.0)
+        self.server = FakeBulk2Server(self.api.endpoint)
+
+    def test_endpoint(self):
+        api = Bulk2Api('example.com', 'abc123', 48.0)
+        self.assertEqual(api.endpoint, 'https://example.com/services/data/v48.0/jobs')
+        self.assertEqual(
+            self.api.endpoint, 'https://example.com/services/data/v47.0/jobs')
+        self.assertEqual(api.session.headers['Authorization'], 'Bearer abc123')
+
+    def test_endpoint_raises_api_version(self):
+        logger = MagicMock()
+        api = Bulk2Api('https://example.com', 'abc123', 38.0, logger)
+        self.assertEqual(api.api_version, 47.0)
+        logger.warning.assert_called_once_with(
+            'Bulk API 2.0 requires API version 47.0 or later; using 47.0 instead of 38.0')
+
+        logger.reset_mock()
+        Bulk2Api('https://example.com', 'abc123', '48.0', logger)
+        logger.warning.assert_not_called()
+
+    @responses.activate
+    def test_ingest_job(self):
+        self.server.register()
+        self.server.failures['Bad'] = 'REQUIRED_FIELD_MISSING:Required fields are missing'
+
+        job = self.api.create_ingest_job('Account', 'insert')
+        self.assertEqual(job['state'], 'Open')
+        self.assertEqual(job['lineEnding'], 'CRLF')
+        self.api.upload_job_data(job['id'], 'Name\r\nGood 1\r\nBad\r\nGood 2\r\n')
+        self.api.close_job(job['id'])
+        info = self.api.wait_for_job(job['id'])
+
+        self.assertEqual(info['state'], 'JobComplete')
+        self.assertEqual(info['numberRecordsFailed'], 1)
+        successful = list(csv.DictReader(self.api.get_successful_results(job['id'])))
+        self.assertEqual(
+            sorted(row['Name'] for row in successful), ['Good 1', 'Good 2'])
+        failed = list(csv.DictReader(self.api.get_failed_results(job['id'])))
+        self.assertEqual(
+            [(row['Name'], row['sf__Error']) for row in failed],
+            [('Bad', 'REQUIRED_FIELD_MISSING:Required fields are missing')],
+        )
+
+    @responses.activate
+    def test_upload_closed_job(self):
+        self.server.register()
+        job = self.api.create_ingest_job('Account', 'insert')
+        self.api.close_job(job['id'])
+        with self.assertRaises(Bulk2ApiError) as cm:
+            self.api.upload_job_data(job['id'], 'Name\r\n')
+        self.assertEqual(str(cm.exception), 'INVALIDJOBSTATE: Job is not open')
+        self.assertEqual(cm.exception.response.status_code, 409)
+
+    @responses.activate
+    def test_wait_for_job_failed(self):
+        responses.add(
+            method=responses.GET,
+            url='{}/ingest/750000000000001'.format(self.api.endpoint),
+            body='{"id": "750000000000001", "state": "Failed", "errorMessage": "InvalidBatch"}',
+            status=200,
+            content_type='application/json',
+        )
+        with self.assertRaises(Bulk2ApiError):
+            self.api.wait_for_job('750000000000001')
+
+    @responses.activate
+    def test_query_results_pages(self):
+        self.server.register()
+        soql = 'SELECT Id, Name FROM Account'
+        rows = [{'Id': '001{:012d}'.format(i), 'Name': 'Account {}'.format(i)}
+            for i in range(5)]
+        self.server.query_results[soql] = (['Id', 'Name'], rows)
+
+        job = self.api.create_query_job(soql)
+        self.api.wait_for_job(job['id'], 'query')
+        pages = [list(csv.DictReader(page))
+            for page in self.api.get_query_results(job['id'])]
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), rows)
+        self.assertIn('locator=4', self.server.requests[-1][1])
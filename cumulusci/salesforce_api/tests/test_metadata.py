@@ -0,0 +1,326 @@
+""" Tests for the Metadata API client """
+
+import base64
+import io
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+import zipfile
+
+from mock import MagicMock
+from mock import patch
+import responses
+
+from cumulusci.salesforce_api.exceptions import MetadataApiError
+from cumulusci.salesforce_api.exceptions import MetadataComponentFailure
+from cumulusci.salesforce_api.metadata import ApiDeploy
+from cumulusci.salesforce_api.metadata import ApiListMetadata
+from cumulusci.salesforce_api.metadata import ApiRetrieveUnpackaged
+from cumulusci.salesforce_api.metadata import MetadataApiClient
+from cumulusci.salesforce_api.metadata import MetadataPoller
+from cumulusci.salesforce_api.metadata import SoapResponse
+from cumulusci.utils import zip_subfolder
+
+ENDPOINT = 'https://na1.salesforce.com/services/Soap/m/38.0/00D000000000001'
+
+ENVELOPE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns="http://soap.sforce.com/2006/04/metadata">
+  <soapenv:Body>{}</soapenv:Body>
+</soapenv:Envelope>'''
+
+FAULT = '''<soapenv:Fault>
+  <faultcode>sf:INVALID_CROSS_REFERENCE_KEY</faultcode>
+  <faultstring>No package named 'Test'</faultstring>
+</soapenv:Fault>'''
+
+DEPLOY_FAILED = '''<checkDeployStatusResponse><result>
+  <details>
+    <componentFailures>
+      <changed>false</changed>
+      <columnNumber>12</columnNumber>
+      <componentType>ApexClass</componentType>
+      <created>true</created>
+      <deleted>false</deleted>
+      <fileName>classes/Test.cls</fileName>
+      <fullName>Test</fullName>
+      <lineNumber>3</lineNumber>
+      <problem>Unexpected token</problem>
+      <problemType>Error</problemType>
+    </componentFailures>
+    <componentFailures>
+      <componentType />
+      <created>false</created>
+      <deleted>false</deleted>
+      <fileName>package.xml</fileName>
+      <fullName />
+      <problem>No package.xml found</problem>
+      <problemType>Error</problemType>
+    </componentFailures>
+  </details>
+  <done>true</done>
+  <id>0Af000000000001</id>
+  <status>Failed</status>
+</result></checkDeployStatusResponse>'''
+
+
+PACKAGE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<Package xmlns="http://soap.sforce.com/2006/04/metadata">
+    <types>
+        <members>*</members>
+        <name>ApexClass</name>
+    </types>
+    <version>38.0</version>
+</Package>'''
+
+
+def _zip_bytes(files):
+    zip_bytes = io.BytesIO()
+    zip_file = zipfile.ZipFile(zip_bytes, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in files:
+        zip_file.writestr(name, content)
+    zip_file.close()
+    return zip_bytes.getvalue()
+
+
+def _soap_response(body, status_code=200):
+    response = MagicMock()
+    response.content = ENVELOPE.format(body).encode('utf-8')
+    response.status_code = status_code
+    return SoapResponse(response)
+
+
+@patch('cumulusci.salesforce_api.metadata.time.sleep', MagicMock())
+class TestMetadataApi(unittest.TestCase):
+
+    def setUp(self):
+        self.task = MagicMock()
+        self.task.org_config.instance_url = 'https://na1.salesforce.com'
+        self.task.org_config.org_id = '00D000000000001'
+        self.task.org_config.access_token = 'abc123'
+        self.task.org_config.refresh_token = None
+        self.task.project_config.project__package__api_version = '38.0'
+
+    def test_soap_response_find(self):
+        response = _soap_response(DEPLOY_FAILED)
+        self.assertEqual(response.findtext('status'), 'Failed')
+        self.assertEqual(len(response.findall('componentFailures')), 2)
+        failure = response.findall('componentFailures')[1]
+        self.assertIsNone(response.findtext('fullName', failure))
+        self.assertIsNone(response.find('faultcode'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_soap_response_not_xml(self):
+        response = SoapResponse(MagicMock(content='<html>Service Unavailable'))
+        self.assertIsNone(response.find('faultcode'))
+        self.assertEqual(response.findall('result'), [])
+
+    def test_client_shared(self):
+        deploy = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        list_metadata = ApiListMetadata(self.task, 'CustomObject')
+        self.assertIs(deploy.client, list_metadata.client)
+        self.assertEqual(deploy._build_endpoint_url(), ENDPOINT)
+
+    def test_client_my_domain(self):
+        client = MetadataApiClient(
+            'https://test--dev.na1.my.salesforce.com', '00D000000000001')
+        self.assertEqual(client.endpoint_url('38.0'), ENDPOINT)
+
+    @responses.activate
+    def test_fault(self):
+        responses.add(responses.POST, ENDPOINT, body=ENVELOPE.format(FAULT), status=500)
+        api = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        with self.assertRaises(MetadataApiError) as cm:
+            api()
+        self.assertEqual(
+            str(cm.exception),
+            "sf:INVALID_CROSS_REFERENCE_KEY: No package named 'Test'",
+        )
+        self.assertEqual(api.status, 'Failed')
+
+    @responses.activate
+    def test_deploy_polls_status(self):
+        bodies = {
+            'deploy': ['<deployResponse><result><done>false</done>'
+                '<id>0Af000000000001</id><state>Queued</state></result></deployResponse>'],
+            'checkDeployStatus': [
+                '<checkDeployStatusResponse><result><done>false</done>'
+                '<stateDetail>Processing Type: ApexClass</stateDetail></result>'
+                '</checkDeployStatusResponse>',
+                '<checkDeployStatusResponse><result><done>true</done>'
+                '<status>Succeeded</status></result></checkDeployStatusResponse>',
+            ],
+        }
+        requests = []
+
+        def soap_call(request):
+            requests.append(request.body)
+            body = bodies[request.headers['SOAPAction']].pop(0)
+            return (200, {}, ENVELOPE.format(body))
+
+        responses.add_callback(responses.POST, ENDPOINT, callback=soap_call)
+        api = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        self.assertEqual(api(), 'Success')
+        self.assertEqual(api.process_id, '0Af000000000001')
+        self.assertIn('<sessionId>abc123</sessionId>', requests[0])
+        self.assertIn('<asyncProcessId>0Af000000000001</asyncProcessId>', requests[1])
+
+    @responses.activate
+    def test_deploy_streams_zip(self):
+        zip_bytes = _zip_bytes([
+            ('package.xml', PACKAGE_XML),
+            ('classes/Test.cls', os.urandom(200000)),
+        ])
+        zip_file = tempfile.TemporaryFile()
+        zip_file.write(zip_bytes)
+        requests = []
+
+        def soap_call(request):
+            body = request.body
+            if hasattr(body, 'read'):
+                body = body.read()
+            requests.append((request.headers, body))
+            return (200, {}, ENVELOPE.format(
+                '<deployResponse><result><done>true</done><status>Succeeded</status>'
+                '<id>0Af000000000001</id></result></deployResponse>'))
+
+        responses.add_callback(responses.POST, ENDPOINT, callback=soap_call)
+        api = ApiDeploy(self.task, zip_file)
+        self.assertEqual(api(), 'Success')
+
+        headers, body = requests[0]
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        self.assertIn(b'<sessionId>abc123</sessionId>', body)
+        self.assertIn(b'<purgeOnDelete>true</purgeOnDelete>', body)
+        zipstr = body.split(b'<ZipFile>')[1].split(b'</ZipFile>')[0]
+        self.assertEqual(base64.b64decode(zipstr), zip_bytes)
+
+    @responses.activate
+    def test_poller(self):
+        in_progress = ('<checkDeployStatusResponse><result><done>false</done>'
+            '</result></checkDeployStatusResponse>')
+        succeeded = ('<checkDeployStatusResponse><result><done>true</done>'
+            '<status>Succeeded</status></result></checkDeployStatusResponse>')
+        statuses = {
+            '0Af000000000001': [in_progress, in_progress, DEPLOY_FAILED],
+            '0Af000000000002': [succeeded],
+        }
+        process_ids = ['0Af000000000001', '0Af000000000002']
+        polled = []
+
+        def soap_call(request):
+            if request.headers['SOAPAction'] == 'deploy':
+                body = ('<deployResponse><result><done>false</done><id>{}</id>'
+                    '</result></deployResponse>'.format(process_ids.pop(0)))
+            else:
+                process_id = request.body.split('<asyncProcessId>')[1][:15]
+                polled.append(process_id)
+                body = statuses[process_id].pop(0)
+            return (200, {}, ENVELOPE.format(body))
+
+        responses.add_callback(responses.POST, ENDPOINT, callback=soap_call)
+        failing = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        succeeding = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        poller = MetadataPoller()
+        poller.add(failing)
+        poller.add(succeeding)
+
+        self.assertEqual(poller.wait(), [succeeding, failing])
+        self.assertEqual(succeeding.result(), 'Success')
+        with self.assertRaises(MetadataComponentFailure):
+            try:
+                failing.result()
+            except MetadataComponentFailure:
+                # The error is raised with the traceback of the failure
+                frames = traceback.extract_tb(sys.exc_info()[2])
+                self.assertEqual(frames[-1][2], '_process_response')
+                raise
+        self.assertEqual(polled, [
+            '0Af000000000001',
+            '0Af000000000002',
+            '0Af000000000001',
+            '0Af000000000001',
+        ])
+
+    def test_deploy_component_failures(self):
+        api = ApiDeploy(self.task, 'UEsFBgAAAAAAAAAAAAAAAAAAAAAAAA==')
+        with self.assertRaises(MetadataComponentFailure) as cm:
+            api._process_response(_soap_response(DEPLOY_FAILED))
+        self.assertEqual(str(cm.exception), '\n\n'.join([
+            'Create of ApexClass Test: Error on line 3, col 12: Unexpected token',
+            'Update of None package.xml: Error: No package.xml found',
+        ]))
+
+    def test_list_metadata(self):
+        api = ApiListMetadata(self.task, 'CustomObject')
+        metadata = api._process_response(_soap_response(
+            '<listMetadataResponse>'
+            '<result><fullName>Account</fullName><type>CustomObject</type></result>'
+            '<result><fullName>Test__c</fullName><namespacePrefix /><type>CustomObject</type></result>'
+            '</listMetadataResponse>'
+        ))
+        self.assertEqual(
+            [(item['fullName'], item['namespacePrefix']) for item in metadata['CustomObject']],
+            [('Account', None), ('Test__c', None)],
+        )
+
+    @responses.activate
+    def test_retrieve_streams_zip(self):
+        # Random content does not compress so the zip spans many chunks
+        content = os.urandom(200000)
+        zip_bytes = _zip_bytes([
+            ('unpackaged/package.xml', PACKAGE_XML),
+            ('unpackaged/classes/Test.cls', content),
+        ])
+        # Base64 text is split across lines in the envelope
+        zipstr = base64.encodestring(zip_bytes)
+        bodies = {
+            'retrieve': ['<retrieveResponse><result><done>false</done>'
+                '<id>09S000000000001</id></result></retrieveResponse>'],
+            'checkStatus': ['<checkStatusResponse><result><done>true</done>'
+                '<id>09S000000000001</id></result></checkStatusResponse>'],
+            'checkRetrieveStatus': ['<checkRetrieveStatusResponse><result>'
+                '<id>09S000000000001</id><status>Succeeded</status>'
+                '<zipFile>{}</zipFile></result>'
+                '</checkRetrieveStatusResponse>'.format(zipstr)],
+        }
+
+        def soap_call(request):
+            body = bodies[request.headers['SOAPAction']].pop(0)
+            return (200, {}, ENVELOPE.format(body))
+
+        responses.add_callback(responses.POST, ENDPOINT, callback=soap_call)
+        api = ApiRetrieveUnpackaged(self.task, PACKAGE_XML, '38.0')
+        result = api()
+
+        self.assertEqual(sorted(result.namelist()), ['classes/Test.cls', 'package.xml'])
+        self.assertEqual(result.read('classes/Test.cls'), content)
+
+    def test_soap_response_stream_fault(self):
+        response = MagicMock()
+        response.iter_content.return_value = [ENVELOPE.format(FAULT).encode('utf-8')]
+        response = SoapResponse(response, stream=True)
+        self.assertEqual(response.findtext('faultcode'), 'sf:INVALID_CROSS_REFERENCE_KEY')
+        self.assertIn(b'No package named', response.content)
+        self.assertIsNone(response.zip_file)
+
+    def test_zip_subfolder(self):
+        src = zipfile.ZipFile(io.BytesIO(_zip_bytes([
+            ('unpackaged/package.xml', PACKAGE_XML),
+            ('unpackaged/classes/Test.cls', 'public class Test {}'),
+            ('other/Other.cls', 'public class Other {}'),
+        ])))
+        subfolder = zip_subfolder(src, 'unpackaged')
+        self.assertEqual(subfolder.namelist(), ['package.xml', 'classes/Test.cls'])
+        self.assertEqual(subfolder.read('classes/Test.cls'), 'public class Test {}')
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            subfolder.extractall(tempdir)
+            with open(os.path.join(tempdir, 'classes', 'Test.cls')) as f:
+                self.assertEqual(f.read(), 'public class Test {}')
+            self.assertEqual(sorted(os.listdir(tempdir)), ['classes', 'package.xml'])
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,141 @@
+""" Utilities for testing the Salesforce APIs
+
+FakeBulk2Server: a fake Bulk API 2.0 server for the responses library"""
+
+import csv
+import json
+import re
+from StringIO import StringIO
+
+import responses
+
+
+class FakeBulk2Server(object):
+    """ Serves Bulk API 2.0 ingest and query jobs from memory.
+
+    Call register() inside a test decorated with responses.activate.
+    Ingest jobs give each successful row a new Id and fail the rows with a
+    value listed in failures.  Their results are returned in reverse order
+    like the real API which does not keep the order of the upload.  Query
+    jobs return the rows set in query_results for their SOQL in pages of
+    page_size rows.
+    """
+
+    def __init__(self, endpoint, page_size=2):
+        self.endpoint = endpoint
+        self.page_size = page_size
+        self.jobs = {}
+        # value: error of the rows that fail to load
+        self.failures = {}
+        # soql: (fields, rows) returned by query jobs
+        self.query_results = {}
+        self.requests = []
+
+    def register(self):
+        job_url = re.escape(self.endpoint) + r'/(ingest|query)'
+        routes = [
+            (responses.POST, job_url + '$', self._create_job),
+            (responses.PUT, job_url + r'/(\w+)/batches$', self._upload),
+            (responses.PATCH, job_url + r'/(\w+)$', self._set_state),
+            (responses.GET, job_url + r'/(\w+)$', self._get_job),
+            (responses.GET, job_url + r'/(\w+)/(successfulResults|failedResults)$', self._get_results),
+            (responses.GET, job_url + r'/(\w+)/results(\?.*)?$', self._get_query_results),
+        ]
+        for method, url, callback in routes:
+            responses.add_callback(method, re.compile(url), self._route(url, callback))
+
+    def _route(self, url, callback):
+        def handle(request):
+            self.requests.append((request.method, request.url))
+            return callback(request, *re.match(url, request.url).groups())
+        return handle
+
+    def _json(self, data, status=200):
+        return (status, {'Content-Type': 'application/json'}, json.dumps(data))
+
+    def _csv(self, fields, rows, headers=None):
+        body = StringIO()
+        writer = csv.DictWriter(body, fields, lineterminator='\n')
+        writer.writerow(dict(zip(fields, fields)))
+        writer.writerows(rows)
+        headers = dict(headers or {})
+        headers['Content-Type'] = 'text/csv'
+        return (200, headers, body.getvalue())
+
+    def _create_job(self, request, job_type):
+        job = json.loads(request.body)
+        job['id'] = '750{:012d}'.format(len(self.jobs) + 1)
+        job['state'] = 'Open' if job_type == 'ingest' else 'UploadComplete'
+        job['data'] = ''
+        self.jobs[job['id']] = job
+        return self._json(job)
+
+    def _upload(self, request, job_type, job_id):
+        job = self.jobs[job_id]
+        if job['state'] != 'Open':
+            return self._json([{
+                'errorCode': 'INVALIDJOBSTATE',
+                'message': 'Job is not open',
+            }], 409)
+        body = request.body
+        if hasattr(body, 'read'):
+            body = body.read()
+        job['data'] += body
+        return (201, {}, '')
+
+    def _set_state(self, request, job_type, job_id):
+        job = self.jobs[job_id]
+        job['state'] = json.loads(request.body)['state']
+        return self._json(job)
+
+    def _get_job(self, request, job_type, job_id):
+        job = self.jobs[job_id]
+        # Jobs report being in progress once before they complete
+        if job['state'] == 'UploadComplete':
+            job['state'] = 'InProgress'
+        elif job['state'] == 'InProgress':
+            self._process(job)
+            job['state'] = 'JobComplete'
+        info = dict((key, value) for key, value in job.items()
+            if not key.startswith('_') and key != 'data')
+        return self._json(info)
+
+    def _process(self, job):
+        job['_successful'] = []
+        job['_failed'] = []
+        if 'query' in job:
+            return
+        reader = csv.DictReader(StringIO(job['data']))
+        job['_fields'] = reader.fieldnames
+        for row in reader:
+            errors = [self.failures[value] for value in row.values()
+                if value in self.failures]
+            if errors:
+                row['sf__Error'] = errors[0]
+                row['sf__Id'] = ''
+                job['_failed'].append(row)
+            else:
+                row['sf__Id'] = '001{:012d}'.format(len(job['_successful']) + 1)
+                row['sf__Created'] = 'true'
+                job['_successful'].append(row)
+        job['numberRecordsProcessed'] = len(job['_successful']) + len(job['_failed'])
+        job['numberRecordsFailed'] = len(job['_failed'])
+
+    def _get_results(self, request, job_type, job_id, result_type):
+        job = self.jobs[job_id]
+        if result_type == 'successfulResults':
+            fields = ['sf__Id', 'sf__Created'] + job['_fields']
+            rows = job['_successful']
+        else:
+            fields = ['sf__Id', 'sf__Error'] + job['_fields']
+            rows = job['_failed']
+        return self._csv(fields, list(reversed(rows)))
+
+    def _get_query_results(self, request, job_type, job_id, query_string):
+        job = self.jobs[job_id]
+        fields, rows = self.query_results[job['query']]
+        match = re.search(r'locator=(\d+)', query_string or '')
+        start = int(match.group(1)) if match else 0
+        end = start + self.page_size
+        locator = str(end) if end < len(rows) else 'null'
+        return self._csv(fields, rows[start:end], {'Sforce-Locator': locator})
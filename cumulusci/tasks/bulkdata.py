@@ -1,32 +1,59 @@
+from cumulusci.core.config import YamlGlobalConfig
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.core.tasks import BaseTask
+from cumulusci.core.utils import process_bool_arg
+from cumulusci.salesforce_api.bulk2 import Bulk2Api
+from cumulusci.salesforce_api.exceptions import Bulk2ApiError
 from cumulusci.tasks.salesforce import BaseSalesforceApiTask
+from cumulusci.tasks.salesforce import BulkJobTaskMixin
 
 import csv
-import time
 import hiyapyco
-import xml.etree.ElementTree as ET
 
 import datetime
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import pickle
+import Queue
+import random
 import requests
+import sys
 import tempfile
+import threading
+import time
+import yaml
 
 from collections import OrderedDict
+from future.utils import raise_
+from multiprocessing.pool import ThreadPool
+from salesforce_bulk.salesforce_bulk import BulkBatchFailed
 
-from salesforce_bulk import CsvDictsAdapter
-
+import sqlite3
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import create_session
-from sqlalchemy.orm import mapper
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import and_
+from sqlalchemy import bindparam
 from sqlalchemy import create_engine
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import String
 from sqlalchemy import Table
 from sqlalchemy import Unicode
 from sqlalchemy import text
 from sqlalchemy import types
 from sqlalchemy import event
-from StringIO import StringIO
+from sqlalchemy import func
+from sqlalchemy import Index
+from sqlalchemy import inspect
+from cStringIO import StringIO
 
 # Create a custom sqlalchemy field type for sqlite datetime fields which are stored as integer of epoch time
 class EpochType(types.TypeDecorator):
@@ -35,9 +62,13 @@ class EpochType(types.TypeDecorator):
     epoch = datetime.datetime(1970, 1, 1, 0, 0, 0)
 
     def process_bind_param(self, value, dialect):
-        return (value / 1000 - self.epoch).total_seconds()
+        if value is None:
+            return None
+        return int((value - self.epoch).total_seconds() * 1000)
 
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return self.epoch + datetime.timedelta(seconds=value / 1000)
 
 # Listen for sqlalchemy column_reflect event and map datetime fields to EpochType
@@ -46,108 +77,998 @@ def setup_epoch(inspector, table, column_info):
     if isinstance(column_info['type'], types.DateTime):
         column_info['type'] = EpochType()
 
-class DeleteData(BaseSalesforceApiTask):
+def _set_sqlite_bulk_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA synchronous = OFF')
+    cursor.execute('PRAGMA journal_mode = MEMORY')
+    cursor.close()
+
+def _use_sqlite_bulk_pragmas(engine, staging_path=None):
+    """ Trades durability for speed on SQLite databases that are temporary
+    or created by the task, which a failed run can simply write again.
+    Existing databases may hold data that can not be recreated from the
+    org, like the watermarks of incremental queries, so they keep their
+    settings. """
+    if engine.dialect.name != 'sqlite':
+        return
+    database = engine.url.database
+    if (
+        staging_path or
+        not database or
+        database == ':memory:' or
+        not os.path.exists(database)
+    ):
+        event.listen(engine, 'connect', _set_sqlite_bulk_pragmas)
+
+def _convert(value):
+    """ Converts a database value to a csv value for the Bulk API """
+    if value:
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        try:
+            return value.encode('utf8')
+        except AttributeError:
+            pass
+    return value
+
+def _encode(value):
+    return value.encode('utf8') if isinstance(value, unicode) else value
+
+def _isoformat(value):
+    return value.isoformat() if value else value
+
+def _get_converters(columns):
+    """ Returns a list of (index, function) pairs that convert the values
+    of the columns which need it to csv values for the Bulk API.
+
+    The conversion of each column is picked once from its type.  Numbers
+    are written as is by the csv module, and columns of unknown types fall
+    back to _convert.
+    """
+    converters = []
+    for index, column in enumerate(columns):
+        if isinstance(column.type, (types.DateTime, types.Date, EpochType)):
+            converters.append((index, _isoformat))
+        elif isinstance(column.type, types.String):
+            converters.append((index, _encode))
+        elif not isinstance(column.type, (types.Integer, types.Numeric, types.Boolean)):
+            converters.append((index, _convert))
+    return converters
+
+def _row_digest(values):
+    """ Returns a digest of the values of a csv row used to match rows of
+    Bulk API 2.0 results to the uploaded rows """
+    return hashlib.md5('\x00'.join(values)).digest()
+
+def _create_engine(options):
+    """ Returns an engine for the database_url option and the path of the
+    temporary SQLite database used to stage a dataset, if any """
+    if not options.get('dataset_path'):
+        return create_engine(options['database_url']), None
+    handle, staging_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    return create_engine('sqlite:///{}'.format(staging_path)), staging_path
+
+def _get_schema_fingerprint(engine, names):
+    """ Returns a digest of the definitions of the named tables, read with
+    a single query of the database catalog, or None if the dialect is not
+    supported """
+    names = sorted(names)
+    # Catalog tables are declared on a throwaway MetaData to query them
+    # without reflection
+    catalog = MetaData()
+    if engine.dialect.name == 'sqlite':
+        master = Table(
+            'sqlite_master',
+            catalog,
+            *[Column(name) for name in ('type', 'name', 'tbl_name', 'sql')]
+        )
+        query = select([master.c.type, master.c.name, master.c.sql]).where(
+            master.c.tbl_name.in_(names)
+        ).order_by(master.c.type, master.c.name)
+    elif engine.dialect.name in ('postgresql', 'mysql', 'mssql'):
+        # Connect first so the dialect knows the default schema
+        engine.connect().close()
+        columns = Table(
+            'columns',
+            catalog,
+            *[Column(name) for name in (
+                'table_schema', 'table_name', 'column_name', 'ordinal_position',
+                'data_type', 'is_nullable', 'character_maximum_length',
+                'column_default',
+            )],
+            schema='information_schema'
+        )
+        keys = Table(
+            'key_column_usage',
+            catalog,
+            *[Column(name) for name in (
+                'table_schema', 'table_name', 'column_name', 'constraint_name',
+            )],
+            schema='information_schema'
+        )
+        query = select([
+            columns.c.table_name,
+            columns.c.column_name,
+            columns.c.data_type,
+            columns.c.is_nullable,
+            columns.c.character_maximum_length,
+            columns.c.column_default,
+            keys.c.constraint_name,
+        ]).select_from(columns.outerjoin(keys, and_(
+            keys.c.table_schema == columns.c.table_schema,
+            keys.c.table_name == columns.c.table_name,
+            keys.c.column_name == columns.c.column_name,
+        ))).where(and_(
+            columns.c.table_schema == engine.dialect.default_schema_name,
+            columns.c.table_name.in_(names),
+        )).order_by(
+            columns.c.table_name,
+            columns.c.ordinal_position,
+            keys.c.constraint_name,
+        )
+    else:
+        return None
+    rows = engine.execute(query).fetchall()
+    return hashlib.sha1(repr([tuple(row) for row in rows])).hexdigest()
+
+def _reflect_tables(engine, names, cache_dir=None):
+    """ Returns a MetaData with only the named tables reflected.
+
+    With a cache_dir, the reflected MetaData is pickled to a file for the
+    database and tables along with a fingerprint of their schema and
+    loaded from there while the fingerprint matches.
+    """
+    fingerprint = None
+    if cache_dir:
+        fingerprint = _get_schema_fingerprint(engine, names)
+    if fingerprint:
+        key = hashlib.sha1(repr((str(engine.url), sorted(names)))).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.pickle')
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_fingerprint, metadata = pickle.load(f)
+            if cached_fingerprint == fingerprint:
+                metadata.bind = engine
+                return metadata
+        except (IOError, EOFError, pickle.PickleError, ValueError):
+            pass
+
+    metadata = MetaData()
+    metadata.bind = engine
+    metadata.reflect(only=sorted(names))
+
+    if fingerprint:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path, 'wb') as f:
+            pickle.dump((fingerprint, metadata), f, pickle.HIGHEST_PROTOCOL)
+    return metadata
+
+def _get_cache_dir():
+    """ Returns the directory the bulk data tasks cache the metadata of
+    orgs and databases in """
+    return os.path.join(
+        os.path.expanduser('~'),
+        YamlGlobalConfig.config_local_dir,
+        'bulkdata_cache',
+    )
+
+def _get_mapping_dependencies(mappings):
+    """ Returns an OrderedDict of each mapping step name to the set of
+    earlier steps it must wait for.  A step waits for the earlier steps
+    that load its own table or a table it looks up.  Only earlier steps are
+    considered so the order of the mapping file is preserved. """
+    dependencies = OrderedDict()
+    loaded = []
+    for name, mapping in mappings.items():
+        tables = set([mapping.get('table')])
+        for lookup in mapping.get('lookups', {}).values():
+            tables.add(lookup['table'])
+        dependencies[name] = set(
+            step for step, table in loaded if table in tables
+        )
+        loaded.append((name, mapping.get('table')))
+    return dependencies
+
+def _ddl_type(column):
+    """ Returns the type to create a copy of a column with.  Columns
+    reflected from SQLite without a declared type are copied as text. """
+    if isinstance(column.type, types.NullType):
+        return Unicode(255)
+    return column.type
+
+def _run_steps(steps, dependencies, run_step, parallel_steps):
+    """ Calls run_step for each step once all of its dependencies have
+    finished, running up to parallel_steps steps at a time.  The first
+    exception raised by a step is reraised once the running steps finish.
+    """
+    pending = list(steps)
+    finished = set()
+    running = 0
+    error = None
+    completed = Queue.Queue()
+
+    def run(step):
+        try:
+            run_step(step)
+            completed.put((step, None))
+        except Exception:
+            completed.put((step, sys.exc_info()))
+
+    pool = ThreadPool(parallel_steps)
+    try:
+        while pending or running:
+            if not error:
+                for step in list(pending):
+                    if running >= parallel_steps:
+                        break
+                    if dependencies[step] <= finished:
+                        pending.remove(step)
+                        running += 1
+                        pool.apply_async(run, (step,))
+            if not running:
+                if error:
+                    break
+                raise TaskOptionsError(
+                    'Circular dependency between steps: {}'.format(
+                        ', '.join(pending)))
+            step, exc_info = completed.get()
+            running -= 1
+            if exc_info:
+                error = error or exc_info
+            else:
+                finished.add(step)
+    finally:
+        pool.close()
+        pool.join()
+
+    if error:
+        raise_(*error)
+
+class BatchSizer(object):
+    """ Chooses the number of rows in the Bulk API batches of a step.
+
+    Batches are limited both by row count and by encoded size.  The row
+    count starts at the Bulk API maximum and is tuned as batches complete:
+    it is halved when rows fail to lock, reduced when a batch takes longer
+    than twice target_seconds to process and doubled again when batches
+    take less than half of it.
+    """
+    max_rows = 10000
+    min_rows = 200
+    # The Bulk API limits batches to 10MB and 10M characters
+    max_bytes = 10000000
+    target_seconds = 60
+
+    def __init__(self, name, logger):
+        self.name = name
+        self.logger = logger
+        self.rows = self.max_rows
+
+    def record(self, batch_info, lock_errors=0):
+        """ Adjusts the row count from the info of a completed batch """
+        processed = int(batch_info.get('numberRecordsProcessed') or 0)
+        seconds = int(batch_info.get('totalProcessingTime') or 0) / 1000.0
+        rows = self.rows
+        if lock_errors:
+            rows = self.rows // 2
+        elif processed and seconds > self.target_seconds * 2:
+            rows = int(processed * self.target_seconds / seconds)
+        elif seconds < self.target_seconds / 2.0:
+            rows = self.rows * 2
+        rows = max(self.min_rows, min(self.max_rows, rows))
+        if rows != self.rows:
+            self.logger.info('    Changed batch size for {} from {} to {} rows'.format(
+                self.name, self.rows, rows))
+            self.rows = rows
+
+class RecordTypeCache(object):
+    """ The Ids of the record types of an org by object and developer name.
+
+    All record types are loaded with a single query the first time one is
+    needed.  With a cache_dir, they are saved to a file for the org which
+    later runs use instead of querying until it is older than ttl seconds.
+    Record types missing from the file may have been deployed since it was
+    written, so the first miss of an object queries its record types again.
+    """
+    ttl = 86400
+
+    def __init__(self, sf, org_config, cache_dir=None):
+        self.sf = sf
+        self.org_config = org_config
+        self.cache_dir = cache_dir
+        self.record_types = None
+        # Objects to query again on a miss as they were read from the file
+        self.stale_objects = None
+        # Steps may look up record types from several threads
+        self.lock = threading.Lock()
+
+    @property
+    def cache_path(self):
+        if not self.cache_dir:
+            return None
+        # Keyed on the org id as scratch orgs may share an instance url
+        return os.path.join(self.cache_dir, 'record_types_{}.json'.format(
+            hashlib.sha1(self.org_config.org_id).hexdigest()))
+
+    def get(self, sf_object, developer_name):
+        """ Returns the Id of a record type or None to default to the
+        record type assigned by the profile """
+        with self.lock:
+            if self.record_types is None:
+                self.record_types = self._read_cache()
+                self.stale_objects = None if self.record_types is None else set()
+            if self.record_types is None:
+                self.record_types = self._query()
+                self._write_cache()
+            record_type_id = self.record_types.get(sf_object, {}).get(developer_name)
+            if (
+                record_type_id is None and
+                self.stale_objects is not None and
+                sf_object not in self.stale_objects
+            ):
+                self.stale_objects.add(sf_object)
+                self.record_types[sf_object] = self._query(sf_object).get(sf_object, {})
+                self._write_cache()
+                record_type_id = self.record_types[sf_object].get(developer_name)
+        return record_type_id
+
+    def _read_cache(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - cache['timestamp'] > self.ttl:
+            return None
+        return cache['record_types']
+
+    def _query(self, sf_object=None):
+        soql = 'SELECT Id, SobjectType, DeveloperName FROM RecordType'
+        if sf_object:
+            soql += " WHERE SobjectType = '{}'".format(sf_object)
+        record_types = {}
+        for record in self.sf.query_all(soql)['records']:
+            record_types.setdefault(record['SobjectType'], {})[
+                record['DeveloperName']] = record['Id']
+        return record_types
+
+    def _write_cache(self):
+        if not self.cache_path:
+            return
+        cache_dir = os.path.dirname(self.cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.cache_path, 'w') as f:
+            json.dump({
+                'timestamp': time.time(),
+                'record_types': self.record_types,
+            }, f)
+
+class Dataset(object):
+    """ A directory of gzipped csv files, one per table, with a dataset.yml
+    manifest listing the file, columns and row count of each table.
+
+    The first column of a table is its primary key.  None is written as an
+    empty value and empty values are read back as None.
+    """
+    manifest_name = 'dataset.yml'
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = OrderedDict()
+        manifest_path = os.path.join(path, self.manifest_name)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = yaml.safe_load(f) or {}
+            for table in manifest.get('tables', []):
+                self.tables[table['name']] = table
+
+    def _save_manifest(self):
+        with open(os.path.join(self.path, self.manifest_name), 'w') as f:
+            yaml.safe_dump(
+                {'tables': self.tables.values()},
+                f,
+                default_flow_style=False,
+            )
+
+    def write_table(self, name, columns, rows):
+        """ Streams rows of values in the order of columns to the file of a
+        table and returns the number of rows written """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        file_name = '{}.csv.gz'.format(name)
+        count = 0
+        with gzip.open(os.path.join(self.path, file_name), 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([_convert(value) for value in row])
+                count += 1
+        # Column names may be str subclasses which yaml can't represent
+        self.tables[name] = {
+            'name': str(name),
+            'file': file_name,
+            'columns': [str(column) for column in columns],
+            'rows': count,
+        }
+        self._save_manifest()
+        return count
+
+    def read_table(self, name, chunk_size=10000):
+        """ Yields the rows of a table as lists of up to chunk_size dicts
+        keyed by column name """
+        path = os.path.join(self.path, self.tables[name]['file'])
+        # Buffer the reads as GzipFile is slow at reading lines by itself
+        with io.BufferedReader(gzip.open(path, 'rb')) as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            chunk = []
+            for row in reader:
+                chunk.append(dict(zip(
+                    columns,
+                    [value.decode('utf-8') if value else None for value in row],
+                )))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+class DeleteData(BulkJobTaskMixin, BaseSalesforceApiTask):
 
     task_options = {
         'objects': {
             'description': 'A list of objects to delete records from in order of deletion.  If passed via command line, use a comma separated string',
-            'required': True,
-        }
+        },
+        'mapping': {
+            'description': 'The path to a LoadData mapping yaml file.  If objects is not set, the records of the mapped objects are deleted in the reverse order of their dependencies',
+        },
+        'parallel_steps': {
+            'description': 'The number of objects to delete concurrently when a mapping is used.  Defaults to 1',
+        },
+        'hard_delete': {
+            'description': 'If True, perform a hard delete, bypassing the recycle bin.  Requires the Bulk API Hard Delete permission.  Default: False',
+        },
+        'bulk_api': {
+            'description': 'The version of the Bulk API to use: 1.0 or 2.0.  Defaults to 1.0',
+        },
     }
 
     def _init_options(self, kwargs):
         super(DeleteData, self)._init_options(kwargs)
        
+        if 'objects' not in self.options and 'mapping' not in self.options:
+            raise TaskOptionsError('DeleteData requires either objects or mapping')
+
         # Split and trim objects string into a list if not already a list
-        if not isinstance(self.options['objects'], list):
+        if 'objects' in self.options and not isinstance(self.options['objects'], list):
             self.options['objects'] = [obj.strip() for obj in self.options['objects'].split(',')]
 
-    def _run_task(self):
-        for obj in self.options['objects']:
-            self.logger.info('Deleting all {} records'.format(obj))
-            # Query for all record ids
-            self.logger.info('  Querying for all {} objects'.format(obj))
-            query_job = self.bulk.create_query_job(obj, contentType='CSV')
-            batch = self.bulk.query(query_job, "select Id from {}".format(obj))
-            while not self.bulk.is_batch_done(query_job, batch):
-                time.sleep(10)
-            self.bulk.close_job(query_job)
-
-            delete_rows = []
-            for row in self.bulk.get_batch_result_iter(query_job, batch, parse_csv=True):
-                delete_rows.append(row)
-
-            if not delete_rows:
-                self.logger.info('  No {} objects found, skipping delete'.format(obj))
-                continue
-
-            # Delete the records
-            delete_job = self.bulk.create_delete_job(obj, contentType='CSV')
-            self.logger.info('  Deleting {} {} records'.format(len(delete_rows), obj))
-            batch_num = 1
-            for batch in self._upload_batch(delete_job, delete_rows):
-                self.logger.info('    Uploaded batch {}'.format(batch))
-                while not self.bulk.is_batch_done(delete_job, batch):
-                    self.logger.info('      Checking status of batch {0}'.format(batch_num))
-                    time.sleep(10)
-                self.logger.info('      Batch {} complete'.format(batch))
-                batch_num += 1
-            self.bulk.close_job(delete_job)
-
-    def _split_batches(self, data, batch_size):
-        """Yield successive n-sized chunks from l."""
-        for i in range(0, len(data), batch_size):
-            yield data[i:i + batch_size]
-
-    def _upload_batch(self, job, data):
-        # Split into batches
-        batches = self._split_batches(data, 2500)
+        self.options['hard_delete'] = process_bool_arg(self.options.get('hard_delete', False))
+        self.options['parallel_steps'] = int(self.options.get('parallel_steps', 1))
 
-        uri = "{}/job/{}/batch".format(self.bulk.endpoint, job)
-        headers = self.bulk.headers({"Content-Type": "text/csv"})
-        for batch in batches:
-            data = ['"Id"']
-            data += ['"{}"'.format(record['Id']) for record in batch]
-            data = '\n'.join(data)
-            resp = requests.post(uri, data=data, headers=headers)
-            content = resp.content
+    def _run_task(self):
+        objects, dependencies = self._get_objects()
+        _run_steps(
+            objects,
+            dependencies,
+            self._delete_object,
+            self.options['parallel_steps'],
+        )
 
-            if resp.status_code >= 400:
-                self.bulk.raise_error(content, resp.status_code)
+    def _get_objects(self):
+        """ Returns the objects to delete and the set of objects that must be
+        deleted before each one """
+        if 'objects' in self.options:
+            # Objects listed explicitly are deleted one after another
+            objects = self.options['objects']
+            dependencies = OrderedDict()
+            for i, obj in enumerate(objects):
+                dependencies[obj] = set(objects[i - 1:i])
+            return objects, dependencies
+
+        # Reverse the load dependencies of the mapping so an object is only
+        # deleted once the objects that look it up have been deleted
+        mappings = hiyapyco.load(self.options['mapping'])
+        load_dependencies = _get_mapping_dependencies(mappings)
+        objects = []
+        dependencies = OrderedDict()
+        for name, mapping in reversed(mappings.items()):
+            obj = mapping['sf_object']
+            if obj not in dependencies:
+                objects.append(obj)
+                dependencies[obj] = set()
+            for step, step_dependencies in load_dependencies.items():
+                dependent_obj = mappings[step]['sf_object']
+                if name in step_dependencies and dependent_obj != obj:
+                    dependencies[obj].add(dependent_obj)
+        return objects, dependencies
+
+    def _delete_object(self, obj):
+        self.logger.info('Deleting all {} records'.format(obj))
+        # Query for all record ids
+        self.logger.info('  Querying for all {} objects'.format(obj))
+        result_files = self._query_files(obj, 'select Id from {}'.format(obj))
+
+        if self.options['bulk_api'] == '2.0':
+            # Each job takes a single upload.  Quoted Ids take 22 bytes a line.
+            batches = self._get_delete_batches(
+                result_files, Bulk2Api.max_upload_bytes // 22)
+            return self._delete_bulk2(obj, batches)
+
+        delete_job = None
+        total_rows = 0
+        for batch_file, count in self._get_delete_batches(result_files, BatchSizer.max_rows):
+            if not delete_job:
+                # Create the job only once there are records to delete
+                delete_job = self._create_delete_job(obj)
+            batch_id = self.bulk.post_bulk_batch(delete_job, batch_file)
+            batch_file.close()
+            total_rows += count
+            self.logger.info('    Uploaded batch {} of {} records'.format(batch_id, count))
+
+        if not delete_job:
+            self.logger.info('  No {} objects found, skipping delete'.format(obj))
+            return
+
+        self.bulk.close_job(delete_job)
+        self.logger.info('  Deleting {} {} records'.format(total_rows, obj))
+        self._wait_for_job(delete_job)
+
+    def _delete_bulk2(self, obj, batches):
+        """ Deletes the records of each batch with a Bulk API 2.0 job """
+        operation = 'hardDelete' if self.options['hard_delete'] else 'delete'
+        total_rows = 0
+        for batch_file, count in batches:
+            job = self.bulk2.create_ingest_job(obj, operation)
+            self.bulk2.upload_job_data(job['id'], batch_file)
+            batch_file.close()
+            self.bulk2.close_job(job['id'])
+            self.logger.info('  Deleting {} {} records with job {}'.format(
+                count, obj, job['id']))
+            info = self.bulk2.wait_for_job(job['id'])
+            total_rows += count
+            failed = int(info.get('numberRecordsFailed') or 0)
+            if failed:
+                self.logger.warning('    {} {} records failed to delete'.format(failed, obj))
+
+        if not total_rows:
+            self.logger.info('  No {} objects found, skipping delete'.format(obj))
+
+    def _create_delete_job(self, obj):
+        if self.options['hard_delete']:
+            return self.bulk.create_job(obj, 'hardDelete', contentType='CSV')
+        return self.bulk.create_delete_job(obj, contentType='CSV')
+
+    def _get_delete_batches(self, result_files, max_rows):
+        """ Streams the queried Ids into csv batch files of up to max_rows
+        records, yielding each file and its record count as soon as it is
+        full.  Result files keep downloading in the background while the
+        batches are uploaded. """
+        batch_file, writer = self._start_batch()
+        count = 0
+        for result_file in result_files:
+            reader = csv.reader(result_file)
+            next(reader, None)  # skip the header row
+            for row in reader:
+                writer.writerow(row[:1])
+                count += 1
+                if count == max_rows:
+                    batch_file.seek(0)
+                    yield batch_file, count
+                    batch_file, writer = self._start_batch()
+                    count = 0
+            result_file.close()
+
+        if count:
+            batch_file.seek(0)
+            yield batch_file, count
+        else:
+            batch_file.close()
 
-            tree = ET.fromstring(content)
-            batch_id = tree.findtext("{%s}id" % self.bulk.jobNS)
+    def _start_batch(self):
+        batch_file = tempfile.TemporaryFile()
+        writer = csv.writer(batch_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(['Id'])
+        return batch_file, writer
 
-            yield batch_id
-        
-class LoadData(BaseSalesforceApiTask):
+class LoadData(BulkJobTaskMixin, BaseSalesforceApiTask):
 
     task_options = {
         'database_url': {
             'description': 'The database url to a database containing the test data to load',
-            'required': True,
+        },
+        'dataset_path': {
+            'description': 'The path to a dataset directory written by QueryData to load instead of a database',
         },
         'mapping': {
             'description': 'The path to a yaml file containing mappings of the database fields to Salesforce object fields',
             'required': True,
         },
+        'bulk_mode': {
+            'description': 'Set to Serial to force serial mode on all jobs.  Parallel is the default.  A mapping step can override this with its own bulk_mode',
+        },
+        'parallel_steps': {
+            'description': 'The number of mapping steps to run concurrently when they do not depend on each other.  Defaults to 1',
+        },
+        'resume': {
+            'description': 'If True, resume a failed run by skipping the steps and batches it completed.  The data must not have changed since that run.  Default: False',
+        },
+        'incremental': {
+            'description': 'If True, only upsert the rows that are new or changed since the last incremental load, using the hash and Salesforce Id of each loaded row stored in the database.  Default: False',
+        },
+        'delete_removed': {
+            'description': 'If True with incremental, delete the records of rows that were removed from the database since the last incremental load.  Default: False',
+        },
+        'max_pending_batches': {
+            'description': 'The number of batches of a job that can wait to be processed before more are posted.  Batch sizes adapt to the processing time of completed batches.  Defaults to 10',
+        },
+        'max_retries': {
+            'description': 'The number of times rows that failed to lock are retried in a Serial job.  Defaults to 3',
+        },
+        'error_file': {
+            'description': 'The path of a csv file to write the rows that failed to load to, with the step, local id and error of each row',
+        },
+        'bulk_api': {
+            'description': 'The version of the Bulk API to use: 1.0 or 2.0.  Bulk API 2.0 loads each step with as few jobs as possible and ignores bulk_mode.  Defaults to 1.0',
+        },
+        'reflection_cache_dir': {
+            'description': 'The directory to cache the reflected definitions of the mapped tables in until their schema changes.  Defaults to ~/.cumulusci/bulkdata_cache for databases other than SQLite, which are fast to reflect',
+        },
     }
 
+    # Table used to checkpoint the progress of a run so it can be resumed
+    state_table_name = 'cumulusci_load_state'
+
+    # Table of the hash and Salesforce Id of each row of incremental loads
+    hash_table_name = 'cumulusci_load_hashes'
+
+    # Prefix of the tables the lookups of a step are resolved into
+    lookup_table_prefix = 'cumulusci_lookup_'
+
+    # Row errors that are retried as they are likely to succeed on their own
+    retry_errors = ('UNABLE_TO_LOCK_ROW',)
+
+    # Number of rows read from the database at a time to build batches
+    query_page_size = 10000
+
+    def _init_options(self, kwargs):
+        super(LoadData, self)._init_options(kwargs)
+
+        if not self.options.get('database_url') and not self.options.get('dataset_path'):
+            raise TaskOptionsError('LoadData requires either database_url or dataset_path')
+
+        bulk_mode = self.options.get('bulk_mode')
+        if bulk_mode and bulk_mode not in ('Serial', 'Parallel'):
+            raise TaskOptionsError('bulk_mode must be either Serial or Parallel')
+
+        self.options['parallel_steps'] = int(self.options.get('parallel_steps', 1))
+        self.options['resume'] = process_bool_arg(self.options.get('resume', False))
+        if self.options['resume'] and self.options.get('dataset_path'):
+            raise TaskOptionsError('resume requires database_url as datasets are loaded through a temporary database')
+        self.options['incremental'] = process_bool_arg(self.options.get('incremental', False))
+        self.options['delete_removed'] = process_bool_arg(self.options.get('delete_removed', False))
+        if self.options['incremental']:
+            if self.options.get('dataset_path'):
+                raise TaskOptionsError('incremental requires database_url as datasets are loaded through a temporary database')
+            if self.options['resume']:
+                raise TaskOptionsError('incremental loads continue from the rows loaded by a failed run so resume is not needed')
+        elif self.options['delete_removed']:
+            raise TaskOptionsError('delete_removed requires incremental')
+        self.options['max_pending_batches'] = int(self.options.get('max_pending_batches', 10))
+        self.options['max_retries'] = int(self.options.get('max_retries', 3))
+
+        database_url = self.options.get('database_url')
+        if (
+            'reflection_cache_dir' not in self.options and
+            database_url and
+            not database_url.startswith('sqlite')
+        ):
+            self.options['reflection_cache_dir'] = _get_cache_dir()
+
+    def _init_task(self):
+        super(LoadData, self)._init_task()
+        self.record_types = RecordTypeCache(self.sf, self.org_config, _get_cache_dir())
+
     def _run_task(self):
         self._init_mapping()
         self._init_db()
+        try:
+            self._init_state()
+            self._init_hashes()
+            self._init_errors()
+            try:
+                _run_steps(
+                    self.mapping.keys(),
+                    _get_mapping_dependencies(self.mapping),
+                    self._run_step,
+                    self.options['parallel_steps'],
+                )
+                if self.options['delete_removed']:
+                    self._delete_removed_rows()
+            finally:
+                if self.error_file:
+                    self.error_file.close()
+
+            if self.failed_rows:
+                self.logger.warning('{} rows failed to load'.format(self.failed_rows))
+
+            # The checkpoints are only needed to resume a failed run
+            self.state_table.drop(self.engine)
+        finally:
+            if self.staging_path:
+                self.engine.dispose()
+                os.remove(self.staging_path)
+
+    def _run_step(self, name):
+        mapping = self.mapping[name]
+        if self._get_state(name, 0):
+            self.logger.info('Skipping Job: {} (completed by the previous run)'.format(name))
+            return
+
+        self.logger.info('Running Job: {}'.format(name))
+        sizer = BatchSizer(mapping['sf_object'], self.logger)
+
+        if self.options['bulk_api'] == '2.0':
+            # A Bulk API 2.0 job is split into batches by the server so each
+            # job only needs to fit in an upload
+            max_rows = lambda batch_num: sys.maxint
+            max_bytes = Bulk2Api.max_upload_bytes
+        else:
+            max_rows = lambda batch_num: sizer.rows
+            max_bytes = BatchSizer.max_bytes
+
+        def batch_size(batch_num):
+            # Batches posted by a previous run must hold the same rows again
+            state = self._get_state(name, batch_num, status=None)
+            if state and state['row_count']:
+                return state['row_count']
+            return max_rows(batch_num)
+
+        lookup_tables = self._create_lookup_tables(name, mapping)
+        try:
+            rows = self._get_batches(
+                mapping, batch_size, max_bytes=max_bytes, lookup_tables=lookup_tables)
+            retries = self._upload(name, mapping, rows, sizer)
+
+            # Resubmit only the rows that failed to lock, in Serial jobs so
+            # they do not contend with each other again
+            for attempt in range(1, self.options['max_retries'] + 1):
+                if not retries:
+                    break
+                self.logger.info('  Retrying {} rows that failed to lock (attempt {})'.format(
+                    len(retries), attempt))
+                rows = self._get_batches(
+                    mapping,
+                    max_rows,
+                    sorted(local_id for local_id, error in retries),
+                    max_bytes,
+                    lookup_tables,
+                )
+                retries = self._upload(
+                    '{} (retry {})'.format(name, attempt),
+                    mapping,
+                    rows,
+                    sizer,
+                    concurrency='Serial',
+                    resume=False,
+                )
+            self._record_failures(name, retries)
+
+            self._save_state(name, 0, status='Completed')
+            self.session.commit()
+        finally:
+            # Each step runs in its own thread with its own session
+            self.session.remove()
+            self._drop_lookup_tables(lookup_tables)
+
+    def _init_state(self):
+        """ Creates the checkpoint table and loads the checkpoints of the
+        previous run if resuming.
+
+        A row with batch_num 0 marks a completed step.  Other rows record
+        the job and batch a batch was posted to and whether its results
+        have been written back.
+        """
+        self.state_table = Table(
+            self.state_table_name,
+            MetaData(),
+            Column('step', String(255), primary_key=True),
+            Column('batch_num', Integer, primary_key=True, autoincrement=False),
+            Column('job_id', String(18)),
+            Column('batch_id', String(18)),
+            Column('status', String(20)),
+            Column('row_count', Integer),
+        )
+        self.state_table.create(self.engine, checkfirst=True)
 
-        for name, mapping in self.mapping.items():
-            self.logger.info('Running Job: {}'.format(name))
-            rows = self._get_batches(mapping)
-            res = self._upload_batches(mapping, rows)
+        self.state = {}
+        if self.options['resume']:
+            for row in self.engine.execute(self.state_table.select()):
+                self.state[(row['step'], row['batch_num'])] = dict(row)
+            self.logger.info('Resuming from {} checkpoints'.format(len(self.state)))
+        else:
+            self.engine.execute(self.state_table.delete())
+
+    def _init_hashes(self):
+        """ Creates the table of row hashes used by incremental loads.
+
+        Rows are keyed by the object and table of their mapping step and
+        their local id.  The hash covers the values sent for the row, so a
+        row is sent again when its fields, static values or the Ids of the
+        records it looks up change.
+        """
+        self.hash_table = None
+        # local id: hash of the rows sent by each step until they succeed
+        self.pending_hashes = {}
+        if not self.options['incremental']:
+            return
+        self.hash_table = Table(
+            self.hash_table_name,
+            MetaData(),
+            Column('sf_object', String(255), primary_key=True),
+            Column('table_name', String(255), primary_key=True),
+            Column('local_id', Integer, primary_key=True, autoincrement=False),
+            Column('row_hash', String(32)),
+            Column('sf_id', String(18)),
+        )
+        self.hash_table.create(self.engine, checkfirst=True)
+
+    def _save_hashes(self, mapping, ids):
+        """ Records the hash and Salesforce Id of rows that were loaded in
+        the current session """
+        pending = self.pending_hashes[(mapping['sf_object'], mapping['table'])]
+        rows = [{
+            '_local_id': local_id,
+            'sf_object': mapping['sf_object'],
+            'table_name': mapping['table'],
+            'local_id': local_id,
+            'row_hash': pending.pop(local_id, None),
+            'sf_id': sf_id,
+        } for local_id, sf_id in ids]
+        self.session.execute(self.hash_table.delete().where(and_(
+            self.hash_table.c.sf_object == mapping['sf_object'],
+            self.hash_table.c.table_name == mapping['table'],
+            self.hash_table.c.local_id == bindparam('_local_id'),
+        )), rows)
+        self.session.execute(self.hash_table.insert(), rows)
+
+    def _delete_removed_rows(self):
+        """ Deletes the records of rows that are no longer in the database,
+        starting with the last mapping step """
+        done = set()
+        for mapping in reversed(self.mapping.values()):
+            key = (mapping['sf_object'], mapping['table'])
+            if key in done:
+                continue
+            done.add(key)
+
+            table = self.tables[mapping['table']].__table__
+            id_column = list(table.primary_key)[0]
+            removed = self.session.execute(
+                select([self.hash_table.c.local_id, self.hash_table.c.sf_id]).where(and_(
+                    self.hash_table.c.sf_object == mapping['sf_object'],
+                    self.hash_table.c.table_name == mapping['table'],
+                    ~self.hash_table.c.local_id.in_(select([id_column])),
+                ))
+            ).fetchall()
+            if not removed:
+                continue
 
-    def _create_job(self, mapping):
+            self.logger.info('Deleting {} removed {} records'.format(
+                len(removed), mapping['sf_object']))
+            self._delete_records(mapping['sf_object'], [row['sf_id'] for row in removed])
+            self.session.execute(self.hash_table.delete().where(and_(
+                self.hash_table.c.sf_object == mapping['sf_object'],
+                self.hash_table.c.table_name == mapping['table'],
+                self.hash_table.c.local_id == bindparam('_local_id'),
+            )), [{'_local_id': row['local_id']} for row in removed])
+            self.session.commit()
+        self.session.remove()
+
+    def _delete_records(self, sf_object, sf_ids):
+        batches = []
+        for i in range(0, len(sf_ids), BatchSizer.max_rows):
+            batch_file = tempfile.TemporaryFile()
+            writer = csv.writer(batch_file, quoting=csv.QUOTE_ALL)
+            writer.writerow(['Id'])
+            writer.writerows([sf_id] for sf_id in sf_ids[i:i + BatchSizer.max_rows])
+            batch_file.seek(0)
+            batches.append(batch_file)
+
+        if self.options['bulk_api'] == '2.0':
+            for batch_file in batches:
+                job_id = self.bulk2.create_ingest_job(sf_object, 'delete')['id']
+                self.bulk2.upload_job_data(job_id, batch_file)
+                batch_file.close()
+                self.bulk2.close_job(job_id)
+                self.bulk2.wait_for_job(job_id)
+            return
+
+        job_id = self.bulk.create_delete_job(sf_object, contentType='CSV')
+        for batch_file in batches:
+            self.bulk.post_bulk_batch(job_id, batch_file)
+            batch_file.close()
+        self.bulk.close_job(job_id)
+        self._wait_for_job(job_id)
+
+    def _init_errors(self):
+        """ Opens the error file, appending to it when resuming """
+        self.failed_rows = 0
+        self.error_lock = threading.Lock()
+        self.error_file = None
+        self.error_writer = None
+
+        path = self.options.get('error_file')
+        if not path:
+            return
+        append = self.options['resume'] and os.path.isfile(path)
+        self.error_file = open(path, 'ab' if append else 'wb')
+        self.error_writer = csv.writer(self.error_file)
+        if not append:
+            self.error_writer.writerow(['Step', 'Local Id', 'Error'])
+
+    def _record_failures(self, name, failures):
+        """ Writes (local id, error) pairs of rows that failed to load to the
+        error file as they are found """
+        if not failures:
+            return
+        self.logger.warning('    {} rows failed to load: {}'.format(
+            len(failures), failures[0][1]))
+        # Steps running in parallel share the error file
+        with self.error_lock:
+            self.failed_rows += len(failures)
+            if self.error_writer:
+                for local_id, error in failures:
+                    self.error_writer.writerow([name, local_id, error])
+                self.error_file.flush()
+
+    def _get_state(self, name, batch_num, status='Completed'):
+        state = self.state.get((name, batch_num))
+        if state and (status is None or state['status'] == status):
+            return state
+
+    def _save_state(self, name, batch_num, job_id=None, batch_id=None, status=None, row_count=None):
+        """ Records a checkpoint in the current session.  The caller commits
+        it together with any data it depends on. """
+        self.session.execute(self.state_table.delete().where(and_(
+            self.state_table.c.step == name,
+            self.state_table.c.batch_num == batch_num,
+        )))
+        self.session.execute(self.state_table.insert().values(
+            step=name,
+            batch_num=batch_num,
+            job_id=job_id,
+            batch_id=batch_id,
+            status=status,
+            row_count=row_count,
+        ))
+
+    def _create_job(self, mapping, concurrency=None):
         action = mapping.get('action', 'insert')
         job_id = None
 
-        if action == 'insert':
-            job_id = self.bulk.create_insert_job(mapping['sf_object'], contentType='CSV')
+        if not concurrency:
+            concurrency = mapping.get('bulk_mode', self.options.get('bulk_mode'))
+
+        if self.options['incremental']:
+            # Rows loaded before are sent with their Id to update them
+            job_id = self.bulk.create_upsert_job(
+                mapping['sf_object'],
+                'Id',
+                contentType='CSV',
+                concurrency=concurrency,
+            )
+        elif action == 'insert':
+            job_id = self.bulk.create_insert_job(
+                mapping['sf_object'],
+                contentType='CSV',
+                concurrency=concurrency,
+            )
 
         if not job_id:
             self.logger.error('  No handler for action type {}'.format(action))
@@ -157,66 +1078,402 @@ class LoadData(BaseSalesforceApiTask):
         return job_id
 
 
-    def _upload_batches(self, mapping, batches):
-      
+    def _upload(self, name, mapping, batches, sizer, concurrency=None, resume=True):
+        """ Loads the batches with the selected Bulk API and returns the
+        (local id, error) pairs of the rows that failed with one of the
+        retry_errors.  Other failed rows are written to the error file. """
+        if self.options['bulk_api'] == '2.0':
+            # Bulk API 2.0 has no concurrency mode to choose
+            return self._upload_jobs(name, mapping, batches, resume)
+        return self._upload_batches(name, mapping, batches, sizer, concurrency, resume)
+
+    def _split_failures(self, name, failures):
+        """ Records the permanent failures and returns the failures that
+        can be retried """
+        transient = []
+        permanent = []
+        for local_id, error in failures:
+            if error.startswith(self.retry_errors):
+                transient.append((local_id, error))
+            else:
+                permanent.append((local_id, error))
+        self._record_failures(name, permanent)
+        return transient
+
+    def _upload_batches(self, name, mapping, batches, sizer=None, concurrency=None, resume=True):
+
         job_id = None
-        table = self.tables[mapping.get('table')]
+        pending = {}
+        retries = []
+        window = self.options['max_pending_batches']
+
+        def handle_failures(failures):
+            transient = self._split_failures(name, failures)
+            retries.extend(transient)
+            return len(transient)
+
+        def process_batch(batch_id, info):
+            if batch_id not in pending:
+                return
+            self.logger.info('      Batch {} complete'.format(batch_id))
+            batch_num, local_ids = pending.pop(batch_id)
+            failures = self._process_batch_results(mapping, job_id, batch_id, local_ids)
+            self._save_state(name, batch_num, job_id, batch_id, 'Completed', len(local_ids))
+            self.session.commit()
+            lock_errors = handle_failures(failures)
+            if sizer:
+                sizer.record(info, lock_errors)
+
+        # Keep up to max_pending_batches batches posted and let the server
+        # schedule them according to the job's concurrency mode.  The next
+        # batch is only built once there is room so its size can adapt to
+        # the batches completed so far.
+        for batch_num, (batch_file, local_ids) in enumerate(batches, 1):
+            if resume and self._get_state(name, batch_num):
+                batch_file.close()
+                self.logger.info('    Skipping batch {} (completed by the previous run)'.format(batch_num))
+                continue
+
+            state = self._get_state(name, batch_num, status='Posted') if resume else None
+            if state:
+                failures = self._resume_batch(name, mapping, batch_num, state, local_ids)
+                if failures is not None:
+                    batch_file.close()
+                    handle_failures(failures)
+                    continue
 
-        for batch, batch_rows in batches:
             if not job_id:
                 # Create a job only once we have the first batch to load into it
-                job_id = self._create_job(mapping)
-
-            # Prepare the rows
-            rows = CsvDictsAdapter(iter(batch))
+                job_id = self._create_job(mapping, concurrency)
 
             # Create the batch
-            batch_id = self.bulk.post_bulk_batch(job_id, rows)
+            batch_id = self.bulk.post_bulk_batch(job_id, batch_file)
+            batch_file.close()
             self.logger.info('    Uploaded batch {}'.format(batch_id))
-            while not self.bulk.is_batch_done(job_id, batch_id):
-                self.logger.info('      Checking batch status...')
-                time.sleep(10)
-            
-            # Wait for batch to complete
-            res = self.bulk.wait_for_batch(job_id, batch_id)
-            self.logger.info('      Batch {} complete'.format(batch_id))
+            pending[batch_id] = (batch_num, local_ids)
+            self._save_state(name, batch_num, job_id, batch_id, 'Posted', len(local_ids))
+            self.session.commit()
+
+            if len(pending) >= window:
+                self._wait_for_job(
+                    job_id,
+                    process_batch,
+                    until=lambda: len(pending) < window,
+                )
+
+        if job_id:
+            self.bulk.close_job(job_id)
+            self._wait_for_job(job_id, process_batch)
+
+        return retries
+
+    def _upload_jobs(self, name, mapping, batches, resume=True):
+        """ Loads each batch with a Bulk API 2.0 ingest job """
+        retries = []
+        for job_num, (batch_file, local_ids) in enumerate(batches, 1):
+            if resume and self._get_state(name, job_num):
+                batch_file.close()
+                self.logger.info('    Skipping job {} (completed by the previous run)'.format(job_num))
+                continue
+
+            job_id = None
+            state = self._get_state(name, job_num, status='Posted') if resume else None
+            if state:
+                self.logger.info('    Checking job {} posted by the previous run'.format(state['job_id']))
+                try:
+                    info = self.bulk2.wait_for_job(state['job_id'])
+                    job_id = state['job_id']
+                except Bulk2ApiError:
+                    pass
 
-            # salesforce_bulk is broken in fetching id results so do it manually
-            results_url = '{}/job/{}/batch/{}/result'.format(self.bulk.endpoint, job_id, batch_id)
-            headers = self.bulk.headers()
-            resp = requests.get(results_url, headers=headers)
-            csv_file = tempfile.TemporaryFile()
-            csv_file.write(resp.content)
-            csv_file.seek(0)
-            reader = csv.DictReader(csv_file)
-
-            # Write to the local Id column on the uploaded rows
-            i = 0
-            for result in reader:
-                row = batch_rows[i]
-                i += 1
-                if result['Id']:
-                    setattr(row, mapping['fields']['Id'], result['Id'])
-
-            # Commit to the db
+            if not job_id:
+                if self.options['incremental']:
+                    # Rows loaded before are sent with their Id to update them
+                    job_id = self.bulk2.create_ingest_job(
+                        mapping['sf_object'],
+                        'upsert',
+                        external_id_field='Id',
+                    )['id']
+                else:
+                    job_id = self.bulk2.create_ingest_job(
+                        mapping['sf_object'],
+                        mapping.get('action', 'insert'),
+                    )['id']
+                self.logger.info('  Created bulk job {}'.format(job_id))
+                self.bulk2.upload_job_data(job_id, batch_file)
+                self.bulk2.close_job(job_id)
+                self.logger.info('    Uploaded {} rows'.format(len(local_ids)))
+                self._save_state(name, job_num, job_id, None, 'Posted', len(local_ids))
+                self.session.commit()
+                info = self.bulk2.wait_for_job(job_id)
+
+            self.logger.info('    Job {} complete: {} rows processed, {} failed'.format(
+                job_id, info.get('numberRecordsProcessed'), info.get('numberRecordsFailed')))
+            failures = self._process_job_results(mapping, job_id, batch_file, local_ids)
+            batch_file.close()
+            self._save_state(name, job_num, job_id, None, 'Completed', len(local_ids))
             self.session.commit()
-                
-        self.bulk.close_job(job_id)
- 
-        
-    def _query_db(self, mapping):
-        table = self.tables[mapping.get('table')]
+            retries.extend(self._split_failures(name, failures))
+
+        return retries
+
+    def _process_job_results(self, mapping, job_id, batch_file, local_ids):
+        """ Writes back the Ids of a completed Bulk API 2.0 job and returns
+        the (local id, error) pairs of its failed rows.
+
+        The results of a job are not in the order of the uploaded rows but
+        repeat their fields, so rows are matched on a digest of their values.
+        Identical rows are interchangeable.
+        """
+        batch_file.seek(0)
+        reader = csv.reader(batch_file)
+        fields = next(reader)
+        rows = {}
+        for local_id, row in zip(local_ids, reader):
+            rows.setdefault(_row_digest(row), []).append(local_id)
+
+        def match(results, column):
+            for result in csv.DictReader(results):
+                local_ids = rows.get(_row_digest([result[field] for field in fields]))
+                if local_ids:
+                    yield local_ids.pop(), result[column]
+            results.close()
+
+        ids = list(match(self.bulk2.get_successful_results(job_id), 'sf__Id'))
+        if ids and 'Id' in mapping.get('fields', {}):
+            self._write_back_ids(mapping, ids)
+        if ids and self.options['incremental']:
+            self._save_hashes(mapping, ids)
+
+        return list(match(self.bulk2.get_failed_results(job_id), 'sf__Error'))
+
+    def _resume_batch(self, name, mapping, batch_num, state, local_ids):
+        """ Waits for a batch posted by the previous run and writes back its
+        results.  Returns the failed rows of the batch or None if the batch
+        has to be posted again. """
+        job_id = state['job_id']
+        batch_id = state['batch_id']
+        self.logger.info('    Checking batch {} posted by the previous run'.format(batch_id))
+        try:
+            self.bulk.wait_for_batch(job_id, batch_id)
+        except BulkBatchFailed:
+            return None
+        if self.bulk.batch_state(job_id, batch_id) != 'Completed':
+            return None
+
+        self.logger.info('      Batch {} complete'.format(batch_id))
+        failures = self._process_batch_results(mapping, job_id, batch_id, local_ids)
+        self._save_state(name, batch_num, job_id, batch_id, 'Completed', len(local_ids))
+        self.session.commit()
+        return failures
+
+    def _process_batch_results(self, mapping, job_id, batch_id, local_ids):
+        """ Writes back the Ids of a completed batch and returns the (local
+        id, error) pairs of its failed rows """
+        # salesforce_bulk is broken in fetching id results so do it manually
+        results_url = '{}/job/{}/batch/{}/result'.format(self.bulk.endpoint, job_id, batch_id)
+        headers = self.bulk.headers()
+        resp = requests.get(results_url, headers=headers, stream=True)
+        if resp.status_code >= 400:
+            self.bulk.raise_error(resp.content, resp.status_code)
+
+        # Stream the results which are returned in the same order as the
+        # rows in the batch
+        reader = csv.DictReader(resp.iter_lines(chunk_size=8192))
+        ids = []
+        failures = []
+        for local_id, result in zip(local_ids, reader):
+            if result['Success'] == 'true':
+                ids.append((local_id, result['Id']))
+            else:
+                failures.append((local_id, result['Error']))
+
+        if ids and 'Id' in mapping.get('fields', {}):
+            self._write_back_ids(mapping, ids)
+        if ids and self.options['incremental']:
+            self._save_hashes(mapping, ids)
+
+        return failures
+
+    def _write_back_ids(self, mapping, ids):
+        """ Writes a batch of (local id, Salesforce Id) pairs to the local Id
+        column of the mapping's table in a single set based operation """
+        table = self.tables[mapping['table']].__table__
+        id_column = list(table.primary_key)[0]
+        sf_id_column = table.c[mapping['fields']['Id']]
+
+        if self.session.bind.dialect.name == 'postgresql':
+            # Join against the pairs unnested from two array parameters so
+            # the whole batch is written with one statement
+            preparer = self.session.bind.dialect.identifier_preparer
+            statement = text(
+                'UPDATE {table} SET {sf_id} = ids.sf_id '
+                'FROM (SELECT unnest(:local_ids) AS local_id, '
+                'unnest(:sf_ids) AS sf_id) AS ids '
+                'WHERE {table}.{id} = ids.local_id'.format(
+                    table=preparer.format_table(table),
+                    sf_id=preparer.quote(sf_id_column.name),
+                    id=preparer.quote(id_column.name),
+                )
+            )
+            self.session.execute(statement, {
+                'local_ids': [local_id for local_id, sf_id in ids],
+                'sf_ids': [sf_id for local_id, sf_id in ids],
+            })
+        else:
+            statement = table.update().where(
+                id_column == bindparam('_local_id')
+            ).values({sf_id_column.name: bindparam('_sf_id')})
+            self.session.execute(statement, [
+                {'_local_id': local_id, '_sf_id': sf_id}
+                for local_id, sf_id in ids
+            ])
+
+    def _create_lookup_tables(self, name, mapping):
+        """ Resolves each lookup of a step into a table of the join values
+        matching exactly one row of the lookup table and the value field of
+        that row, keyed on the join value.
+
+        The lookup tables are aggregated once per step here rather than in
+        each page of rows read by _iter_rows, which would make reading a
+        step quadratic in the size of the lookup tables.  Join values
+        matching more than one row are left out so the lookup is empty
+        rather than the row repeated for each match.  Returns a dict of the
+        tables by lookup field. """
+        lookup_tables = {}
+        for field, lookup in mapping.get('lookups', {}).items():
+            lookup_table = self.tables[lookup['table']].__table__
+            join_column = lookup_table.c[lookup['join_field']]
+            value_column = lookup_table.c[lookup['value_field']]
+            table_name = self.lookup_table_prefix + hashlib.md5(
+                '{}.{}'.format(name, field)).hexdigest()[:12]
+            table = Table(
+                table_name,
+                MetaData(),
+                Column('join_value', _ddl_type(join_column), primary_key=True, autoincrement=False),
+                Column('value', _ddl_type(value_column)),
+            )
+            # Drop a table left behind by an interrupted run
+            table.drop(self.engine, checkfirst=True)
+            table.create(self.engine)
+            self.session.execute(table.insert().from_select(
+                ['join_value', 'value'],
+                select([join_column, func.min(value_column)])
+                .where(join_column != None)
+                .group_by(join_column)
+                .having(func.count() == 1),
+            ))
+            self.session.commit()
+            lookup_tables[field] = table
+        return lookup_tables
+
+    def _drop_lookup_tables(self, lookup_tables):
+        for table in lookup_tables.values():
+            table.drop(self.engine, checkfirst=True)
+
+    def _query_db(self, mapping, fields, only_ids=None, lookup_tables=None):
+        """ Builds a select of the local id, the mapped fields and the
+        value field of each lookup, optionally limited to the rows with the
+        local ids in only_ids.  Lookups are joined to the tables built by
+        _create_lookup_tables if passed, or else aggregated in the query. """
+        table = self.tables[mapping.get('table')].__table__
 
-        query = self.session.query(table)
         if 'filters' in mapping:
+            # Filter in a subquery so unqualified column names in the
+            # filters are not ambiguous with the joined lookup tables
             filter_args = []
             for f in mapping['filters']:
                 filter_args.append(text(f))
-            query = query.filter(*filter_args)
+            table = select([table]).where(and_(*filter_args)).alias(table.name)
+
+        columns = [list(table.primary_key)[0]]
+        for db_field in fields.values():
+            columns.append(table.c[db_field])
+
+        # Resolve lookups in the database with an outer join per lookup
+        # rather than querying the lookup table once per row.  The value
+        # field of each lookup is added as an extra column to the results.
+        # Join values matching more than one row are left out so the lookup
+        # is empty rather than the row repeated for each match.
+        from_obj = table
+        for field, lookup in mapping.get('lookups', {}).items():
+            if lookup_tables is not None:
+                lookup_values = lookup_tables[field]
+            else:
+                lookup_table = self.tables[lookup['table']].__table__
+                join_column = lookup_table.c[lookup['join_field']]
+                lookup_values = select([
+                    join_column.label('join_value'),
+                    func.min(lookup_table.c[lookup['value_field']]).label('value'),
+                ]).group_by(join_column).having(func.count() == 1).alias()
+            from_obj = from_obj.outerjoin(
+                lookup_values,
+                lookup_values.c.join_value == table.c[lookup['key_field']],
+            )
+            columns.append(lookup_values.c.value)
+
+        if self.options['incremental']:
+            # Add the hash and Salesforce Id of the last load of each row
+            from_obj = from_obj.outerjoin(self.hash_table, and_(
+                self.hash_table.c.sf_object == mapping['sf_object'],
+                self.hash_table.c.table_name == mapping['table'],
+                self.hash_table.c.local_id == columns[0],
+            ))
+            columns.append(self.hash_table.c.row_hash)
+            columns.append(self.hash_table.c.sf_id)
+
+        # Order by the local id so batches are the same on every run
+        query = select(columns).select_from(from_obj).order_by(columns[0])
+        if only_ids is not None:
+            query = query.where(columns[0].in_(only_ids))
         return query
 
-
-    def _get_batches(self, mapping):
+    def _iter_rows(self, mapping, fields, only_ids=None, lookup_tables=None):
+        """ Yields the rows of _query_db in pages keyed on the local id.
+
+        Each page is fetched completely before its rows are yielded so no
+        cursor is open while the batches built from them are posted and
+        their checkpoints and results are committed in the same session. """
+        if only_ids is not None:
+            # Select the rows in chunks of ids to stay under the database's
+            # limit on the number of bound parameters
+            for i in range(0, len(only_ids), 500):
+                query = self._query_db(
+                    mapping, fields, only_ids[i:i + 500], lookup_tables)
+                for row in self.session.execute(query).fetchall():
+                    yield row
+            return
+
+        query = self._query_db(mapping, fields, lookup_tables=lookup_tables)
+        id_column = list(query.inner_columns)[0]
+        last_id = None
+        while True:
+            page = query
+            if last_id is not None:
+                page = page.where(id_column > last_id)
+            rows = self.session.execute(page.limit(self.query_page_size)).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < self.query_page_size:
+                return
+            last_id = rows[-1][0]
+
+    def _get_batches(self, mapping, batch_size=None, only_ids=None, max_bytes=None,
+                     lookup_tables=None):
+        """ Yields a temporary file of csv rows and the list of local ids of
+        those rows for each batch.  batch_size is called with each batch
+        number to get the maximum number of rows in that batch.  If only_ids
+        is passed, only the rows with those local ids are included.
+        lookup_tables are the tables of _create_lookup_tables for the step.
+
+        For incremental loads, rows with the same hash as in the last load
+        are skipped and the Salesforce Id of rows loaded before is sent in
+        an Id column. """
+        incremental = self.options['incremental']
+        if batch_size is None:
+            batch_size = lambda batch_num: BatchSizer.max_rows
+        if max_bytes is None:
+            max_bytes = BatchSizer.max_bytes
         action = mapping.get('action', 'insert')
         fields = mapping.get('fields', {}).copy()
         static = mapping.get('static', {})
@@ -227,130 +1484,251 @@ class LoadData(BaseSalesforceApiTask):
         if action == 'insert' and 'Id' in fields:
             del fields['Id']
 
-        # Build the list of fields to import
-        import_fields = fields.keys() + static.keys() + lookups.keys()
+        # Build the list of fields to import in the order of the query
+        # columns followed by the static values
+        import_fields = fields.keys() + lookups.keys() + static.keys()
+        static_values = [_convert(value) for value in static.values()]
 
         if record_type:
             import_fields.append('RecordTypeId')
-            # default to the profile assigned recordtype if we can't find any
-            # query for the RT by developer name
-            try:
-                query = "SELECT Id FROM RecordType WHERE SObjectType='{0}'" \
-                    "AND DeveloperName = '{1}' LIMIT 1"
-                record_type_id = self.sf.query(
-                    query.format(mapping.get('sf_object'), record_type)
-                )['records'][0]['Id']
-            except (KeyError, IndexError):
-                record_type_id = None
-
-        query = self._query_db(mapping)
+            record_type_id = self.record_types.get(
+                mapping.get('sf_object'), record_type)
+            static_values.append(_convert(record_type_id))
+
+        if incremental:
+            import_fields.insert(0, 'Id')
+            pending_hashes = self.pending_hashes.setdefault(
+                (mapping['sf_object'], mapping['table']), {})
+            unchanged = 0
+
+        # Compile the conversion of the selected columns, skipping the
+        # local id
+        query = self._query_db(mapping, fields)
+        converters = _get_converters(list(query.inner_columns)[1:])
+
+        rows = self._iter_rows(mapping, fields, only_ids, lookup_tables)
+
+        # Rows are written to a line buffer first so the encoded size of
+        # each batch can be kept under the Bulk API limit
+        line_buffer = StringIO()
+        writer = csv.writer(line_buffer, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(import_fields)
+        header = line_buffer.getvalue()
 
         total_rows = 0
         batch_num = 1
-        batch = []
-        batch_rows = []
-    
-        for row in query:
+        max_rows = batch_size(batch_num)
+        batch_file = self._start_batch(header)
+        batch_bytes = len(header)
+        local_ids = []
+
+        for row in rows:
+            values = list(row[1:])
+            for index, convert in converters:
+                values[index] = convert(values[index])
+            if incremental:
+                values, (last_hash, sf_id) = values[:-2], row[-2:]
+
+            line_buffer.seek(0)
+            line_buffer.truncate()
+            writer.writerow(values + static_values)
+            line = line_buffer.getvalue()
+
+            if incremental:
+                row_hash = hashlib.md5(line).hexdigest()
+                if row_hash == last_hash:
+                    unchanged += 1
+                    continue
+                pending_hashes[row[0]] = row_hash
+                line_buffer.seek(0)
+                line_buffer.truncate()
+                writer.writerow([_convert(sf_id or '')] + values + static_values)
+                line = line_buffer.getvalue()
+
             total_rows += 1
 
-            # Get the row data from the mapping and database values
-            csv_row = {}
-            for key, value in fields.items():
-                csv_row[key] = getattr(row, value)
-            for key, value in static.items():
-                csv_row[key] = value
-            for key, lookup in lookups.items():
-                lookup_table = lookup['table']
-                kwargs = {lookup['join_field']: getattr(row, lookup['key_field'])}
-                try:
-                    res = self.session.query(self.tables[lookup['table']]).filter_by(**kwargs).one()
-                    csv_row[key] = getattr(res, lookup['value_field'])
-                except:
-                    csv_row[key] = None
-            if record_type:
-                csv_row['RecordTypeId'] = record_type_id 
-
-            # utf-8 encode row values
-            for key, value in csv_row.items():
-                if value:
-                    if isinstance(value, datetime.datetime):
-                        csv_row[key] = value.isoformat()
-                    else:
-                        try:
-                            csv_row[key] = value.encode('utf8')
-                        except AttributeError:
-                            continue
-
-            # Write to csv file
-            batch.append(csv_row)
-        
-            batch_rows.append(row)
-
-            # Slice into batches
-            if len(batch) == 10000:
-                self.logger.info('    Processing batch {}'.format(batch_num))
-                yield batch, batch_rows
+            # Slice into batches by row count and encoded size
+            if local_ids and (
+                len(local_ids) >= max_rows or
+                batch_bytes + len(line) > max_bytes
+            ):
+                self.logger.info('    Processing batch {} of {} rows'.format(batch_num, len(local_ids)))
+                batch_file.seek(0)
+                yield batch_file, local_ids
 
                 # Start the next batch
                 batch_num += 1
-                batch = []
-                batch_rows = []
+                max_rows = batch_size(batch_num)
+                batch_file = self._start_batch(header)
+                batch_bytes = len(header)
+                local_ids = []
+
+            batch_file.write(line)
+            batch_bytes += len(line)
+            # The first column is the local id used to write back the Id
+            local_ids.append(row[0])
 
         self.logger.info('  Prepared {} rows for import to {}'.format(total_rows, mapping['sf_object']))
+        if incremental:
+            self.logger.info('  Skipped {} rows unchanged since the last load'.format(unchanged))
+
+        if local_ids:
+            self.logger.info('    Processing batch {} of {} rows'.format(batch_num, len(local_ids)))
+            batch_file.seek(0)
+            yield batch_file, local_ids
+        else:
+            batch_file.close()
 
-        if batch:
-            yield batch, batch_rows
+    def _start_batch(self, header):
+        batch_file = tempfile.TemporaryFile()
+        batch_file.write(header)
+        return batch_file
 
     def _init_db(self):
         # initialize the DB engine
-        self.engine = create_engine(self.options['database_url'])
+        self.engine, self.staging_path = _create_engine(self.options)
 
         # initialize DB metadata
-        self.metadata = MetaData()
-        self.metadata.bind = self.engine
+        if self.staging_path:
+            # The staged tables are already known so skip reflection
+            self.metadata = MetaData()
+            self.metadata.bind = self.engine
+            self._import_dataset()
+        else:
+            # Only reflect the mapped tables as the database may be shared
+            # with many others
+            self.metadata = _reflect_tables(
+                self.engine,
+                self._get_mapped_tables(),
+                self.options.get('reflection_cache_dir'),
+            )
 
         # initialize the automap mapping
         self.base = automap_base(bind=self.engine, metadata=self.metadata)
-        self.base.prepare(self.engine, reflect=True)
+        self.base.prepare()
 
         # Loop through mappings and reflect each referenced table
         self.tables = {}
         for name, mapping in self.mapping.items():
             if 'table' in mapping and mapping['table'] not in self.tables:
                 self.tables[mapping['table']] = self.base.classes[mapping['table']]
-
-        # initialize the DB session
-        self.session = Session(self.engine)
+            # Lookup tables are joined when querying so they must be mapped too
+            for lookup in mapping.get('lookups', {}).values():
+                if lookup['table'] not in self.tables:
+                    self.tables[lookup['table']] = self.base.classes[lookup['table']]
+
+        # initialize a thread local DB session for concurrent steps
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+
+    def _import_dataset(self):
+        """ Copies the tables of the dataset used by the mapping to the
+        staging database in chunks """
+        dataset = Dataset(self.options['dataset_path'])
+        for name in sorted(self._get_mapped_tables()):
+            columns = dataset.tables[name]['columns']
+            table = Table(
+                name,
+                self.metadata,
+                Column(columns[0], Integer, primary_key=True),
+                *[Column(column, Unicode(255)) for column in columns[1:]]
+            )
+            table.create(self.engine)
+            for chunk in dataset.read_table(name):
+                self.engine.execute(table.insert(), chunk)
+            self.logger.info('Staged {} rows of {}'.format(dataset.tables[name]['rows'], name))
+
+    def _get_mapped_tables(self):
+        """ Returns the set of tables loaded or looked up by the mapping """
+        names = set()
+        for mapping in self.mapping.values():
+            names.add(mapping['table'])
+            for lookup in mapping.get('lookups', {}).values():
+                names.add(lookup['table'])
+        return names
 
     def _init_mapping(self):
         self.mapping = hiyapyco.load(self.options['mapping'])
 
-class QueryData(BaseSalesforceApiTask):
+class QueryData(BulkJobTaskMixin, BaseSalesforceApiTask):
     task_options = {
         'database_url': {
             'description': 'A DATABASE_URL where the query output should be written',
-            'required': True,
+        },
+        'dataset_path': {
+            'description': 'The path of a dataset directory of gzipped csv files to write the query output to instead of a database',
         },
         'mapping': {
             'description': 'The path to a yaml file containing mappings of the database fields to Salesforce object fields',
             'required': True,
         },
+        'pk_chunking': {
+            'description': 'If True, enables PK chunking on the query jobs.  Set to a number to also set the chunk size.',
+        },
+        'bulk_api': {
+            'description': 'The version of the Bulk API to use: 1.0 or 2.0.  Defaults to 1.0',
+        },
+        'incremental': {
+            'description': 'If True, only query the records modified since the last incremental run of each mapping and update the rows with their Salesforce Id in the database.  Every mapping must map the Id field.  Default: False',
+        },
     }
 
+    # Table of the last SystemModstamp queried by each mapping
+    watermark_table_name = 'cumulusci_query_watermarks'
+
+    # Seconds before the watermark to query again, as records committed
+    # after a query may have a SystemModstamp from before it ran.  Rows are
+    # upserted by Id, so records read again are only updated in place.
+    watermark_overlap = 300
+
+    def _init_options(self, kwargs):
+        super(QueryData, self)._init_options(kwargs)
+        if not self.options.get('database_url') and not self.options.get('dataset_path'):
+            raise TaskOptionsError('QueryData requires either database_url or dataset_path')
+        self.options['incremental'] = process_bool_arg(self.options.get('incremental', False))
+        if self.options['incremental'] and self.options.get('dataset_path'):
+            raise TaskOptionsError('incremental requires database_url as datasets are written through a temporary database')
+
     def _run_task(self):
         self._init_mapping()
         self._init_db()
-
-        for name, mapping in self.mappings.items():
-            fields = self._fields_for_mapping(mapping)
-            soql = self._soql_for_mapping(mapping)
-            self._run_query(soql, mapping)
+        self._init_watermarks()
+
+        try:
+            for name, mapping in self.mappings.items():
+                watermark = self._get_watermark(name)
+                soql = self._soql_for_mapping(mapping, watermark)
+                last_modified = self._run_query(soql, mapping)
+                # Records read again from the overlap must not move the
+                # watermark back
+                if last_modified and last_modified > watermark:
+                    self._save_watermark(name, mapping, last_modified)
+
+            # Lookups are loaded as Salesforce Ids and translated to local
+            # ids once every table has been loaded
+            self._translate_lookups()
+
+            if self.staging_path:
+                self._export_dataset()
+        finally:
+            if self.staging_path:
+                self.session.close()
+                self.engine.dispose()
+                os.remove(self.staging_path)
+
+    def _export_dataset(self):
+        """ Streams each staged table to the dataset """
+        dataset = Dataset(self.options['dataset_path'])
+        for name, table in self.metadata.tables.items():
+            query = select([table]).order_by(table.c.id)
+            rows = self.engine.execute(query.execution_options(stream_results=True))
+            count = dataset.write_table(name, [column.name for column in table.columns], rows)
+            self.logger.info('Wrote {} rows of {} to {}'.format(
+                count, name, self.options['dataset_path']))
 
     def _init_db(self):
-        self.models = {}
-
         # initialize the DB engine
-        self.engine = create_engine(self.options['database_url'])
+        self.engine, self.staging_path = _create_engine(self.options)
+        _use_sqlite_bulk_pragmas(self.engine, self.staging_path)
 
         # initialize DB metadata
         self.metadata = MetaData()
@@ -359,9 +1737,10 @@ class QueryData(BaseSalesforceApiTask):
         # Create the tables
         self._create_tables()
 
-        # initialize the automap mapping
+        # initialize the automap mapping.  The mapped tables were defined
+        # by _create_tables so there is nothing to reflect.
         self.base = automap_base(bind=self.engine, metadata=self.metadata)
-        self.base.prepare(self.engine, reflect=True)
+        self.base.prepare()
 
         # Loop through mappings and reflect each referenced table
         self.tables = {}
@@ -372,8 +1751,57 @@ class QueryData(BaseSalesforceApiTask):
         # initialize session
         self.session = create_session(bind=self.engine, autocommit=False)
 
+    def _init_watermarks(self):
+        self.watermark_table = None
+        # table: Salesforce Ids of the rows queried by this run
+        self.queried_ids = {}
+        # table: largest local id before this run, as rows are only
+        # inserted by a run that is not incremental
+        self.start_ids = {}
+        if not self.options['incremental']:
+            for name, table in self.metadata.tables.items():
+                self.start_ids[name] = self.session.execute(
+                    select([func.max(table.c.id)])).scalar() or 0
+            return
+        self.watermark_table = Table(
+            self.watermark_table_name,
+            MetaData(),
+            Column('name', String(255), primary_key=True),
+            Column('sf_object', String(255)),
+            Column('last_modified', String(32)),
+        )
+        self.watermark_table.create(self.engine, checkfirst=True)
+
+    def _get_watermark(self, name):
+        if self.watermark_table is None:
+            return None
+        return self.session.execute(
+            select([self.watermark_table.c.last_modified]).where(
+                self.watermark_table.c.name == name)
+        ).scalar()
+
+    def _save_watermark(self, name, mapping, last_modified):
+        """ Records the SystemModstamp of the last modified record queried
+        by a mapping.  It is saved after the rows are committed, so a failed
+        run queries the rows again and updates them in place. """
+        self.session.execute(
+            self.watermark_table.delete().where(self.watermark_table.c.name == name))
+        self.session.execute(self.watermark_table.insert(), {
+            'name': name,
+            'sf_object': mapping['sf_object'],
+            'last_modified': last_modified,
+        })
+        self.session.commit()
+        self.logger.info('Queried {} records modified up to {}'.format(
+            mapping['sf_object'], last_modified))
+
     def _init_mapping(self):
         self.mappings = hiyapyco.load(self.options['mapping'])
+        if self.options['incremental']:
+            for name, mapping in self.mappings.items():
+                if 'Id' not in mapping.get('fields', {}):
+                    raise TaskOptionsError(
+                        'incremental requires the Id field to be mapped in {}'.format(name))
         #self.mappings = [(name, mapping) for name, mapping in self.mappings.items()]
         #self.mappings.reverse()
         #rev_mappings = OrderedDict()
@@ -381,59 +1809,158 @@ class QueryData(BaseSalesforceApiTask):
         #    rev_mappings[mapping_item[0]] = mapping_item[1]
         #self.mappings = rev_mappings
 
-    def _soql_for_mapping(self, mapping):
+    def _soql_for_mapping(self, mapping, watermark=None):
         sf_object = mapping['sf_object']
         fields = [field['sf'] for field in self._fields_for_mapping(mapping)]
+        if self.options['incremental'] and 'SystemModstamp' not in fields:
+            fields.append('SystemModstamp')
         soql = "SELECT {fields} FROM {sf_object}".format(**{
             'fields': ', '.join(fields),
             'sf_object': sf_object,
         })
+        if watermark:
+            # SystemModstamp values are returned as SOQL datetime literals
+            since = datetime.datetime.strptime(watermark, '%Y-%m-%dT%H:%M:%S.%fZ')
+            since -= datetime.timedelta(seconds=self.watermark_overlap)
+            soql += ' WHERE SystemModstamp >= {}{:03d}Z'.format(
+                since.strftime('%Y-%m-%dT%H:%M:%S.'), since.microsecond // 1000)
         return soql
 
     def _run_query(self, soql, mapping):
-        self.logger.info('Creating bulk job for: {sf_object}'.format(**mapping))
-        job = self.bulk.create_query_job(mapping['sf_object'], contentType='CSV')
-        self.logger.info('Job id: {0}'.format(job))
-        self.logger.info('Submitting query: {}'.format(soql))
-        batch = self.bulk.query(job, soql)
-        self.logger.info('Batch id: {0}'.format(batch))
-        self.bulk.wait_for_batch(job, batch)
-        self.logger.info('Batch {0} finished'.format(batch))
-        self.bulk.close_job(job)
-        self.logger.info('Job {0} closed'.format(job))
+        """ Writes the query results to the table of a mapping and returns
+        the last SystemModstamp of the results for incremental runs """
+        result_files = self._query_files(mapping['sf_object'], soql)
 
         field_map = {}
         for field in self._fields_for_mapping(mapping):
             field_map[field['sf']] = field['db']
+        lookups = mapping.get('lookups', {})
+        table = self.metadata.tables[mapping['table']]
+        incremental = self.options['incremental']
+        last_modified = None
 
-        for row in self.bulk.get_batch_result_iter(job, batch, parse_csv=True):
-            self._import_row(row, mapping, field_map)
+        if incremental:
+            write_rows = lambda chunk: self._upsert_rows(table, field_map['Id'], chunk)
+        else:
+            write_rows = lambda chunk: self.session.execute(table.insert(), chunk)
+
+        # Write the rows of each result file in chunks with a single
+        # executemany per chunk
+        for result_file in result_files:
+            chunk = []
+            for row in csv.DictReader(result_file):
+                if incremental:
+                    # ISO 8601 timestamps in UTC compare as strings
+                    last_modified = max(last_modified, row['SystemModstamp'])
+                    if 'SystemModstamp' not in field_map:
+                        del row['SystemModstamp']
+                chunk.append(self._import_row(row, lookups, field_map))
+                if len(chunk) == 10000:
+                    write_rows(chunk)
+                    chunk = []
+            if chunk:
+                write_rows(chunk)
+            result_file.close()
 
         self.session.commit()
-
-    def _import_row(self, row, mapping, field_map):
-        model = self.models[mapping['table']]
+        return last_modified
+
+    def _upsert_rows(self, table, id_field, rows):
+        """ Updates the rows whose Salesforce Id is already in the table and
+        inserts the others """
+        sf_ids = [row[id_field] for row in rows]
+        self.queried_ids.setdefault(table.name, []).extend(sf_ids)
+
+        # Select the existing rows in chunks of ids to stay under the
+        # database's limit on the number of bound parameters
+        local_ids = {}
+        for i in range(0, len(sf_ids), 500):
+            local_ids.update(self.session.execute(
+                select([table.c[id_field], table.c.id]).where(
+                    table.c[id_field].in_(sf_ids[i:i + 500]))
+            ).fetchall())
+
+        updates = []
+        inserts = []
+        for row in rows:
+            local_id = local_ids.get(row[id_field])
+            if local_id is None:
+                inserts.append(row)
+            else:
+                row['_local_id'] = local_id
+                updates.append(row)
+
+        if updates:
+            self.session.execute(
+                table.update().where(table.c.id == bindparam('_local_id')),
+                updates,
+            )
+        if inserts:
+            self.session.execute(table.insert(), inserts)
+
+    def _import_row(self, row, lookups, field_map):
         mapped_row = {}
         for key, value in row.items():
-            if key in mapping.get('lookups', {}):
-                if not value:
-                    mapped_row[field_map[key]] = None
-                    continue
-                # For lookup fields, the value should be the local db id instead of the sf id
-                lookup = mapping['lookups'][key]
-                lookup_model = self.models[lookup['table']]
-                kwargs = { lookup['value_field']: value }
-                res = self.session.query(lookup_model).filter_by(**kwargs).first()
-                if res:
-                    mapped_row[field_map[key]] = res.id
-                else:
-                    mapped_row[field_map[key]] = None
+            if key in lookups and not value:
+                mapped_row[field_map[key]] = None
             else:
+                # Lookup fields hold the Salesforce Id of the referenced
+                # record until _translate_lookups runs
                 mapped_row[field_map[key]] = value.decode('utf-8')
-        instance = model()
-        for key, value in mapped_row.items():
-            setattr(instance, key, value)
-        self.session.add(instance)
+        return mapped_row
+
+    def _translate_lookups(self):
+        """ Replaces the Salesforce Ids in lookup fields with the local id of
+        the referenced row using one UPDATE per lookup """
+        translated = set()
+        for name, mapping in self.mappings.items():
+            table = self.metadata.tables[mapping['table']]
+            for lookup in mapping.get('lookups', {}).values():
+                # Tables can be shared by mappings so only translate a
+                # column once
+                key = (mapping['table'], lookup['key_field'])
+                if key in translated:
+                    continue
+                translated.add(key)
+
+                self._index_column(lookup['table'], lookup['value_field'])
+                lookup_table = self.metadata.tables[lookup['table']].alias()
+                local_id = select([lookup_table.c.id]).where(
+                    lookup_table.c[lookup['value_field']] ==
+                    table.c[lookup['key_field']]
+                ).limit(1).as_scalar()
+                update = table.update().where(
+                    table.c[lookup['key_field']] != None
+                ).values({lookup['key_field']: local_id})
+
+                if not self.options['incremental']:
+                    # Rows left by earlier runs were already translated
+                    self.session.execute(update.where(
+                        table.c.id > self.start_ids[mapping['table']]))
+                    continue
+
+                # The rows of earlier runs were already translated so only
+                # the rows queried by this run hold Salesforce Ids
+                sf_ids = self.queried_ids.get(mapping['table'], [])
+                id_column = table.c[mapping['fields']['Id']]
+                for i in range(0, len(sf_ids), 500):
+                    self.session.execute(
+                        update.where(id_column.in_(sf_ids[i:i + 500])))
+        self.session.commit()
+
+    def _index_column(self, table_name, column_name):
+        """ Indexes the Salesforce Id column of a lookup table, unless it
+        already is, so each translated row finds its lookup without
+        scanning the table """
+        connection = self.session.connection()
+        for index in inspect(connection).get_indexes(table_name):
+            if index['column_names'] == [column_name]:
+                return
+        table = self.metadata.tables[table_name]
+        Index(
+            'ix_{}_{}'.format(table_name, column_name),
+            table.c[column_name],
+        ).create(connection)
 
     def _create_tables(self):
         for name, mapping in self.mappings.items():
@@ -448,15 +1975,10 @@ class QueryData(BaseSalesforceApiTask):
         return fields
 
     def _create_table(self, mapping):
-        model_name = '{}Model'.format(mapping['table'])
-        mapper_kwargs = {}
         table_kwargs = {}
-        if mapping['table'] in self.models:
-            mapper_kwargs['non_primary'] = True
+        if mapping['table'] in self.metadata.tables:
             table_kwargs['extend_existing'] = True
-        else:
-            self.models[mapping['table']] = type(model_name, (object,), {})
-        
+
         fields = []
         fields.append(Column('id', Integer, primary_key=True))
         for field in self._fields_for_mapping(mapping):
@@ -468,4 +1990,411 @@ class QueryData(BaseSalesforceApiTask):
             **table_kwargs
         )
         self.metadata.create_all()
-        mapper(self.models[mapping['table']], t, **mapper_kwargs)
+
+class IdMap(object):
+    """ Maps the Ids of records in a source org to the Ids of their copies
+    in a target org.
+
+    Up to max_size Ids are kept in memory.  The rest spill to a temporary
+    SQLite database so copying very large orgs does not exhaust memory.
+    """
+    max_size = 1000000
+
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+        self.spill = None
+        self.spill_path = None
+
+    def update(self, pairs):
+        """ Adds (source Id, target Id) pairs """
+        with self.lock:
+            for source_id, target_id in pairs:
+                if source_id in self.ids or len(self.ids) < self.max_size:
+                    self.ids[source_id] = target_id
+                    continue
+                if not self.spill:
+                    self._init_spill()
+                self.spill.execute(
+                    'INSERT OR REPLACE INTO ids VALUES (?, ?)',
+                    (source_id, target_id),
+                )
+            if self.spill:
+                self.spill.commit()
+
+    def get(self, source_id):
+        """ Returns the target Id of a source Id or None if it wasn't copied """
+        with self.lock:
+            target_id = self.ids.get(source_id)
+            if target_id is None and self.spill:
+                row = self.spill.execute(
+                    'SELECT target_id FROM ids WHERE source_id = ?',
+                    (source_id,),
+                ).fetchone()
+                if row:
+                    target_id = str(row[0])
+            return target_id
+
+    def _init_spill(self):
+        handle, self.spill_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        # Steps share the map from several threads behind the lock
+        self.spill = sqlite3.connect(self.spill_path, check_same_thread=False)
+        self.spill.execute('PRAGMA synchronous = OFF')
+        self.spill.execute(
+            'CREATE TABLE ids (source_id TEXT PRIMARY KEY, target_id TEXT)')
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+            os.remove(self.spill_path)
+            self.spill = None
+
+class CopyData(BulkJobTaskMixin, BaseSalesforceApiTask):
+    """ Copies records from the org of the task to a target org by piping
+    the results of bulk queries into insert batches without a database """
+
+    task_options = {
+        'mapping': {
+            'description': 'The path to a LoadData mapping yaml file.  The fields, lookups, static values and record types of each step are copied.  Filters only apply to databases and are ignored.',
+            'required': True,
+        },
+        'target_org': {
+            'description': 'The name of the org in the keychain to copy the records to',
+            'required': True,
+        },
+        'bulk_mode': {
+            'description': 'Set to Serial to force serial mode on all insert jobs in the target org.  Parallel is the default.',
+        },
+        'parallel_steps': {
+            'description': 'The number of independent mapping steps to copy concurrently.  Defaults to 1',
+        },
+        'pk_chunking': {
+            'description': 'If True, enables PK chunking on the query jobs in the source org.  Set to a number to also set the chunk size.',
+        },
+        'bulk_api': {
+            'description': 'The version of the Bulk API to query the source org with: 1.0 or 2.0.  Records are always inserted with 1.0.  Defaults to 1.0',
+        },
+    }
+
+    def _init_options(self, kwargs):
+        super(CopyData, self)._init_options(kwargs)
+
+        bulk_mode = self.options.get('bulk_mode')
+        if bulk_mode and bulk_mode not in ('Serial', 'Parallel'):
+            raise TaskOptionsError('bulk_mode must be either Serial or Parallel')
+
+        self.options['parallel_steps'] = int(self.options.get('parallel_steps', 1))
+
+    def _run_task(self):
+        self.mapping = hiyapyco.load(self.options['mapping'])
+        self._init_target()
+        self.id_map = IdMap()
+        try:
+            _run_steps(
+                self.mapping.keys(),
+                _get_mapping_dependencies(self.mapping),
+                self._copy_step,
+                self.options['parallel_steps'],
+            )
+        finally:
+            self.id_map.close()
+
+    def _init_target(self):
+        keychain = self.project_config.keychain
+        self.target_org_config = keychain.get_org(self.options['target_org'])
+        self.target_org_config.refresh_oauth_token(keychain.get_connected_app())
+        self.target_sf = self._init_api(org_config=self.target_org_config)
+        self.target_bulk = self._init_bulk(self.target_org_config)
+        self.target_record_types = RecordTypeCache(
+            self.target_sf, self.target_org_config, _get_cache_dir())
+
+    def _copy_step(self, name):
+        """ Copies the records of a mapping step.
+
+        Result files of the query download in the background while the
+        batches built from them are posted to the target org, and the Ids of
+        the copies are added to the Id map as each batch completes.  Steps
+        run after the steps they look up so lookups can be translated.
+        """
+        mapping = self.mapping[name]
+        sf_object = mapping['sf_object']
+        self.logger.info('Copying: {}'.format(name))
+
+        fields = [field for field in mapping.get('fields', {}) if field != 'Id']
+        lookups = mapping.get('lookups', {}).keys()
+        static = mapping.get('static', {})
+        import_fields = fields + lookups + static.keys()
+        static_values = [_convert(value) for value in static.values()]
+        if mapping.get('record_type'):
+            import_fields.append('RecordTypeId')
+            static_values.append(_convert(self.target_record_types.get(
+                sf_object, mapping['record_type'])))
+
+        soql = 'SELECT {} FROM {}'.format(', '.join(['Id'] + fields + lookups), sf_object)
+        result_files = self._query_files(sf_object, soql)
+
+        job_id = None
+        pending = {}
+        batches = self._get_copy_batches(
+            result_files, fields, lookups, import_fields, static_values)
+        for batch_file, source_ids in batches:
+            if not job_id:
+                job_id = self.target_bulk.create_insert_job(
+                    sf_object,
+                    contentType='CSV',
+                    concurrency=mapping.get('bulk_mode', self.options.get('bulk_mode')),
+                )
+                self.logger.info('  Created bulk job {} in the target org'.format(job_id))
+            batch_id = self.target_bulk.post_bulk_batch(job_id, batch_file)
+            batch_file.close()
+            pending[batch_id] = source_ids
+            self.logger.info('    Uploaded batch {} of {} records'.format(batch_id, len(source_ids)))
+
+        if not job_id:
+            self.logger.info('  No {} records found, skipping copy'.format(sf_object))
+            return
+
+        self.target_bulk.close_job(job_id)
+
+        def process_batch(batch_id, info):
+            self.id_map.update(
+                self._get_copied_ids(job_id, batch_id, pending.pop(batch_id)))
+
+        self._wait_for_job(job_id, process_batch, bulk=self.target_bulk)
+
+    def _get_copy_batches(self, result_files, fields, lookups, import_fields, static_values):
+        """ Yields csv batch files of the query results with the lookups
+        translated to target Ids and the list of source Ids of each batch """
+        line_buffer = StringIO()
+        writer = csv.writer(line_buffer, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(import_fields)
+        header = line_buffer.getvalue()
+
+        batch_file = None
+        for result_file in result_files:
+            for row in csv.DictReader(result_file):
+                values = [row[field] for field in fields]
+                for lookup in lookups:
+                    # Lookups to records that were not copied are left blank
+                    values.append(self.id_map.get(row[lookup]) if row[lookup] else '')
+                line_buffer.seek(0)
+                line_buffer.truncate()
+                writer.writerow(values + static_values)
+                line = line_buffer.getvalue()
+
+                if batch_file and (
+                    len(source_ids) == BatchSizer.max_rows or
+                    batch_bytes + len(line) > BatchSizer.max_bytes
+                ):
+                    batch_file.seek(0)
+                    yield batch_file, source_ids
+                    batch_file = None
+                if not batch_file:
+                    batch_file = tempfile.TemporaryFile()
+                    batch_file.write(header)
+                    batch_bytes = len(header)
+                    source_ids = []
+
+                batch_file.write(line)
+                batch_bytes += len(line)
+                source_ids.append(row['Id'])
+            result_file.close()
+
+        if batch_file:
+            batch_file.seek(0)
+            yield batch_file, source_ids
+
+    def _get_copied_ids(self, job_id, batch_id, source_ids):
+        """ Returns (source Id, target Id) pairs of the rows of a batch that
+        were inserted """
+        uri = '{}/job/{}/batch/{}/result'.format(
+            self.target_bulk.endpoint, job_id, batch_id)
+        resp = requests.get(uri, headers=self.target_bulk.headers(), stream=True)
+        if resp.status_code >= 400:
+            self.target_bulk.raise_error(resp.content, resp.status_code)
+
+        ids = []
+        failed = 0
+        reader = csv.DictReader(resp.iter_lines(chunk_size=8192))
+        for source_id, result in zip(source_ids, reader):
+            if result['Success'] == 'true':
+                ids.append((source_id, result['Id']))
+            else:
+                failed += 1
+                if failed == 1:
+                    self.logger.warning('    Failed to copy {}: {}'.format(
+                        source_id, result['Error']))
+        if failed:
+            self.logger.warning('    {} records of batch {} failed to copy'.format(
+                failed, batch_id))
+        return ids
+
+class GenerateData(BaseTask):
+    """ Generates rows of synthetic data for the tables of a LoadData
+    mapping so loads can be tested at scale.
+
+    Each mapped field gets a value generated from the type of its column in
+    an existing table, or from the name of the Salesforce field for new
+    tables whose columns are all text.  Lookup keys reference the local ids
+    of the rows generated for the looked up table, which is expected to be
+    joined on its primary key.  Salesforce Id columns are left empty.
+    """
+
+    task_options = {
+        'database_url': {
+            'description': 'A DATABASE_URL to write the generated rows to.  Missing tables are created and rows are appended after the highest existing id.',
+        },
+        'dataset_path': {
+            'description': 'The path of a dataset directory to write the generated rows to instead of a database',
+        },
+        'mapping': {
+            'description': 'The path to a LoadData mapping yaml file',
+            'required': True,
+        },
+        'rows': {
+            'description': 'The number of rows to generate for each table.  Defaults to 1000',
+        },
+        'seed': {
+            'description': 'The seed of the random values.  The same seed, mapping and rows generate the same data.  Defaults to 0',
+        },
+    }
+
+    # The number of rows inserted with each executemany
+    chunk_size = 10000
+
+    # Dates and datetimes are spread over this many days before start_date
+    start_date = datetime.datetime(2017, 1, 1)
+    date_range_days = 3650
+
+    def _init_options(self, kwargs):
+        super(GenerateData, self)._init_options(kwargs)
+        if not self.options.get('database_url') and not self.options.get('dataset_path'):
+            raise TaskOptionsError('GenerateData requires either database_url or dataset_path')
+        self.options['rows'] = int(self.options.get('rows', 1000))
+        self.options['seed'] = int(self.options.get('seed', 0))
+
+    def _run_task(self):
+        self.mapping = hiyapyco.load(self.options['mapping'])
+        columns = self._get_table_columns()
+        if self.options.get('dataset_path'):
+            self._write_dataset(columns)
+        else:
+            self._write_database(columns)
+
+    def _get_table_columns(self):
+        """ Returns an OrderedDict of each table to an OrderedDict of its
+        columns, other than the primary key, to what they hold: the name of a
+        Salesforce field, the lookup spec of a lookup key or None for the
+        columns that are left empty """
+        tables = OrderedDict()
+        for mapping in self.mapping.values():
+            columns = tables.setdefault(mapping['table'], OrderedDict())
+            for sf_field, db_field in mapping.get('fields', {}).items():
+                columns[db_field] = None if sf_field == 'Id' else sf_field
+            for lookup in mapping.get('lookups', {}).values():
+                columns[lookup['key_field']] = lookup
+                lookup_columns = tables.setdefault(lookup['table'], OrderedDict())
+                lookup_columns.setdefault(lookup['value_field'], None)
+        return tables
+
+    def _write_dataset(self, tables):
+        dataset = Dataset(self.options['dataset_path'])
+        id_ranges = dict(
+            (name, (1, self.options['rows'])) for name in tables)
+        for name, columns in tables.items():
+            count = dataset.write_table(
+                name,
+                ['id'] + columns.keys(),
+                self._generate_rows(name, columns, id_ranges),
+            )
+            self.logger.info('Generated {} rows of {}'.format(count, name))
+
+    def _write_database(self, tables):
+        engine = create_engine(self.options['database_url'])
+        _use_sqlite_bulk_pragmas(engine)
+        metadata = MetaData()
+        metadata.bind = engine
+        metadata.reflect(only=[name for name in tables if engine.has_table(name)])
+
+        id_ranges = {}
+        for name, columns in tables.items():
+            if name in metadata.tables:
+                table = metadata.tables[name]
+            else:
+                table = Table(
+                    name,
+                    metadata,
+                    Column('id', Integer, primary_key=True),
+                    *[Column(column, Unicode(255)) for column in columns]
+                )
+                table.create()
+            id_column = list(table.primary_key)[0]
+            last_id = engine.execute(select([func.max(id_column)])).scalar() or 0
+            id_ranges[name] = (last_id + 1, last_id + self.options['rows'])
+
+        try:
+            for name, columns in tables.items():
+                table = metadata.tables[name]
+                keys = [list(table.primary_key)[0].name] + columns.keys()
+                column_types = [table.c[column].type for column in columns]
+                rows = self._generate_rows(name, columns, id_ranges, column_types)
+                insert = table.insert()
+                while True:
+                    chunk = [dict(zip(keys, row))
+                        for row in itertools.islice(rows, self.chunk_size)]
+                    if not chunk:
+                        break
+                    engine.execute(insert, chunk)
+                self.logger.info('Generated {} rows of {}'.format(
+                    self.options['rows'], name))
+        finally:
+            engine.dispose()
+
+    def _generate_rows(self, name, columns, id_ranges, column_types=None):
+        """ Yields the rows of a table as lists of the local id and the
+        values of the columns """
+        # Seed each table on its own so its rows don't depend on the order
+        # or number of the other tables
+        rng = random.Random('{}:{}'.format(self.options['seed'], name))
+        generators = []
+        for index, (column, spec) in enumerate(columns.items()):
+            type_ = column_types[index] if column_types else None
+            generators.append(self._get_generator(rng, spec, type_, id_ranges))
+
+        first_id, last_id = id_ranges[name]
+        for local_id in xrange(first_id, last_id + 1):
+            yield [local_id] + [generate(local_id) for generate in generators]
+
+    def _get_generator(self, rng, spec, type_, id_ranges):
+        """ Returns a function of the local id of a row that generates the
+        value of a column """
+        if spec is None:
+            return lambda local_id: None
+        if isinstance(spec, dict):
+            first_id, last_id = id_ranges[spec['table']]
+            return lambda local_id: rng.randint(first_id, last_id)
+
+        sf_field = spec
+        if isinstance(type_, types.Boolean):
+            return lambda local_id: rng.random() < 0.5
+        if isinstance(type_, types.Integer):
+            return lambda local_id: rng.randint(0, 1000000)
+        if isinstance(type_, (types.Numeric, types.Float)):
+            return lambda local_id: round(rng.uniform(0, 1000000), 2)
+        if isinstance(type_, (types.DateTime, EpochType)):
+            return lambda local_id: self.start_date - datetime.timedelta(
+                seconds=rng.randint(0, self.date_range_days * 86400))
+        if isinstance(type_, types.Date):
+            return lambda local_id: (self.start_date - datetime.timedelta(
+                days=rng.randint(0, self.date_range_days))).date()
+
+        # Text columns are generated from the name of the field
+        if sf_field.endswith('Date'):
+            return lambda local_id: (self.start_date - datetime.timedelta(
+                days=rng.randint(0, self.date_range_days))).date().isoformat()
+        if 'Email' in sf_field:
+            return lambda local_id: u'user{}.{}@example.com'.format(
+                local_id, rng.randint(0, 999999))
+        return lambda local_id: u'{} {} {}'.format(
+            sf_field, local_id, rng.randint(0, 999999))
@@ -1,5 +1,5 @@
-import base64
 import cgi
+from collections import OrderedDict
 import datetime
 from distutils.version import LooseVersion
 import errno
@@ -11,13 +11,17 @@ import re
 import shutil
 import tempfile
 import time
+import xml.etree.ElementTree as ET
 import zipfile
+from multiprocessing.pool import ThreadPool
 
 import hiyapyco
 from github3.repos.repo import Release
+import requests
 from simple_salesforce import Salesforce
 from simple_salesforce import SalesforceGeneralError
 from salesforce_bulk import SalesforceBulk
+from salesforce_bulk.salesforce_bulk import BulkBatchFailed
 import xmltodict
 
 from cumulusci.core.exceptions import ApexTestException
@@ -26,6 +30,7 @@ from cumulusci.core.exceptions import TaskOptionsError
 from cumulusci.core.tasks import BaseTask
 from cumulusci.core.utils import process_bool_arg
 from cumulusci.tasks.metadata.package import PackageXmlGenerator
+from cumulusci.salesforce_api.bulk2 import Bulk2Api
 from cumulusci.salesforce_api.exceptions import MetadataApiError
 from cumulusci.salesforce_api.metadata import ApiDeploy
 from cumulusci.salesforce_api.metadata import ApiListMetadata
@@ -86,25 +91,27 @@ class BaseSalesforceApiTask(BaseSalesforceTask):
         self._init_class()
     
 
-    def _init_api(self, base_url=None):
+    def _init_api(self, base_url=None, org_config=None):
+        org_config = org_config or self.org_config
         if self.api_version:
             api_version = self.api_version
         else:
             api_version = self.project_config.project__package__api_version
 
         rv = Salesforce(
-            instance=self.org_config.instance_url.replace('https://', ''),
-            session_id=self.org_config.access_token,
+            instance=org_config.instance_url.replace('https://', ''),
+            session_id=org_config.access_token,
             version=api_version,
         )
         if base_url is not None:
             rv.base_url += base_url
         return rv
 
-    def _init_bulk(self):
+    def _init_bulk(self, org_config=None):
+        org_config = org_config or self.org_config
         return SalesforceBulk(
-            host=self.org_config.instance_url.replace('https://', ''),
-            sessionId=self.org_config.access_token,
+            host=org_config.instance_url.replace('https://', ''),
+            sessionId=org_config.access_token,
         )
 
     def _init_class(self):
@@ -116,6 +123,223 @@ class BaseSalesforceApiTask(BaseSalesforceTask):
         return obj
 
 
+class BulkJobTaskMixin(object):
+    """ Helpers for running Bulk API jobs with job level polling.
+
+    The bulk_api option of a task selects Bulk API 1.0 (self.bulk) or 2.0
+    (self.bulk2) for its jobs.
+    """
+
+    # Number of result files downloaded concurrently by bulk queries
+    download_workers = 4
+
+    def _init_options(self, kwargs):
+        super(BulkJobTaskMixin, self)._init_options(kwargs)
+        self.options['bulk_api'] = str(self.options.get('bulk_api', '1.0'))
+        if self.options['bulk_api'] not in ('1.0', '2.0'):
+            raise TaskOptionsError('bulk_api must be either 1.0 or 2.0')
+
+    def _init_task(self):
+        super(BulkJobTaskMixin, self)._init_task()
+        self.bulk2 = self._init_bulk2()
+
+    def _init_bulk2(self):
+        if self.api_version:
+            api_version = self.api_version
+        else:
+            api_version = self.project_config.project__package__api_version
+        return Bulk2Api(
+            self.org_config.instance_url,
+            self.org_config.access_token,
+            api_version,
+            self.logger,
+        )
+
+    def _query_files(self, sf_object, soql):
+        """ Runs a bulk query with the selected Bulk API and yields a
+        temporary csv file starting with the header row for each result
+        file """
+        if self.options['bulk_api'] == '1.0':
+            job, batch_ids = self._run_query_job(sf_object, soql)
+            for result_file in self._get_query_results(job, batch_ids):
+                yield result_file
+            return
+
+        # Bulk API 2.0 splits large queries into chunks on the server so the
+        # pk_chunking option does not apply
+        self.logger.info('Creating Bulk API 2.0 query job for: {}'.format(sf_object))
+        self.logger.info('Submitting query: {}'.format(soql))
+        job = self.bulk2.create_query_job(soql)
+        self.logger.info('Job id: {0}'.format(job['id']))
+        info = self.bulk2.wait_for_job(job['id'], 'query')
+        self.logger.info('Job {} complete: {} records'.format(
+            job['id'], info.get('numberRecordsProcessed')))
+        for result_file in self.bulk2.get_query_results(job['id']):
+            yield result_file
+
+    def _get_batch_states(self, job_id, bulk=None):
+        """ Returns an OrderedDict of batch_id: dict of the batch info """
+        bulk = bulk or self.bulk
+        uri = '{}/job/{}/batch'.format(bulk.endpoint, job_id)
+        resp = requests.get(uri, headers=bulk.headers())
+        if resp.status_code >= 400:
+            bulk.raise_error(resp.content, resp.status_code)
+
+        tree = ET.fromstring(resp.content)
+        states = OrderedDict()
+        for batch_info in tree.iterfind('{%s}batchInfo' % bulk.jobNS):
+            info = {}
+            for child in batch_info:
+                info[re.sub('{.*?}', '', child.tag)] = child.text
+            states[info['id']] = info
+        return states
+
+    def _wait_for_job(self, job_id, callback=None, chunked_batch_id=None, until=None, bulk=None):
+        """ Polls a job until none of its batches are queued or in progress.
+
+        The job info is polled instead of each batch.  The batch list is
+        only fetched when the job reports progress and callback is called
+        with the id and info of each batch as soon as it completes.
+        chunked_batch_id is the original batch of a PK chunked query which
+        Salesforce marks as Not Processed once it has been split into chunk
+        batches.  If until is passed, polling also stops as soon as it
+        returns True, which allows waiting on a job that is still open.
+        bulk is the connection of the job's org and defaults to self.bulk.
+        """
+        done = set()
+        finished = 0
+        while True:
+            job = (bulk or self.bulk).job_status(job_id)
+            total = int(job['numberBatchesTotal'])
+            job_finished = (
+                int(job['numberBatchesCompleted']) +
+                int(job['numberBatchesFailed'])
+            )
+            job_pending = (
+                int(job['numberBatchesQueued']) +
+                int(job['numberBatchesInProgress'])
+            )
+            if job_finished > finished:
+                finished = job_finished
+                self.logger.info('    Job {}: {} of {} batches complete'.format(
+                    job_id, finished, total))
+                for batch_id, info in self._get_batch_states(job_id, bulk).items():
+                    if batch_id in done:
+                        continue
+                    state = info['state']
+                    if state == 'Not Processed' and batch_id == chunked_batch_id:
+                        continue
+                    if state in ('Failed', 'Not Processed'):
+                        raise BulkBatchFailed(job_id, batch_id, info.get('stateMessage'))
+                    if state == 'Completed':
+                        done.add(batch_id)
+                        if callback:
+                            callback(batch_id, info)
+            if not job_pending or (until and until()):
+                break
+            self.logger.info('      Checking job status...')
+            time.sleep(10)
+
+    def _create_query_job(self, sf_object):
+        """ Creates a CSV query job, enabling PK chunking if the pk_chunking
+        option is set """
+        pk_chunking = self.options.get('pk_chunking')
+        if pk_chunking in (None, '') or process_bool_arg(pk_chunking) is False:
+            return self.bulk.create_query_job(sf_object, contentType='CSV')
+
+        if process_bool_arg(pk_chunking) is True:
+            header = 'true'
+        else:
+            header = 'chunkSize={}'.format(int(pk_chunking))
+
+        # salesforce_bulk can't pass extra headers so create the job manually
+        uri = '{}/job'.format(self.bulk.endpoint)
+        headers = self.bulk.headers({'Sforce-Enable-PKChunking': header})
+        doc = self.bulk.create_job_doc(
+            object_name=sf_object,
+            operation='query',
+            contentType='CSV',
+        )
+        resp = requests.post(uri, data=doc, headers=headers)
+        if resp.status_code >= 400:
+            self.bulk.raise_error(resp.content, resp.status_code)
+
+        tree = ET.fromstring(resp.content)
+        return tree.findtext('{%s}id' % self.bulk.jobNS)
+
+    def _run_query_job(self, sf_object, soql):
+        """ Runs a bulk query and returns the id of the job and the ids of
+        every completed batch, including the chunk batches of a PK chunked
+        query """
+        self.logger.info('Creating bulk job for: {}'.format(sf_object))
+        job = self._create_query_job(sf_object)
+        self.logger.info('Job id: {0}'.format(job))
+        self.logger.info('Submitting query: {}'.format(soql))
+        batch = self.bulk.query(job, soql)
+        self.logger.info('Batch id: {0}'.format(batch))
+        self.bulk.close_job(job)
+        self.logger.info('Job {0} closed'.format(job))
+
+        batch_ids = []
+        self._wait_for_job(
+            job,
+            lambda batch_id, info: batch_ids.append(batch_id),
+            chunked_batch_id=batch,
+        )
+        return job, batch_ids
+
+    def _get_result_ids(self, job_id, batch_id):
+        uri = '{}/job/{}/batch/{}/result'.format(
+            self.bulk.endpoint, job_id, batch_id)
+        resp = requests.get(uri, headers=self.bulk.headers())
+        if resp.status_code >= 400:
+            self.bulk.raise_error(resp.content, resp.status_code)
+
+        tree = ET.fromstring(resp.content)
+        return [
+            result.text
+            for result in tree.iterfind('{%s}result' % self.bulk.jobNS)
+        ]
+
+    def _download_result(self, job_id, batch_id, result_id):
+        """ Streams a query result file to a temporary file """
+        uri = '{}/job/{}/batch/{}/result/{}'.format(
+            self.bulk.endpoint, job_id, batch_id, result_id)
+        resp = requests.get(uri, headers=self.bulk.headers(), stream=True)
+        if resp.status_code >= 400:
+            self.bulk.raise_error(resp.content, resp.status_code)
+
+        result_file = tempfile.TemporaryFile()
+        for chunk in resp.iter_content(chunk_size=65536):
+            result_file.write(chunk)
+        result_file.seek(0)
+        return result_file
+
+    def _get_query_results(self, job_id, batch_ids):
+        """ Yields a temporary file for each result file of the batches.
+
+        Result files are downloaded concurrently by a pool of
+        download_workers threads and yielded in the order they finish.
+        """
+        results = []
+        for batch_id in batch_ids:
+            for result_id in self._get_result_ids(job_id, batch_id):
+                results.append((batch_id, result_id))
+        if not results:
+            return
+
+        self.logger.info('Downloading {} result files'.format(len(results)))
+        pool = ThreadPool(min(self.download_workers, len(results)))
+        try:
+            for result_file in pool.imap_unordered(
+                lambda result: self._download_result(job_id, *result),
+                results,
+            ):
+                yield result_file
+        finally:
+            pool.terminate()
+
+
 class GetInstalledPackages(BaseSalesforceMetadataApiTask):
     api_class = ApiRetrieveInstalledPackages
     name = 'GetInstalledPackages'
@@ -349,8 +573,9 @@ class Deploy(BaseSalesforceMetadataApiTask):
             for f in files:
                 self._write_zip_file(zipf, root, f)
         zipf = self._process_zip_file(zipf)
-        zipf.fp.seek(0)
-        package_zip = base64.b64encode(zipf.fp.read())
+        # The zip is encoded as it is sent by the api
+        package_zip = zipf.fp
+        zipf.close()
 
         os.chdir(pwd)
 
@@ -1212,27 +1437,32 @@ class PackageUpload(BaseSalesforceApiTask):
             ))
 
 
-class SOQLQuery(BaseSalesforceApiTask):
+class SOQLQuery(BulkJobTaskMixin, BaseSalesforceApiTask):
     name = 'SOQLQuery'
 
     task_options = {
         'object' : {'required':True, 'description':'The object to query'},
         'query' : {'required':True, 'description':'A valid bulk SOQL query for the object'},
-        'result_file' : {'required':True,'description':'The name of the csv file to write the results to'}
+        'result_file' : {'required':True,'description':'The name of the csv file to write the results to'},
+        'pk_chunking' : {'description':'If True, enables PK chunking on the query job.  Set to a number to also set the chunk size.'},
+        'bulk_api' : {'description':'The version of the Bulk API to use: 1.0 or 2.0.  Defaults to 1.0'},
     }
 
     def _run_task(self):
-        self.logger.info('Creating bulk job for: {object}'.format(**self.options))
-        job = self.bulk.create_query_job(self.options['object'], contentType='CSV')
-        self.logger.info('Job id: {0}'.format(job))
-        self.logger.info('Submitting query: {query}'.format(**self.options))
-        batch = self.bulk.query(job,self.options['query'])
-        self.logger.info('Batch id: {0}'.format(batch))
-        self.bulk.wait_for_batch(job,batch)
-        self.logger.info('Batch {0} finished'.format(batch))
-        self.bulk.close_job(job)
-        self.logger.info('Job {0} closed'.format(job))
-        with open(self.options['result_file'],"w") as result_file:
-            for row in self.bulk.get_batch_result_iter(job,batch):
-                result_file.write(row+'\n')
+        results = self._query_files(
+            self.options['object'],
+            self.options['query'],
+        )
+        with open(self.options['result_file'], 'wb') as result_file:
+            header = True
+            for result in results:
+                # Every result file starts with the header row
+                if not header:
+                    result.readline()
+                header = False
+                for line in result:
+                    if not line.endswith('\n'):
+                        line += '\n'
+                    result_file.write(line)
+                result.close()
         self.logger.info('Wrote results to: {result_file}'.format(**self.options))
@@ -0,0 +1,1493 @@
+""" Tests for the bulkdata tasks """
+
+import csv
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+from collections import OrderedDict
+from StringIO import StringIO
+
+from mock import MagicMock
+from mock import patch
+from salesforce_bulk.salesforce_bulk import BulkBatchFailed
+import responses
+from sqlalchemy import Column
+from sqlalchemy import Date
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import create_engine
+from sqlalchemy import Unicode
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.types import NullType
+
+from cumulusci.core.config import BaseGlobalConfig
+from cumulusci.core.config import BaseProjectConfig
+from cumulusci.core.config import OrgConfig
+from cumulusci.core.config import ScratchOrgConfig
+from cumulusci.core.config import TaskConfig
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.salesforce_api.tests.utils import FakeBulk2Server
+from cumulusci.tasks.bulkdata import BatchSizer
+from cumulusci.tasks.bulkdata import CopyData
+from cumulusci.tasks.bulkdata import Dataset
+from cumulusci.tasks.bulkdata import DeleteData
+from cumulusci.tasks.bulkdata import EpochType
+from cumulusci.tasks.bulkdata import GenerateData
+from cumulusci.tasks.bulkdata import IdMap
+from cumulusci.tasks.bulkdata import LoadData
+from cumulusci.tasks.bulkdata import QueryData
+from cumulusci.tasks.bulkdata import RecordTypeCache
+from cumulusci.tasks.bulkdata import _get_converters
+from cumulusci.tasks.bulkdata import _get_mapping_dependencies
+from cumulusci.tasks.bulkdata import _run_steps
+from cumulusci.tasks.bulkdata import _use_sqlite_bulk_pragmas
+
+MAPPING = """Insert Accounts:
+    sf_object: Account
+    table: accounts
+    fields:
+        Id: sf_id
+        Name: name
+Insert Contacts:
+    sf_object: Contact
+    table: contacts
+    fields:
+        Id: sf_id
+        LastName: last_name
+    lookups:
+        AccountId:
+            table: accounts
+            key_field: account_id
+            join_field: id
+            value_field: sf_id
+"""
+
+SCHEMA = """
+CREATE TABLE accounts (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(255),
+    sf_id VARCHAR(18)
+);
+CREATE TABLE contacts (
+    id INTEGER PRIMARY KEY,
+    last_name VARCHAR(255),
+    account_id INTEGER,
+    sf_id VARCHAR(18)
+);
+INSERT INTO accounts VALUES (1, 'Account 1', '001000000000001');
+INSERT INTO accounts VALUES (2, 'Account 2', NULL);
+INSERT INTO contacts VALUES (1, 'Contact 1', 1, NULL);
+INSERT INTO contacts VALUES (2, 'Contact 2', 2, NULL);
+INSERT INTO contacts VALUES (3, 'Contact 3', NULL, NULL);
+INSERT INTO contacts VALUES (4, 'Contact 4', 1, NULL);
+"""
+
+
+class TestMappingSteps(unittest.TestCase):
+
+    def test_get_mapping_dependencies(self):
+        mappings = OrderedDict([
+            ('Accounts', {'table': 'accounts'}),
+            ('Products', {'table': 'products'}),
+            ('Contacts', {'table': 'contacts', 'lookups': {
+                'AccountId': {'table': 'accounts'},
+            }}),
+            ('Account Parents', {'table': 'accounts', 'lookups': {
+                'ParentId': {'table': 'accounts'},
+            }}),
+        ])
+        self.assertEqual(_get_mapping_dependencies(mappings), OrderedDict([
+            ('Accounts', set()),
+            ('Products', set()),
+            ('Contacts', set(['Accounts'])),
+            ('Account Parents', set(['Accounts'])),
+        ]))
+
+    def test_run_steps_in_dependency_order(self):
+        steps = ['A', 'B', 'C', 'D']
+        dependencies = {
+            'A': set(),
+            'B': set(),
+            'C': set(['A']),
+            'D': set(['B', 'C']),
+        }
+        finished = []
+        def run_step(step):
+            for dependency in dependencies[step]:
+                self.assertIn(dependency, finished)
+            finished.append(step)
+        _run_steps(steps, dependencies, run_step, 2)
+        self.assertEqual(sorted(finished), steps)
+
+    def test_run_steps_reraises_error(self):
+        def run_step(step):
+            if step == 'A':
+                raise ValueError('step failed')
+        with self.assertRaises(ValueError):
+            _run_steps(['A', 'B'], {'A': set(), 'B': set(['A'])}, run_step, 2)
+
+
+class TestConverters(unittest.TestCase):
+
+    def test_get_converters(self):
+        table = Table(
+            'contacts',
+            MetaData(),
+            Column('name', Unicode(255)),
+            Column('employees', Integer),
+            Column('birthdate', Date),
+            Column('last_activity', EpochType()),
+            Column('other', NullType()),
+        )
+        converters = _get_converters(table.columns)
+        self.assertEqual([index for index, convert in converters], [0, 2, 3, 4])
+        row = [u'N\xe4me', 5, datetime.date(1980, 1, 1),
+            datetime.datetime(2017, 1, 1, 12, 30), u'Other']
+        for index, convert in converters:
+            row[index] = convert(row[index])
+        self.assertEqual(row, ['N\xc3\xa4me', 5, '1980-01-01', '2017-01-01T12:30:00', 'Other'])
+        self.assertIsNone(converters[0][1](None))
+
+
+class TestSqliteBulkPragmas(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _journal_mode(self):
+        engine = create_engine('sqlite:///{}'.format(self.db_path))
+        _use_sqlite_bulk_pragmas(engine)
+        mode = engine.execute('PRAGMA journal_mode').scalar()
+        engine.dispose()
+        return mode
+
+    def test_new_database(self):
+        self.assertEqual(self._journal_mode(), 'memory')
+
+    def test_existing_database(self):
+        sqlite3.connect(self.db_path).close()
+        self.assertEqual(self._journal_mode(), 'delete')
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def setUp(self):
+        self.sizer = BatchSizer('Account', MagicMock())
+        self.sizer.rows = 4000
+
+    def test_record_lock_errors(self):
+        self.sizer.record(_batch_info('B1'), lock_errors=1)
+        self.assertEqual(self.sizer.rows, 2000)
+
+    def test_record_slow_batch(self):
+        self.sizer.record(_batch_info(
+            'B1', numberRecordsProcessed='4000', totalProcessingTime='240000'))
+        self.assertEqual(self.sizer.rows, 1000)
+
+    def test_record_fast_batch(self):
+        self.sizer.record(_batch_info('B1'))
+        self.assertEqual(self.sizer.rows, 8000)
+        self.sizer.record(_batch_info('B2'))
+        self.assertEqual(self.sizer.rows, BatchSizer.max_rows)
+
+    def test_record_minimum(self):
+        self.sizer.rows = BatchSizer.min_rows
+        self.sizer.record(_batch_info('B1'), lock_errors=10)
+        self.assertEqual(self.sizer.rows, BatchSizer.min_rows)
+
+
+class TestRecordTypeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'id': 'https://login.salesforce.com/id/00D000000000001/005000000000001',
+        }, 'test')
+        self.sf = MagicMock()
+        self.sf.query_all.return_value = {'records': [
+            {'Id': '012000000000001', 'SobjectType': 'Account', 'DeveloperName': 'Business'},
+            {'Id': '012000000000002', 'SobjectType': 'Account', 'DeveloperName': 'Person'},
+            {'Id': '012000000000003', 'SobjectType': 'Contact', 'DeveloperName': 'Business'},
+        ]}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_queries_once(self):
+        cache = RecordTypeCache(self.sf, self.org_config)
+        self.assertEqual(cache.get('Account', 'Person'), '012000000000002')
+        self.assertEqual(cache.get('Contact', 'Business'), '012000000000003')
+        self.assertIsNone(cache.get('Contact', 'Person'))
+        self.assertIsNone(cache.get('Lead', 'Business'))
+        self.assertEqual(self.sf.query_all.call_count, 1)
+
+    def test_get_persists(self):
+        RecordTypeCache(self.sf, self.org_config, self.tempdir).get('Account', 'Person')
+
+        cache = RecordTypeCache(self.sf, self.org_config, self.tempdir)
+        self.assertEqual(cache.get('Account', 'Business'), '012000000000001')
+        self.assertEqual(self.sf.query_all.call_count, 1)
+
+        # Expired caches are queried again
+        cache = RecordTypeCache(self.sf, self.org_config, self.tempdir)
+        with patch('cumulusci.tasks.bulkdata.time.time', return_value=time.time() + cache.ttl + 1):
+            cache.get('Account', 'Business')
+        self.assertEqual(self.sf.query_all.call_count, 2)
+
+    def test_get_persists_per_org(self):
+        # Scratch orgs on the same instance are cached separately
+        orgs = [
+            ScratchOrgConfig({
+                'instance_url': 'https://cs1.salesforce.com',
+                'org_id': org_id,
+            }, 'scratch')
+            for org_id in ('00D000000000002', '00D000000000003')
+        ]
+        RecordTypeCache(self.sf, orgs[0], self.tempdir).get('Account', 'Person')
+        self.sf.query_all.return_value = {'records': [
+            {'Id': '012000000000004', 'SobjectType': 'Account', 'DeveloperName': 'Person'},
+        ]}
+
+        cache = RecordTypeCache(self.sf, orgs[1], self.tempdir)
+        self.assertEqual(cache.get('Account', 'Person'), '012000000000004')
+        self.assertEqual(self.sf.query_all.call_count, 2)
+        self.assertEqual(len(os.listdir(self.tempdir)), 2)
+
+    def test_get_cached_miss_queries_object(self):
+        RecordTypeCache(self.sf, self.org_config, self.tempdir).get('Account', 'Person')
+
+        # A record type deployed after the cache was written
+        self.sf.query_all.return_value = {'records': [
+            {'Id': '012000000000003', 'SobjectType': 'Contact', 'DeveloperName': 'Business'},
+            {'Id': '012000000000004', 'SobjectType': 'Contact', 'DeveloperName': 'Person'},
+        ]}
+        cache = RecordTypeCache(self.sf, self.org_config, self.tempdir)
+        self.assertEqual(cache.get('Contact', 'Person'), '012000000000004')
+        self.sf.query_all.assert_called_with(
+            "SELECT Id, SobjectType, DeveloperName FROM RecordType WHERE SobjectType = 'Contact'")
+        # Each object is only queried again once
+        self.assertIsNone(cache.get('Contact', 'Missing'))
+        self.assertEqual(self.sf.query_all.call_count, 2)
+
+        # The file is rewritten with the new record type
+        cache = RecordTypeCache(self.sf, self.org_config, self.tempdir)
+        self.assertEqual(cache.get('Contact', 'Person'), '012000000000004')
+        self.assertEqual(cache.get('Account', 'Person'), '012000000000002')
+        self.assertEqual(self.sf.query_all.call_count, 2)
+
+
+class TestDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'dataset')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write_and_read_table(self):
+        dataset = Dataset(self.path)
+        count = dataset.write_table(
+            'accounts',
+            ['id', 'name', 'sf_id'],
+            iter([(1, u'Caf\xe9', '001000000000001'), (2, 'Account 2', None)]),
+        )
+        self.assertEqual(count, 2)
+
+        dataset = Dataset(self.path)
+        self.assertEqual(dataset.tables['accounts'], {
+            'name': 'accounts',
+            'file': 'accounts.csv.gz',
+            'columns': ['id', 'name', 'sf_id'],
+            'rows': 2,
+        })
+        self.assertEqual(list(dataset.read_table('accounts', chunk_size=1)), [
+            [{'id': u'1', 'name': u'Caf\xe9', 'sf_id': u'001000000000001'}],
+            [{'id': u'2', 'name': u'Account 2', 'sf_id': None}],
+        ])
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestDeleteData(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+
+    def _run_task(self, options, results):
+        task = DeleteData(
+            self.project_config, TaskConfig({'options': options}), self.org_config)
+        task._run_query_job = MagicMock(return_value=('Q1', ['B1']))
+        task._get_query_results = MagicMock(
+            side_effect=lambda job, batch_ids: [_csv_file(rows) for rows in results])
+        task._wait_for_job = MagicMock()
+        task.bulk = MagicMock()
+        task.bulk.create_job.return_value = 'J1'
+        task.bulk.create_delete_job.return_value = 'J1'
+        uploaded = []
+        def post_bulk_batch(job_id, batch_file):
+            uploaded.append(list(csv.reader(batch_file)))
+            return 'B{}'.format(len(uploaded))
+        task.bulk.post_bulk_batch.side_effect = post_bulk_batch
+        task()
+        return task, uploaded
+
+    def test_run_task_streams_ids_into_batches(self):
+        task, uploaded = self._run_task({'objects': 'Account'}, [
+            [{'Id': '001000000000001'}, {'Id': '001000000000002'}],
+            [{'Id': '001000000000003'}],
+        ])
+        task.bulk.create_delete_job.assert_called_once_with('Account', contentType='CSV')
+        self.assertEqual(uploaded, [[
+            ['Id'],
+            ['001000000000001'],
+            ['001000000000002'],
+            ['001000000000003'],
+        ]])
+        task.bulk.close_job.assert_called_once_with('J1')
+        task._wait_for_job.assert_called_once_with('J1')
+
+    def test_run_task_hard_delete(self):
+        task, uploaded = self._run_task(
+            {'objects': 'Account', 'hard_delete': 'True'},
+            [[{'Id': '001000000000001'}]],
+        )
+        task.bulk.create_job.assert_called_once_with(
+            'Account', 'hardDelete', contentType='CSV')
+
+    def test_get_objects_from_mapping(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            mapping_path = os.path.join(tempdir, 'mapping.yml')
+            with open(mapping_path, 'w') as f:
+                f.write(MAPPING)
+            task = DeleteData(
+                self.project_config,
+                TaskConfig({'options': {'mapping': mapping_path}}),
+                self.org_config,
+            )
+            objects, dependencies = task._get_objects()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(objects, ['Contact', 'Account'])
+        self.assertEqual(dependencies, OrderedDict([
+            ('Contact', set()),
+            ('Account', set(['Contact'])),
+        ]))
+
+    def test_run_task_no_records(self):
+        task, uploaded = self._run_task({'objects': 'Account'}, [])
+        self.assertFalse(task.bulk.create_delete_job.called)
+        self.assertEqual(uploaded, [])
+
+    @responses.activate
+    @patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+    def test_run_task_bulk2(self):
+        task = DeleteData(
+            self.project_config,
+            TaskConfig({'options': {
+                'objects': 'Account',
+                'bulk_api': '2.0',
+                'hard_delete': 'True',
+            }}),
+            self.org_config,
+        )
+        server = FakeBulk2Server(task.bulk2.endpoint)
+        server.register()
+        server.query_results['select Id from Account'] = (['Id'], [
+            {'Id': '001000000000001'},
+            {'Id': '001000000000002'},
+            {'Id': '001000000000003'},
+        ])
+        task()
+
+        delete_jobs = [job for job in server.jobs.values()
+            if job['operation'] == 'hardDelete']
+        self.assertEqual(len(delete_jobs), 1)
+        self.assertEqual(delete_jobs[0]['state'], 'JobComplete')
+        self.assertEqual(
+            delete_jobs[0]['data'],
+            '"Id"\r\n"001000000000001"\r\n"001000000000002"\r\n"001000000000003"\r\n',
+        )
+
+    def test_bulk_api_invalid(self):
+        with self.assertRaises(TaskOptionsError):
+            DeleteData(
+                self.project_config,
+                TaskConfig({'options': {'objects': 'Account', 'bulk_api': '3.0'}}),
+                self.org_config,
+            )
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestLoadData(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = db_path = os.path.join(self.tempdir, 'test.db')
+        conn = sqlite3.connect(db_path)
+        conn.executescript(SCHEMA)
+        conn.commit()
+        conn.close()
+        mapping_path = os.path.join(self.tempdir, 'mapping.yml')
+        with open(mapping_path, 'w') as f:
+            f.write(MAPPING)
+
+        self.task_config = TaskConfig({'options': {
+            'database_url': 'sqlite:///{}'.format(db_path),
+            'mapping': mapping_path,
+        }})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _create_task(self):
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task._init_mapping()
+        task._init_db()
+        # Release the connection before the next test runs steps in threads
+        self.addCleanup(task.session.remove)
+        return task
+
+    def _get_rows(self, task, name):
+        rows = []
+        for batch_file, local_ids in task._get_batches(task.mapping[name]):
+            batch = list(csv.DictReader(batch_file))
+            self.assertEqual(len(batch), len(local_ids))
+            rows.extend(batch)
+            batch_file.close()
+        return rows
+
+    def test_init_db_reflects_mapped_tables(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE unrelated (id INTEGER PRIMARY KEY)')
+        conn.close()
+        task = self._create_task()
+        self.assertEqual(sorted(task.metadata.tables), ['accounts', 'contacts'])
+
+    def test_init_db_reflection_cache(self):
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        self.task_config.config['options']['reflection_cache_dir'] = cache_dir
+        self._create_task()
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        with patch('cumulusci.tasks.bulkdata.MetaData.reflect') as reflect:
+            task = self._create_task()
+        reflect.assert_not_called()
+        self.assertEqual(
+            task.tables['contacts'].__table__.c.keys(),
+            ['id', 'last_name', 'account_id', 'sf_id'],
+        )
+
+        # Schema changes invalidate the cache
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('ALTER TABLE contacts ADD COLUMN email VARCHAR(255)')
+        conn.close()
+        task = self._create_task()
+        self.assertIn('email', task.tables['contacts'].__table__.c)
+
+    def test_get_batches_resolves_lookups(self):
+        task = self._create_task()
+        rows = self._get_rows(task, 'Insert Contacts')
+        self.assertEqual(
+            [(row['LastName'], row['AccountId']) for row in rows],
+            [
+                ('Contact 1', '001000000000001'),
+                ('Contact 2', ''),
+                ('Contact 3', ''),
+                ('Contact 4', '001000000000001'),
+            ],
+        )
+
+    def test_get_batches_ambiguous_lookup(self):
+        task = self._create_task()
+        mapping = task.mapping['Insert Contacts']
+        mapping['lookups']['AccountId']['join_field'] = 'name'
+        mapping['lookups']['AccountId']['key_field'] = 'last_name'
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO accounts VALUES (3, 'Contact 1', '001000000000003')")
+        conn.execute("INSERT INTO accounts VALUES (4, 'Contact 1', '001000000000004')")
+        conn.execute("INSERT INTO accounts VALUES (5, 'Contact 2', '001000000000005')")
+        conn.commit()
+        conn.close()
+        rows = self._get_rows(task, 'Insert Contacts')
+        # Contact 1 matches two accounts so its lookup is left empty
+        self.assertEqual(
+            [(row['LastName'], row['AccountId']) for row in rows],
+            [
+                ('Contact 1', ''),
+                ('Contact 2', '001000000000005'),
+                ('Contact 3', ''),
+                ('Contact 4', ''),
+            ],
+        )
+
+    def test_get_batches_skips_id_on_insert(self):
+        task = self._create_task()
+        rows = self._get_rows(task, 'Insert Accounts')
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertNotIn('Id', row)
+
+    def test_get_batches_filters(self):
+        task = self._create_task()
+        mapping = task.mapping['Insert Contacts']
+        mapping['filters'] = ["last_name != 'Contact 3'"]
+        rows = self._get_rows(task, 'Insert Contacts')
+        self.assertEqual(
+            [row['LastName'] for row in rows],
+            ['Contact 1', 'Contact 2', 'Contact 4'],
+        )
+
+    def test_get_batches_batch_size(self):
+        task = self._create_task()
+        batches = task._get_batches(
+            task.mapping['Insert Contacts'], lambda batch_num: batch_num)
+        self.assertEqual(
+            [local_ids for batch_file, local_ids in batches],
+            [[1], [2, 3], [4]],
+        )
+
+    @patch('cumulusci.tasks.bulkdata.LoadData.query_page_size', 3)
+    def test_get_batches_reads_pages(self):
+        task = self._create_task()
+        rows = self._get_rows(task, 'Insert Contacts')
+        self.assertEqual(
+            [row['LastName'] for row in rows],
+            ['Contact 1', 'Contact 2', 'Contact 3', 'Contact 4'],
+        )
+
+    @patch('cumulusci.tasks.bulkdata.BatchSizer.max_bytes', 80)
+    def test_get_batches_max_bytes(self):
+        task = self._create_task()
+        batches = task._get_batches(task.mapping['Insert Contacts'])
+        self.assertEqual(
+            [local_ids for batch_file, local_ids in batches],
+            [[1, 2], [3, 4]],
+        )
+
+    @responses.activate
+    def test_process_batch_results_writes_ids(self):
+        task = self._create_task()
+        responses.add(
+            method=responses.GET,
+            url='{}/job/J1/batch/B1/result'.format(task.bulk.endpoint),
+            body='"Id","Success","Created","Error"\n'
+                '"003000000000001","true","true",""\n'
+                '"","false","false","UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record"\n'
+                '"003000000000003","true","true",""\n',
+            status=200,
+        )
+        failures = task._process_batch_results(
+            task.mapping['Insert Contacts'], 'J1', 'B1', [1, 2, 3])
+        self.assertEqual(failures, [
+            (2, 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record'),
+        ])
+        rows = task.session.execute(
+            'SELECT id, sf_id FROM contacts ORDER BY id').fetchall()
+        self.assertEqual(
+            [tuple(row) for row in rows],
+            [(1, '003000000000001'), (2, None), (3, '003000000000003'), (4, None)],
+        )
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_run_task_parallel_steps(self):
+        self.task_config.config['options']['parallel_steps'] = 2
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.create_insert_job.side_effect = lambda sf_object, **kwargs: sf_object
+        task.bulk.post_bulk_batch.side_effect = lambda job_id, batch_file: job_id
+        task.bulk.job_status.return_value = _job_info(completed=1, total=1)
+        task._get_batch_states = MagicMock(
+            side_effect=lambda job_id, bulk=None: OrderedDict([(job_id, _batch_info(job_id))]))
+        task._process_batch_results = MagicMock()
+        task()
+        self.assertEqual(
+            [call[0][2] for call in task._process_batch_results.call_args_list],
+            ['Account', 'Contact'],
+        )
+
+    def _run_task_with_batches(self):
+        """ Runs the task against a fake Bulk API which returns a new Id for
+        every row and writes back the Ids of each batch """
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.endpoint = 'https://example.com/services/async/38.0'
+        task.bulk.headers.return_value = {}
+        task.bulk.create_insert_job.side_effect = lambda sf_object, **kwargs: sf_object
+        batches = OrderedDict()
+
+        def post_bulk_batch(job_id, batch_file):
+            batch_id = '751{:012d}'.format(len(batches) + 1)
+            batches[batch_id] = (job_id, len(list(csv.DictReader(batch_file))))
+            return batch_id
+
+        def job_batches(job_id):
+            return [batch_id for batch_id, (job, rows) in batches.items() if job == job_id]
+
+        def results(request):
+            batch_id = request.url.split('/')[-2]
+            job_id, rows = batches[batch_id]
+            prefix = '001' if job_id == 'Account' else '003'
+            body = '"Id","Success","Created","Error"\n'
+            for i in range(rows):
+                body += '"{}{:09d}{:03d}","true","true",""\n'.format(
+                    prefix, int(batch_id[3:]), i)
+            return (200, {}, body)
+
+        task.bulk.post_bulk_batch.side_effect = post_bulk_batch
+        task.bulk.job_status.side_effect = lambda job_id: _job_info(
+            completed=len(job_batches(job_id)), total=len(job_batches(job_id)))
+        task._get_batch_states = MagicMock(side_effect=lambda job_id, bulk=None: OrderedDict(
+            (batch_id, _batch_info(batch_id)) for batch_id in job_batches(job_id)))
+        responses.add_callback(
+            responses.GET, re.compile(r'.*/batch/\w+/result$'), callback=results)
+        task()
+        return batches
+
+    @responses.activate
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    @patch('cumulusci.tasks.bulkdata.BatchSizer.max_rows', 2)
+    def test_run_task_multiple_batches(self):
+        batches = self._run_task_with_batches()
+        self.assertEqual(
+            [(job_id, rows) for job_id, rows in batches.values()],
+            [('Account', 2), ('Contact', 2), ('Contact', 2)],
+        )
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute('SELECT sf_id FROM contacts ORDER BY id').fetchall(),
+            [('003000000002000',), ('003000000002001',),
+                ('003000000003000',), ('003000000003001',)],
+        )
+
+    @responses.activate
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    @patch('cumulusci.tasks.bulkdata.LoadData.query_page_size', 1)
+    def test_run_task_resolves_lookups_once(self):
+        # The lookup table is aggregated once for the step, not per page
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self._run_task_with_batches()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(
+            len([s for s in statements if 'GROUP BY' in s]), 1)
+
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute(
+                "SELECT name FROM sqlite_master WHERE name LIKE 'cumulusci_lookup_%'"
+            ).fetchall(),
+            [],
+        )
+
+    @responses.activate
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    @patch('cumulusci.tasks.bulkdata.BatchSizer.max_rows', 1)
+    @patch('cumulusci.tasks.bulkdata.BatchSizer.min_rows', 1)
+    def test_run_task_pending_window_full(self):
+        # Completed batches are processed while rows are still being read
+        self.task_config.config['options']['max_pending_batches'] = 1
+        batches = self._run_task_with_batches()
+        self.assertEqual(len(batches), 6)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute('SELECT sf_id FROM contacts ORDER BY id').fetchall(),
+            [('003000000003000',), ('003000000004000',),
+                ('003000000005000',), ('003000000006000',)],
+        )
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_run_task_resume(self):
+        def run_task(fail_on=None):
+            task = LoadData(self.project_config, self.task_config, self.org_config)
+            task.bulk = MagicMock()
+            task.bulk.create_insert_job.side_effect = lambda sf_object, **kwargs: sf_object
+            def post_bulk_batch(job_id, batch_file):
+                if job_id == fail_on:
+                    raise Exception('Connection reset')
+                return job_id
+            task.bulk.post_bulk_batch.side_effect = post_bulk_batch
+            task.bulk.job_status.return_value = _job_info(completed=1, total=1)
+            task._get_batch_states = MagicMock(
+                side_effect=lambda job_id, bulk=None: OrderedDict([(job_id, _batch_info(job_id))]))
+            task._process_batch_results = MagicMock()
+            task()
+            return task
+
+        with self.assertRaises(Exception):
+            run_task(fail_on='Contact')
+
+        self.task_config.config['options']['resume'] = 'True'
+        task = run_task()
+        self.assertEqual(
+            [call[0][2] for call in task._process_batch_results.call_args_list],
+            ['Contact'],
+        )
+        self.assertFalse(task.engine.has_table(task.state_table_name))
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_upload_batches_max_pending_batches(self):
+        self.task_config.config['options']['max_pending_batches'] = 1
+        task = self._create_task()
+        task._init_state()
+        task.bulk = MagicMock()
+        task.bulk.create_insert_job.return_value = 'J1'
+        task.bulk.post_bulk_batch.side_effect = ['B1', 'B2']
+        task.bulk.job_status.return_value = _job_info(completed=1, total=1)
+        task._get_batch_states = MagicMock(side_effect=[
+            OrderedDict([('B1', _batch_info('B1'))]),
+            OrderedDict([('B1', _batch_info('B1')), ('B2', _batch_info('B2'))]),
+            OrderedDict([('B1', _batch_info('B1')), ('B2', _batch_info('B2'))]),
+        ])
+        task._process_batch_results = MagicMock(return_value=[])
+        sizer = BatchSizer('Contact', task.logger)
+        sizer.rows = 1000
+        batches = [(_csv_file([{'LastName': 'Contact 1'}]), [1]),
+            (_csv_file([{'LastName': 'Contact 2'}]), [2])]
+        task._upload_batches('Insert Contacts', task.mapping['Insert Contacts'],
+            iter(batches), sizer)
+        self.assertEqual(
+            [call[0][2] for call in task._process_batch_results.call_args_list],
+            ['B1', 'B2'],
+        )
+        self.assertEqual(sizer.rows, 4000)
+
+    def _run_task_with_failures(self, failures):
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.create_insert_job.side_effect = (
+            lambda sf_object, **kwargs: '{}-{}'.format(sf_object, kwargs['concurrency']))
+        task.bulk.post_bulk_batch.side_effect = lambda job_id, batch_file: job_id
+        task.bulk.job_status.return_value = _job_info(completed=1, total=1)
+        task._get_batch_states = MagicMock(
+            side_effect=lambda job_id, bulk=None: OrderedDict([(job_id, _batch_info(job_id))]))
+        task._process_batch_results = MagicMock(
+            side_effect=lambda mapping, job_id, batch_id, local_ids: failures.get(job_id, []))
+        task()
+        return task
+
+    def _read_error_file(self):
+        with open(self.task_config.config['options']['error_file'], 'rb') as f:
+            return list(csv.reader(f))
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_run_task_retries_lock_failures(self):
+        self.task_config.config['options']['error_file'] = os.path.join(
+            self.tempdir, 'errors.csv')
+        task = self._run_task_with_failures({
+            'Contact-None': [
+                (1, 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record'),
+                (2, 'REQUIRED_FIELD_MISSING:Required fields are missing: [LastName]'),
+            ],
+        })
+        calls = task._process_batch_results.call_args_list
+        self.assertEqual(
+            [(call[0][1], call[0][3]) for call in calls],
+            [('Account-None', [1, 2]), ('Contact-None', [1, 2, 3, 4]), ('Contact-Serial', [1])],
+        )
+        self.assertEqual(self._read_error_file(), [
+            ['Step', 'Local Id', 'Error'],
+            ['Insert Contacts', '2', 'REQUIRED_FIELD_MISSING:Required fields are missing: [LastName]'],
+        ])
+        self.assertEqual(task.failed_rows, 1)
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_run_task_retries_exhausted(self):
+        self.task_config.config['options']['error_file'] = os.path.join(
+            self.tempdir, 'errors.csv')
+        self.task_config.config['options']['max_retries'] = 1
+        failures = [(3, 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record')]
+        task = self._run_task_with_failures({
+            'Contact-None': failures,
+            'Contact-Serial': failures,
+        })
+        self.assertEqual(task._process_batch_results.call_count, 3)
+        self.assertEqual(self._read_error_file(), [
+            ['Step', 'Local Id', 'Error'],
+            ['Insert Contacts', '3', failures[0][1]],
+        ])
+
+    @responses.activate
+    @patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+    def test_run_task_bulk2(self):
+        self.task_config.config['options']['bulk_api'] = '2.0'
+        self.task_config.config['options']['error_file'] = os.path.join(
+            self.tempdir, 'errors.csv')
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        server = FakeBulk2Server(task.bulk2.endpoint)
+        server.register()
+        server.failures['Contact 3'] = 'REQUIRED_FIELD_MISSING:Required fields are missing'
+        task()
+
+        self.assertEqual(len(server.jobs), 2)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute('SELECT name, sf_id FROM accounts ORDER BY id').fetchall(),
+            [('Account 1', '001000000000001'), ('Account 2', '001000000000002')],
+        )
+        # Results come back in reverse order and are matched on their values
+        self.assertEqual(
+            conn.execute('SELECT last_name, sf_id FROM contacts ORDER BY id').fetchall(),
+            [
+                ('Contact 1', '001000000000001'),
+                ('Contact 2', '001000000000002'),
+                ('Contact 3', None),
+                ('Contact 4', '001000000000003'),
+            ],
+        )
+        conn.close()
+        self.assertEqual(self._read_error_file(), [
+            ['Step', 'Local Id', 'Error'],
+            ['Insert Contacts', '3', 'REQUIRED_FIELD_MISSING:Required fields are missing'],
+        ])
+
+    @responses.activate
+    @patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+    def test_run_task_incremental(self):
+        self.task_config.config['options']['bulk_api'] = '2.0'
+        self.task_config.config['options']['incremental'] = 'True'
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        server = FakeBulk2Server(task.bulk2.endpoint)
+        server.register()
+        task()
+        self.assertEqual(len(server.jobs), 2)
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE contacts SET last_name = 'Contact 2b' WHERE id = 2")
+        conn.execute("INSERT INTO contacts VALUES (5, 'Contact 5', NULL, NULL)")
+        conn.commit()
+        conn.close()
+
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        server.jobs.clear()
+        task()
+
+        # Only the changed and new contacts are sent, with the Id of the
+        # contact that was loaded before
+        self.assertEqual(len(server.jobs), 1)
+        job = server.jobs.values()[0]
+        self.assertEqual((job['object'], job['operation'], job['externalIdFieldName']),
+            ('Contact', 'upsert', 'Id'))
+        self.assertEqual(
+            [(row['Id'], row['LastName']) for row in csv.DictReader(StringIO(job['data']))],
+            [('001000000000002', 'Contact 2b'), ('', 'Contact 5')],
+        )
+        hashes = task.session.execute(
+            'SELECT local_id, sf_id FROM {} WHERE sf_object = :sf_object ORDER BY local_id'.format(
+                task.hash_table_name), {'sf_object': 'Contact'}).fetchall()
+        self.assertEqual(
+            [tuple(row) for row in hashes],
+            [(1, '001000000000001'), (2, '001000000000001'),
+                (3, '001000000000003'), (4, '001000000000004'), (5, '001000000000002')],
+        )
+
+    @responses.activate
+    @patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+    def test_run_task_incremental_delete_removed(self):
+        self.task_config.config['options']['bulk_api'] = '2.0'
+        self.task_config.config['options']['incremental'] = 'True'
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        server = FakeBulk2Server(task.bulk2.endpoint)
+        server.register()
+        task()
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('DELETE FROM contacts WHERE id IN (1, 3)')
+        conn.commit()
+        conn.close()
+
+        self.task_config.config['options']['delete_removed'] = 'True'
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        server.jobs.clear()
+        task()
+
+        self.assertEqual(len(server.jobs), 1)
+        job = server.jobs.values()[0]
+        self.assertEqual((job['object'], job['operation']), ('Contact', 'delete'))
+        self.assertEqual(
+            [row['Id'] for row in csv.DictReader(StringIO(job['data']))],
+            ['001000000000001', '001000000000003'],
+        )
+        hashes = task.session.execute(
+            'SELECT local_id FROM {} WHERE sf_object = :sf_object ORDER BY local_id'.format(
+                task.hash_table_name), {'sf_object': 'Contact'}).fetchall()
+        self.assertEqual([row[0] for row in hashes], [2, 4])
+
+    def test_incremental_options(self):
+        self.task_config.config['options']['delete_removed'] = 'True'
+        with self.assertRaises(TaskOptionsError):
+            LoadData(self.project_config, self.task_config, self.org_config)
+        self.task_config.config['options']['incremental'] = 'True'
+        self.task_config.config['options']['resume'] = 'True'
+        with self.assertRaises(TaskOptionsError):
+            LoadData(self.project_config, self.task_config, self.org_config)
+
+    def test_database_url_or_dataset_path_required(self):
+        del self.task_config.config['options']['database_url']
+        with self.assertRaises(TaskOptionsError):
+            LoadData(self.project_config, self.task_config, self.org_config)
+
+    def test_bulk_mode_invalid(self):
+        self.task_config.config['options']['bulk_mode'] = 'Sequential'
+        with self.assertRaises(TaskOptionsError):
+            LoadData(self.project_config, self.task_config, self.org_config)
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_wait_for_job_processes_batches_as_completed(self):
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.job_status.side_effect = [
+            _job_info(completed=0, total=2),
+            _job_info(completed=1, total=2),
+            _job_info(completed=2, total=2),
+        ]
+        task._get_batch_states = MagicMock(side_effect=[
+            OrderedDict([('B1', _batch_info('B1')), ('B2', _batch_info('B2', 'InProgress'))]),
+            OrderedDict([('B1', _batch_info('B1')), ('B2', _batch_info('B2'))]),
+        ])
+        completed = []
+        task._wait_for_job('J1', lambda batch_id, info: completed.append(batch_id))
+        self.assertEqual(completed, ['B1', 'B2'])
+        self.assertEqual(task.bulk.job_status.call_count, 3)
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_wait_for_job_failed_batch(self):
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.job_status.return_value = _job_info(completed=0, total=1, failed=1)
+        task._get_batch_states = MagicMock(return_value=OrderedDict([
+            ('B1', _batch_info('B1', 'Failed', stateMessage='InvalidBatch : bad csv')),
+        ]))
+        with self.assertRaises(BulkBatchFailed):
+            task._wait_for_job('J1')
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestQueryData(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tempdir, 'test.db')
+        mapping_path = os.path.join(self.tempdir, 'mapping.yml')
+        with open(mapping_path, 'w') as f:
+            f.write(MAPPING)
+
+        self.task_config = TaskConfig({'options': {
+            'database_url': 'sqlite:///{}'.format(self.db_path),
+            'mapping': mapping_path,
+        }})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_run_task_translates_lookups(self):
+        results = {
+            'Account': [
+                {'Id': '001000000000001', 'Name': 'Account 1'},
+                {'Id': '001000000000002', 'Name': 'Account 2'},
+            ],
+            'Contact': [
+                {'Id': '003000000000001', 'LastName': 'Contact 1', 'AccountId': '001000000000002'},
+                {'Id': '003000000000002', 'LastName': 'Contact 2', 'AccountId': ''},
+                {'Id': '003000000000003', 'LastName': 'Contact 3', 'AccountId': '001000000000009'},
+            ],
+        }
+        task = QueryData(self.project_config, self.task_config, self.org_config)
+        task._run_query_job = MagicMock(
+            side_effect=lambda sf_object, soql: (sf_object, ['B1']))
+        task._get_query_results = MagicMock(
+            side_effect=lambda job, batch_ids: [_csv_file(results[job])])
+        task()
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            'SELECT sf_id, name FROM accounts ORDER BY id').fetchall()
+        self.assertEqual(rows, [
+            ('001000000000001', 'Account 1'),
+            ('001000000000002', 'Account 2'),
+        ])
+        rows = conn.execute(
+            'SELECT sf_id, last_name, account_id FROM contacts ORDER BY id').fetchall()
+        self.assertEqual(rows, [
+            ('003000000000001', 'Contact 1', '2'),
+            ('003000000000002', 'Contact 2', None),
+            ('003000000000003', 'Contact 3', None),
+        ])
+        # The Salesforce Ids of the lookup table are indexed for the update
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(accounts)')]
+        self.assertIn('ix_accounts_sf_id', indexes)
+        conn.close()
+
+    def test_run_task_keeps_earlier_lookups(self):
+        for run in range(1, 3):
+            results = {
+                'Account': [{'Id': '00100000000000{}'.format(run), 'Name': 'Account'}],
+                'Contact': [{
+                    'Id': '00300000000000{}'.format(run),
+                    'LastName': 'Contact',
+                    'AccountId': '00100000000000{}'.format(run),
+                }],
+            }
+            task = QueryData(self.project_config, self.task_config, self.org_config)
+            task._run_query_job = MagicMock(
+                side_effect=lambda sf_object, soql: (sf_object, ['B1']))
+            task._get_query_results = MagicMock(
+                side_effect=lambda job, batch_ids: [_csv_file(results[job])])
+            task()
+
+        # Lookups translated by the first run are not translated again
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            'SELECT id, account_id FROM contacts ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, u'1'), (2, u'2')])
+        conn.close()
+
+    def test_run_task_incremental(self):
+        self.task_config.config['options']['incremental'] = 'True'
+        account_soql = 'SELECT Id, Name, SystemModstamp FROM Account'
+        contact_soql = 'SELECT Id, LastName, AccountId, SystemModstamp FROM Contact'
+        results = {
+            account_soql: [
+                {'Id': '001000000000001', 'Name': 'Account 1', 'SystemModstamp': '2017-01-02T00:00:00.000Z'},
+                {'Id': '001000000000002', 'Name': 'Account 2', 'SystemModstamp': '2017-01-01T00:00:00.000Z'},
+            ],
+            contact_soql: [
+                {'Id': '003000000000001', 'LastName': 'Contact 1', 'AccountId': '001000000000002',
+                    'SystemModstamp': '2017-01-01T00:00:00.000Z'},
+            ],
+            account_soql + ' WHERE SystemModstamp >= 2017-01-01T23:55:00.000Z': [
+                # Modified at the watermark but committed after the last run
+                {'Id': '001000000000001', 'Name': 'Account 1b', 'SystemModstamp': '2017-01-02T00:00:00.000Z'},
+                {'Id': '001000000000002', 'Name': 'Account 2b', 'SystemModstamp': '2017-01-03T00:00:00.000Z'},
+                {'Id': '001000000000003', 'Name': 'Account 3', 'SystemModstamp': '2017-01-04T00:00:00.000Z'},
+            ],
+            contact_soql + ' WHERE SystemModstamp >= 2016-12-31T23:55:00.000Z': [
+                {'Id': '003000000000002', 'LastName': 'Contact 2', 'AccountId': '001000000000003',
+                    'SystemModstamp': '2017-01-03T00:00:00.000Z'},
+            ],
+        }
+
+        def run_task():
+            task = QueryData(self.project_config, self.task_config, self.org_config)
+            task._run_query_job = MagicMock(
+                side_effect=lambda sf_object, soql: (soql, ['B1']))
+            task._get_query_results = MagicMock(
+                side_effect=lambda job, batch_ids: [_csv_file(results[job])])
+            task()
+            return [call[0][1] for call in task._run_query_job.call_args_list]
+
+        run_task()
+        self.assertEqual(run_task(), [
+            account_soql + ' WHERE SystemModstamp >= 2017-01-01T23:55:00.000Z',
+            contact_soql + ' WHERE SystemModstamp >= 2016-12-31T23:55:00.000Z',
+        ])
+
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute('SELECT id, sf_id, name FROM accounts ORDER BY id').fetchall(),
+            [(1, '001000000000001', 'Account 1b'), (2, '001000000000002', 'Account 2b'),
+                (3, '001000000000003', 'Account 3')],
+        )
+        self.assertEqual(
+            conn.execute('SELECT sf_id, account_id FROM contacts ORDER BY id').fetchall(),
+            [('003000000000001', '2'), ('003000000000002', '3')],
+        )
+        self.assertEqual(
+            conn.execute('SELECT name, last_modified FROM cumulusci_query_watermarks ORDER BY name').fetchall(),
+            [('Insert Accounts', '2017-01-04T00:00:00.000Z'),
+                ('Insert Contacts', '2017-01-03T00:00:00.000Z')],
+        )
+
+        # Records read again from the overlap keep the watermark
+        results[account_soql + ' WHERE SystemModstamp >= 2017-01-03T23:55:00.000Z'] = [
+            {'Id': '001000000000003', 'Name': 'Account 3', 'SystemModstamp': '2017-01-04T00:00:00.000Z'},
+        ]
+        results[contact_soql + ' WHERE SystemModstamp >= 2017-01-02T23:55:00.000Z'] = [
+            {'Id': '003000000000002', 'LastName': 'Contact 2', 'AccountId': '001000000000003',
+                'SystemModstamp': '2017-01-02T23:58:00.000Z'},
+        ]
+        run_task()
+        self.assertEqual(
+            conn.execute('SELECT name, last_modified FROM cumulusci_query_watermarks ORDER BY name').fetchall(),
+            [('Insert Accounts', '2017-01-04T00:00:00.000Z'),
+                ('Insert Contacts', '2017-01-03T00:00:00.000Z')],
+        )
+        conn.close()
+
+    def test_soql_for_mapping_watermark(self):
+        self.task_config.config['options']['incremental'] = 'True'
+        task = QueryData(self.project_config, self.task_config, self.org_config)
+        task._init_mapping()
+        mapping = task.mappings['Insert Accounts']
+        self.assertEqual(
+            task._soql_for_mapping(mapping, '2017-01-01T00:02:30.123Z'),
+            'SELECT Id, Name, SystemModstamp FROM Account'
+            ' WHERE SystemModstamp >= 2016-12-31T23:57:30.123Z',
+        )
+        # Records modified at the watermark are always queried again
+        task.watermark_overlap = 0
+        self.assertEqual(
+            task._soql_for_mapping(mapping, '2017-01-01T00:02:30.123Z'),
+            'SELECT Id, Name, SystemModstamp FROM Account'
+            ' WHERE SystemModstamp >= 2017-01-01T00:02:30.123Z',
+        )
+
+    def test_incremental_requires_id(self):
+        self.task_config.config['options']['incremental'] = 'True'
+        task = QueryData(self.project_config, self.task_config, self.org_config)
+        task.options['mapping'] = os.path.join(self.tempdir, 'no_id.yml')
+        with open(task.options['mapping'], 'w') as f:
+            f.write(MAPPING.replace('        Id: sf_id\n', ''))
+        with self.assertRaises(TaskOptionsError):
+            task._init_mapping()
+
+    @responses.activate
+    @patch('cumulusci.salesforce_api.bulk2.time.sleep', MagicMock())
+    def test_run_task_bulk2(self):
+        self.task_config.config['options']['bulk_api'] = '2.0'
+        task = QueryData(self.project_config, self.task_config, self.org_config)
+        server = FakeBulk2Server(task.bulk2.endpoint)
+        server.register()
+        server.query_results['SELECT Id, Name FROM Account'] = (['Id', 'Name'], [
+            {'Id': '001000000000001', 'Name': 'Account 1'},
+            {'Id': '001000000000002', 'Name': 'Account 2'},
+            {'Id': '001000000000003', 'Name': 'Account 3'},
+        ])
+        server.query_results['SELECT Id, LastName, AccountId FROM Contact'] = (
+            ['Id', 'LastName', 'AccountId'],
+            [{'Id': '003000000000001', 'LastName': 'Contact 1', 'AccountId': '001000000000003'}],
+        )
+        task()
+
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(
+            conn.execute('SELECT id, sf_id FROM accounts ORDER BY id').fetchall(),
+            [(1, '001000000000001'), (2, '001000000000002'), (3, '001000000000003')],
+        )
+        self.assertEqual(
+            conn.execute('SELECT sf_id, account_id FROM contacts').fetchall(),
+            [('003000000000001', '3')],
+        )
+        conn.close()
+
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_dataset_round_trip(self):
+        results = {
+            'Account': [
+                {'Id': '001000000000001', 'Name': 'Account 1'},
+                {'Id': '001000000000002', 'Name': 'Account 2'},
+            ],
+            'Contact': [
+                {'Id': '003000000000001', 'LastName': 'Contact 1', 'AccountId': '001000000000002'},
+                {'Id': '003000000000002', 'LastName': 'Contact 2', 'AccountId': ''},
+            ],
+        }
+        options = self.task_config.config['options']
+        del options['database_url']
+        options['dataset_path'] = os.path.join(self.tempdir, 'dataset')
+        task = QueryData(self.project_config, self.task_config, self.org_config)
+        task._run_query_job = MagicMock(
+            side_effect=lambda sf_object, soql: (sf_object, ['B1']))
+        task._get_query_results = MagicMock(
+            side_effect=lambda job, batch_ids: [_csv_file(results[job])])
+        task()
+
+        self.assertFalse(os.path.exists(task.staging_path))
+        dataset = Dataset(options['dataset_path'])
+        self.assertEqual(dataset.tables.keys(), ['accounts', 'contacts'])
+        self.assertEqual(dataset.tables['contacts']['columns'],
+            ['id', 'sf_id', 'last_name', 'account_id'])
+
+        task = LoadData(self.project_config, self.task_config, self.org_config)
+        task.bulk = MagicMock()
+        task.bulk.create_insert_job.side_effect = lambda sf_object, **kwargs: sf_object
+        uploaded = {}
+        def post_bulk_batch(job_id, batch_file):
+            uploaded[job_id] = list(csv.reader(batch_file))
+            return job_id
+        task.bulk.post_bulk_batch.side_effect = post_bulk_batch
+        task.bulk.job_status.return_value = _job_info(completed=1, total=1)
+        task._get_batch_states = MagicMock(
+            side_effect=lambda job_id, bulk=None: OrderedDict([(job_id, _batch_info(job_id))]))
+        task._process_batch_results = MagicMock(return_value=[])
+        task()
+
+        self.assertFalse(os.path.exists(task.staging_path))
+        self.assertEqual(uploaded['Account'], [
+            ['Name'], ['Account 1'], ['Account 2'],
+        ])
+        # The dataset still holds the Ids of the queried org
+        self.assertEqual(uploaded['Contact'], [
+            ['LastName', 'AccountId'],
+            ['Contact 1', '001000000000002'],
+            ['Contact 2', ''],
+        ])
+
+
+class TestIdMap(unittest.TestCase):
+
+    def test_spill(self):
+        id_map = IdMap()
+        id_map.max_size = 2
+        try:
+            id_map.update([
+                ('001000000000001', '001000000000011'),
+                ('001000000000002', '001000000000012'),
+                ('001000000000003', '001000000000013'),
+            ])
+            self.assertEqual(len(id_map.ids), 2)
+            self.assertTrue(os.path.isfile(id_map.spill_path))
+            self.assertEqual(
+                [id_map.get('00100000000000{}'.format(i)) for i in range(1, 5)],
+                ['001000000000011', '001000000000012', '001000000000013', None],
+            )
+        finally:
+            id_map.close()
+        self.assertFalse(os.path.exists(id_map.spill_path))
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestCopyData(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+
+        self.tempdir = tempfile.mkdtemp()
+        mapping_path = os.path.join(self.tempdir, 'mapping.yml')
+        with open(mapping_path, 'w') as f:
+            f.write(MAPPING)
+        self.task_config = TaskConfig({'options': {
+            'mapping': mapping_path,
+            'target_org': 'target',
+        }})
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @responses.activate
+    @patch('cumulusci.tasks.salesforce.time.sleep', MagicMock())
+    def test_run_task_translates_lookups(self):
+        results = {
+            'Account': [
+                {'Id': '001000000000001', 'Name': 'Account 1'},
+                {'Id': '001000000000002', 'Name': 'Account 2'},
+            ],
+            'Contact': [
+                {'Id': '003000000000001', 'LastName': 'Contact 1', 'AccountId': '001000000000002'},
+                {'Id': '003000000000002', 'LastName': 'Contact 2', 'AccountId': ''},
+                {'Id': '003000000000003', 'LastName': 'Contact 3', 'AccountId': '001000000000009'},
+            ],
+        }
+        task = CopyData(self.project_config, self.task_config, self.org_config)
+        task._init_target = MagicMock()
+        task._query_files = MagicMock(
+            side_effect=lambda sf_object, soql: [_csv_file(results[sf_object])])
+        task.target_bulk = MagicMock()
+        task.target_bulk.endpoint = 'https://target.example.com/services/async/38.0'
+        task.target_bulk.headers.return_value = {}
+        task.target_bulk.create_insert_job.side_effect = lambda sf_object, **kwargs: sf_object
+        uploaded = {}
+        def post_bulk_batch(job_id, batch_file):
+            uploaded[job_id] = list(csv.reader(batch_file))
+            return job_id
+        task.target_bulk.post_bulk_batch.side_effect = post_bulk_batch
+        task.target_bulk.job_status.return_value = _job_info(completed=1, total=1)
+        task._get_batch_states = MagicMock(
+            side_effect=lambda job_id, bulk=None: OrderedDict([(job_id, _batch_info(job_id))]))
+        responses.add(
+            method=responses.GET,
+            url='{}/job/Account/batch/Account/result'.format(task.target_bulk.endpoint),
+            body='"Id","Success","Created","Error"\n'
+                '"001000000000011","true","true",""\n'
+                '"001000000000012","true","true",""\n',
+            status=200,
+        )
+        responses.add(
+            method=responses.GET,
+            url='{}/job/Contact/batch/Contact/result'.format(task.target_bulk.endpoint),
+            body='"Id","Success","Created","Error"\n'
+                '"003000000000011","true","true",""\n'
+                '"003000000000012","true","true",""\n'
+                '"003000000000013","true","true",""\n',
+            status=200,
+        )
+        task()
+
+        self.assertEqual(
+            task._query_files.call_args_list[1][0],
+            ('Contact', 'SELECT Id, LastName, AccountId FROM Contact'),
+        )
+        self.assertEqual(uploaded['Account'], [
+            ['Name'], ['Account 1'], ['Account 2'],
+        ])
+        self.assertEqual(uploaded['Contact'], [
+            ['LastName', 'AccountId'],
+            ['Contact 1', '001000000000012'],
+            ['Contact 2', ''],
+            ['Contact 3', ''],
+        ])
+        task._get_batch_states.assert_called_with('Contact', task.target_bulk)
+
+
+class TestGenerateData(unittest.TestCase):
+
+    def setUp(self):
+        self.global_config = BaseGlobalConfig()
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.tempdir = tempfile.mkdtemp()
+        self.mapping_path = os.path.join(self.tempdir, 'mapping.yml')
+        with open(self.mapping_path, 'w') as f:
+            f.write(MAPPING)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _run_task(self, **options):
+        options['mapping'] = self.mapping_path
+        task = GenerateData(self.project_config, TaskConfig({'options': options}))
+        task()
+
+    def _read_dataset(self, path):
+        dataset = Dataset(path)
+        return dict((name, sum(dataset.read_table(name), []))
+            for name in dataset.tables)
+
+    def test_dataset(self):
+        path = os.path.join(self.tempdir, 'dataset')
+        self._run_task(dataset_path=path, rows=5, seed=1)
+        tables = self._read_dataset(path)
+
+        self.assertEqual(sorted(tables), ['accounts', 'contacts'])
+        contacts = tables['contacts']
+        self.assertEqual([row['id'] for row in contacts], ['1', '2', '3', '4', '5'])
+        for row in contacts:
+            self.assertIsNone(row['sf_id'])
+            self.assertTrue(row['last_name'].startswith('LastName {} '.format(row['id'])))
+            self.assertIn(int(row['account_id']), range(1, 6))
+
+        # The same seed generates the same rows
+        self._run_task(dataset_path=os.path.join(self.tempdir, 'again'), rows=5, seed=1)
+        self.assertEqual(self._read_dataset(os.path.join(self.tempdir, 'again')), tables)
+
+    def test_database_appends_rows(self):
+        db_path = os.path.join(self.tempdir, 'test.db')
+        conn = sqlite3.connect(db_path)
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self._run_task(database_url='sqlite:///{}'.format(db_path), rows=3)
+
+        conn = sqlite3.connect(db_path)
+        self.assertEqual(
+            [row[0] for row in conn.execute('SELECT id FROM accounts ORDER BY id')],
+            [1, 2, 3, 4, 5],
+        )
+        rows = conn.execute(
+            'SELECT id, account_id, sf_id FROM contacts WHERE id > 4 ORDER BY id').fetchall()
+        conn.close()
+        self.assertEqual([row[0] for row in rows], [5, 6, 7])
+        for local_id, account_id, sf_id in rows:
+            self.assertIn(account_id, [3, 4, 5])
+            self.assertIsNone(sf_id)
+
+
+def _job_info(completed, total, failed=0):
+    return {
+        'numberBatchesQueued': str(total - completed - failed),
+        'numberBatchesInProgress': '0',
+        'numberBatchesCompleted': str(completed),
+        'numberBatchesFailed': str(failed),
+        'numberBatchesTotal': str(total),
+    }
+
+
+def _batch_info(batch_id, state='Completed', **kwargs):
+    info = {
+        'id': batch_id,
+        'state': state,
+        'numberRecordsProcessed': '1',
+        'totalProcessingTime': '100',
+    }
+    info.update(kwargs)
+    return info
+
+
+def _csv_file(rows):
+    f = tempfile.TemporaryFile()
+    writer = csv.DictWriter(f, rows[0].keys())
+    writer.writeheader()
+    writer.writerows(rows)
+    f.seek(0)
+    return f
@@ -1,4 +1,10 @@
+import base64
+import io
+import os
+import shutil
+import tempfile
 import unittest
+import zipfile
 
 from mock import MagicMock
 from mock import patch
@@ -11,6 +17,8 @@ from cumulusci.core.config import OrgConfig
 from cumulusci.core.config import TaskConfig
 from cumulusci.core.keychain import BaseProjectKeychain
 from cumulusci.tasks.salesforce import BaseSalesforceApiTask
+from cumulusci.tasks.salesforce import SOQLQuery
+from cumulusci.tasks.salesforce import UpdateDependencies
 
 
 @patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
@@ -41,3 +49,154 @@ class TestSalesforceToolingTask(unittest.TestCase):
         obj = task._get_tooling_object('TestObject')
         url = self.base_tooling_url + 'sobjects/TestObject/'
         self.assertEqual(obj.base_url, url)
+
+
+BATCH_LIST = """<?xml version="1.0" encoding="UTF-8"?>
+<batchInfoList xmlns="http://www.force.com/2009/06/asyncapi/dataload">
+    <batchInfo><id>B0</id><state>Not Processed</state></batchInfo>
+    <batchInfo><id>B1</id><state>Completed</state></batchInfo>
+    <batchInfo><id>B2</id><state>Completed</state></batchInfo>
+</batchInfoList>"""
+
+RESULT_LIST = """<?xml version="1.0" encoding="UTF-8"?>
+<result-list xmlns="http://www.force.com/2009/06/asyncapi/dataload">{}</result-list>"""
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestSOQLQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+        self.tempdir = tempfile.mkdtemp()
+        self.result_file = os.path.join(self.tempdir, 'results.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @responses.activate
+    def test_run_task_pk_chunking(self):
+        task_config = TaskConfig({'options': {
+            'object': 'Account',
+            'query': 'SELECT Id FROM Account',
+            'result_file': self.result_file,
+            'pk_chunking': 2,
+        }})
+        task = SOQLQuery(self.project_config, task_config, self.org_config)
+        endpoint = task.bulk.endpoint
+        task.bulk.query = MagicMock(return_value='B0')
+        task.bulk.close_job = MagicMock()
+        task.bulk.job_status = MagicMock(return_value={
+            'numberBatchesQueued': '0',
+            'numberBatchesInProgress': '0',
+            'numberBatchesCompleted': '2',
+            'numberBatchesFailed': '0',
+            'numberBatchesTotal': '3',
+        })
+
+        responses.add(
+            method=responses.POST,
+            url=endpoint + '/job',
+            body='<jobInfo xmlns="http://www.force.com/2009/06/asyncapi/dataload"><id>J1</id></jobInfo>',
+        )
+        responses.add(
+            method=responses.GET,
+            url=endpoint + '/job/J1/batch',
+            body=BATCH_LIST,
+        )
+        responses.add(
+            method=responses.GET,
+            url=endpoint + '/job/J1/batch/B1/result',
+            body=RESULT_LIST.format('<result>R1</result>'),
+        )
+        responses.add(
+            method=responses.GET,
+            url=endpoint + '/job/J1/batch/B2/result',
+            body=RESULT_LIST.format('<result>R2</result><result>R3</result>'),
+        )
+        for batch_id, result_id, body in (
+            ('B1', 'R1', '"Id"\n"001000000000001"\n"001000000000002"\n'),
+            ('B2', 'R2', '"Id"\n"001000000000003"\n'),
+            ('B2', 'R3', '"Id"\n"001000000000004"'),
+        ):
+            responses.add(
+                method=responses.GET,
+                url='{}/job/J1/batch/{}/result/{}'.format(
+                    endpoint, batch_id, result_id),
+                body=body,
+            )
+
+        task()
+
+        self.assertEqual(
+            responses.calls[0].request.headers['Sforce-Enable-PKChunking'],
+            'chunkSize=2',
+        )
+        with open(self.result_file, 'rb') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], '"Id"')
+        self.assertEqual(sorted(lines[1:]), [
+            '"001000000000001"',
+            '"001000000000002"',
+            '"001000000000003"',
+            '"001000000000004"',
+        ])
+
+
+@patch('cumulusci.tasks.salesforce.BaseSalesforceTask._update_credentials',
+    MagicMock(return_value=None))
+class TestUpdateDependencies(unittest.TestCase):
+
+    def setUp(self):
+        self.api_version = 38.0
+        self.global_config = BaseGlobalConfig(
+            {'project': {'package': {'api_version': self.api_version}}})
+        self.project_config = BaseProjectConfig(self.global_config)
+        self.project_config.config['project'] = {
+            'package': {
+                'api_version': self.api_version,
+            }
+        }
+        self.org_config = OrgConfig({
+            'instance_url': 'https://example.com',
+            'access_token': 'abc123',
+        }, 'test')
+
+    @responses.activate
+    def test_install_zip_dependency_subfolder(self):
+        zip_bytes = io.BytesIO()
+        zip_file = zipfile.ZipFile(zip_bytes, 'w')
+        zip_file.writestr('repo-master/unpackaged/pre/package.xml', '<Package />')
+        zip_file.writestr('repo-master/unpackaged/pre/classes/Test.cls', 'public class Test {}')
+        zip_file.writestr('repo-master/src/package.xml', '<Package />')
+        zip_file.close()
+        responses.add(
+            method=responses.GET,
+            url='https://example.com/repo.zip',
+            body=zip_bytes.getvalue(),
+        )
+
+        task = UpdateDependencies(self.project_config, TaskConfig(), self.org_config)
+        task.api_class = MagicMock()
+        task._install_dependency({
+            'zip_url': 'https://example.com/repo.zip',
+            'subfolder': 'repo-master/unpackaged/pre',
+        })
+
+        package_zip = task.api_class.call_args[0][1]
+        deployed = zipfile.ZipFile(io.BytesIO(base64.b64decode(package_zip)))
+        self.assertEqual(
+            sorted(deployed.namelist()), ['classes/Test.cls', 'package.xml'])
+        self.assertEqual(deployed.read('classes/Test.cls'), 'public class Test {}')
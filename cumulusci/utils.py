@@ -6,7 +6,10 @@ import fnmatch
 import os
 import re
 import io
+import shutil
+import tempfile
 import zipfile
+from collections import OrderedDict
 
 import requests
 
@@ -107,22 +110,71 @@ def download_extract_zip(url, target=None, subfolder=None):
     
 
 
-def zip_subfolder(zip_src, path):
-    if not path.endswith('/'):
-        path = path + '/'
-
-    zip_dest = zipfile.ZipFile(io.BytesIO(), 'w', zipfile.ZIP_DEFLATED)
-    for name in zip_src.namelist():
-        if not name.startswith(path):
-            continue
-
-        content = zip_src.read(name)
-        rel_name = name.replace(path, '', 1)
+class ZipSubfolder(object):
+    """ A read only view of the files under a folder of a zip file with
+    names relative to the folder.  Files are read from the source zip file
+    when accessed rather than copied. """
+
+    def __init__(self, zip_src, path):
+        if not path.endswith('/'):
+            path = path + '/'
+        self.zip_src = zip_src
+        self.path = path
+        # relative name: name in the source zip file
+        self.names = OrderedDict()
+        for name in zip_src.namelist():
+            if name.startswith(path) and name != path:
+                self.names[name[len(path):]] = name
+
+    def namelist(self):
+        return list(self.names)
+
+    def open(self, name, mode='r'):
+        return self.zip_src.open(self.names[name], mode)
+
+    def read(self, name):
+        return self.zip_src.read(self.names[name])
+
+    def extractall(self, path):
+        for rel_name, name in self.names.items():
+            parts = rel_name.split('/')
+            # Skip names that would be written outside of path
+            if rel_name.startswith('/') or '..' in parts:
+                continue
+            target = os.path.join(path, *parts)
+            if name.endswith('/'):
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with self.zip_src.open(name) as src, open(target, 'wb') as dest:
+                shutil.copyfileobj(src, dest)
+
+    def as_zipfile(self):
+        """ Copies the files to a new zip file for callers that need a real
+        ZipFile.  It is returned open for writing like the zip files built
+        by the other zip_ functions. """
+        zip_dest = zipfile.ZipFile(
+            tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024),
+            'w',
+            zipfile.ZIP_DEFLATED,
+        )
+        for rel_name, name in self.names.items():
+            info = self.zip_src.getinfo(name)
+            dest_info = zipfile.ZipInfo(rel_name, info.date_time)
+            dest_info.compress_type = zipfile.ZIP_DEFLATED
+            dest_info.external_attr = info.external_attr
+            zip_dest.writestr(dest_info, self.zip_src.read(name))
+        return zip_dest
+
+    def close(self):
+        self.zip_src.close()
 
-        if rel_name:
-            zip_dest.writestr(rel_name, content)
 
-    return zip_dest
+def zip_subfolder(zip_src, path):
+    """ Returns a view of the files under a folder of a zip file """
+    return ZipSubfolder(zip_src, path)
 
 
 def zip_inject_namespace(zip_src, namespace=None, managed=None, filename_token=None, namespace_token=None, namespaced_org=None, logger=None):
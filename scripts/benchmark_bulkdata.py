@@ -0,0 +1,137 @@
+""" Benchmarks the csv generation of LoadData on a generated SQLite table
+
+Usage: python scripts/benchmark_bulkdata.py [--rows 1000000]
+
+Times the conversion of the rows with _convert on every cell against the
+per-column converters picked from the column types, then the whole
+_get_batches pipeline of LoadData.
+"""
+import argparse
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from cumulusci.core.config import BaseGlobalConfig
+from cumulusci.core.config import BaseProjectConfig
+from cumulusci.core.config import OrgConfig
+from cumulusci.core.config import TaskConfig
+from cumulusci.tasks.bulkdata import LoadData
+from cumulusci.tasks.bulkdata import _convert
+from cumulusci.tasks.bulkdata import _get_converters
+
+MAPPING = """Insert Contacts:
+    sf_object: Contact
+    table: contacts
+    fields:
+        FirstName: first_name
+        LastName: last_name
+        Email: email
+        NumberOfEmployees__c: employees
+        Amount__c: amount
+        Birthdate: birthdate
+        LastActivity__c: last_activity
+"""
+
+
+class BenchmarkLoadData(LoadData):
+
+    def _update_credentials(self):
+        # Nothing is sent to an org
+        pass
+
+
+def create_database(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE contacts (id INTEGER PRIMARY KEY, first_name VARCHAR(255), '
+        'last_name VARCHAR(255), email VARCHAR(255), employees INTEGER, '
+        'amount FLOAT, birthdate DATE, last_activity DATETIME)'
+    )
+    conn.executemany(
+        'INSERT INTO contacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        ((
+            i,
+            u'First {}'.format(i),
+            u'L\xe4st {}'.format(i),
+            u'contact{}@example.com'.format(i),
+            i % 1000,
+            i / 100.0,
+            '1980-01-01',
+            1483228800000 + i,
+        ) for i in xrange(1, rows + 1)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def create_task(tempdir, db_path):
+    mapping_path = os.path.join(tempdir, 'mapping.yml')
+    with open(mapping_path, 'w') as f:
+        f.write(MAPPING)
+    global_config = BaseGlobalConfig({'project': {'package': {'api_version': 38.0}}})
+    project_config = BaseProjectConfig(global_config)
+    project_config.config['project'] = {'package': {'api_version': 38.0}}
+    org_config = OrgConfig({
+        'instance_url': 'https://example.com',
+        'access_token': 'abc123',
+    }, 'benchmark')
+    task_config = TaskConfig({'options': {
+        'database_url': 'sqlite:///{}'.format(db_path),
+        'mapping': mapping_path,
+    }})
+    task = BenchmarkLoadData(project_config, task_config, org_config)
+    task._init_mapping()
+    task._init_db()
+    return task
+
+
+def timed(label, func):
+    start = time.time()
+    result = func()
+    print '{:<32} {:8.2f}s'.format(label, time.time() - start)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(tempdir, 'benchmark.db')
+        timed('Create {} rows'.format(args.rows), lambda: create_database(db_path, args.rows))
+        task = create_task(tempdir, db_path)
+        mapping = task.mapping['Insert Contacts']
+        query = task._query_db(mapping, mapping['fields'])
+        rows = timed('Fetch rows', lambda: task.session.execute(query).fetchall())
+
+        def convert_cells():
+            for row in rows:
+                [_convert(value) for value in row[1:]]
+
+        def convert_columns():
+            converters = _get_converters(list(query.inner_columns)[1:])
+            for row in rows:
+                values = list(row[1:])
+                for index, convert in converters:
+                    values[index] = convert(values[index])
+
+        timed('Convert each cell', convert_cells)
+        timed('Convert by column type', convert_columns)
+
+        def get_batches():
+            for batch_file, local_ids in task._get_batches(mapping):
+                batch_file.close()
+
+        timed('_get_batches', get_batches)
+        task.session.remove()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()